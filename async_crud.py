@@ -0,0 +1,191 @@
+import asyncio
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from pymongo import AsyncMongoClient
+from pymongo.errors import DuplicateKeyError
+
+from . import crud
+from .config import \
+DATABASE_NAME, LAST_UPDATE_TTL, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, \
+MONGO_URI, UPDATE_LOCK_TTL
+from .crud import \
+area_pipeline, batch_pipeline, format_batch, format_values, profile_entry, \
+profiles_filter, quantiles_pipeline, values_pipeline
+from .sketch import format_quantiles
+
+# Asynchronous counterparts of the functions of the "crud" module used
+# by the API, so that waiting for the database does not block the event
+# loop (and therefore the other requests handled by the same worker).
+
+mongoClient = AsyncMongoClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE)
+database = mongoClient[DATABASE_NAME]
+
+# Date of the last update and revision of the data (see function
+# "crud.get_revision"), along with the time until which they can be used
+# without querying the database again.
+last_update = {"date": None, "revision": 0, "expiry": float(0)}
+
+async def get_last_update(refresh=False):
+    '''
+    Return the date of the last update of the database (read from
+    the database at most once every "LAST_UPDATE_TTL" seconds, unless
+    "refresh" is True).
+    '''
+    if refresh or last_update["expiry"] <= time.monotonic():
+        document = await database["last_update"].find_one()
+        last_update["date"] = document["date"]
+        last_update["revision"] = document.get("revision", 0)
+        last_update["expiry"] = time.monotonic()+LAST_UPDATE_TTL
+    return last_update["date"]
+
+async def get_revision(refresh=False):
+    '''
+    Return the number of backfills merged into the database (read along
+    with the date of the last update, see function "get_last_update").
+    '''
+    await get_last_update(refresh)
+    return last_update["revision"]
+
+async def history_is_updated(refresh=False):
+    '''
+    Test whether the pollution data recorded up to yesterday
+    are stored in the "air_quality" database.
+    '''
+    DATE = date.today()
+    return await get_last_update(refresh) == \
+    datetime(DATE.year, DATE.month, DATE.day) - timedelta(days=1)
+
+async def is_monitored_by(pollutant, station):
+    '''
+    Test whether air concentration of "pollutant" is recorded by the
+    air quality monitoring station identified by "station_code".
+    '''
+    document = await database["distribution_pollutants"].find_one(
+        {"_id": station})
+    return document is not None and \
+    pollutant in document["monitored_pollutants"]
+
+async def get_values(station, pollutant, n_days):
+    '''
+    See function "get_values" of the "crud" module.
+    '''
+    if not(n_days):
+        return format_values([])
+    cursor = await database["working_days"].aggregate(
+        values_pipeline(station, pollutant, n_days))
+    return format_values(await cursor.to_list())
+
+async def get_batch_values(pairs, stations, n_days):
+    '''
+    Return the averages of "get_values" for each of the given (station,
+    pollutant) pairs and each pollutant of the given stations, all of
+    them retrieved with a single query (see function "format_batch" of
+    the "crud" module for the shape of the result).
+    '''
+    if not(n_days):
+        return format_batch([], pairs)
+    cursor = await database["working_days"].aggregate(
+        batch_pipeline(pairs, stations, n_days))
+    return format_batch(await cursor.to_list(), pairs)
+
+async def get_quantiles(station, pollutant, n_days, q):
+    '''
+    See function "get_quantiles" of the "crud" module.
+    '''
+    if not(n_days):
+        return format_quantiles([], q)
+    cursor = await database["working_days"].aggregate(
+        quantiles_pipeline(station, pollutant, n_days))
+    return format_quantiles(await cursor.to_list(), q)
+
+async def get_area_values(level, area, pollutant, n_days):
+    '''
+    Return the averages of "get_values" calculated with the data of all
+    the stations of "area" (a city, department or region, as given by
+    "level"), or None if no data of "pollutant" exists for this area.
+    '''
+    if not(n_days):
+        return format_values([])
+    # A document is returned for each hour having data, even when no
+    # value falls within the period (its average is then zero).
+    cursor = await database["working_days_rollups"].aggregate(
+        area_pipeline(level, area, pollutant, n_days))
+    documents = await cursor.to_list()
+    if not(documents):
+        return None
+    return format_values(documents)
+
+async def get_profiles(station, pollutant, first_month):
+    '''
+    See function "get_profiles" of the "crud" module.
+    '''
+    cursor = database["profiles"].find(
+        profiles_filter(station, pollutant, first_month),
+        {"sum": 1, "count": 1})
+    return [profile_entry(document) async for document in cursor]
+
+async def acquire_lock(name, owner, ttl=UPDATE_LOCK_TTL):
+    '''
+    Try to take the lock "name" (shared by all the processes using the
+    database) on behalf of "owner" for "ttl" seconds, and return True
+    if it succeeded.
+    '''
+    now = datetime.now(timezone.utc)
+    try:
+        # The lock document can only be (re)written if it does not
+        # exist or if it has expired: otherwise the upsert fails on
+        # the unique "_id".
+        await database["locks"].update_one(
+            {"_id": name, "expiry": {"$lt": now}},
+            {"$set": {"owner": owner,
+                      "expiry": now+timedelta(seconds=ttl)}},
+            upsert=True)
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def renew_lock(name, owner, ttl=UPDATE_LOCK_TTL):
+    '''
+    Extend the lock "name" held by "owner" every third of "ttl"
+    seconds until cancelled.
+    '''
+    while True:
+        await asyncio.sleep(ttl/3)
+        await database["locks"].update_one(
+            {"_id": name, "owner": owner},
+            {"$set": {"expiry": datetime.now(timezone.utc)+timedelta(seconds=ttl)}})
+
+async def release_lock(name, owner):
+    '''
+    Release the lock "name" if it is still held by "owner".
+    '''
+    await database["locks"].delete_one({"_id": name, "owner": owner})
+
+async def update_database(owner):
+    '''
+    Run function "update_database" of the "crud" module in a separate
+    thread (the ingestion of new data is mostly made of downloads,
+    parsing and bulk writes, which gain nothing from the event loop),
+    unless another process is already doing it. Return True if the
+    database has been updated.
+
+    Arguments:
+    owner -- string identifying the calling process.
+    '''
+    if not(await acquire_lock("update", owner)):
+        return False
+    renewal = asyncio.create_task(renew_lock("update", owner))
+    try:
+        # Another process may have performed the update meanwhile.
+        if await history_is_updated(refresh=True):
+            return False
+        await asyncio.to_thread(crud.update_database)
+        await get_last_update(refresh=True)
+        return True
+    finally:
+        renewal.cancel()
+        await release_lock("update", owner)
@@ -0,0 +1,347 @@
+'''
+Ingest the pollution data of an arbitrary range of past days (possibly
+several years) into the "air_quality" database.
+
+The range is split by month, each month being downloaded and stored in
+its own staging collections by a pool of processes. The months are then
+merged with the data already stored, and the histories and rollups are
+rebuilt from the result (so that their cumulative sums and counts stay
+consistent whatever the order of the dates), as well as the profiles.
+They are built next to the ones being served, which they replace at the
+end, and the revision of the data is then incremented so that the API
+processes stop serving the results cached before (see method
+"storageBackend.revision").
+The days older than the retention window ("RETENTION_DAYS") would expire
+as soon as they are stored, so they are refused: the window
+(GARY_RETENTION_DAYS, of the API processes as well) must be widened
+first to keep a long baseline.
+The merge takes the lock of the updates, so that no update runs while
+the collections are being replaced.
+
+The "FR_E2" files already on disk (such as an annual archive, or the
+directories it extracts to) are ingested the same way with option
+"--archive", one file per process and by chunks of rows, so that large
+files fit in small containers (their records older than the retention
+window are left out).
+
+Usage: python -m gary.backfill START END [--workers N]
+(dates given as YYYY-MM-DD, both included)
+       python -m gary.backfill --archive PATH [PATH ...] [--workers N]
+'''
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+
+from .config import BACKFILL_WORKERS, RETENTION_DAYS
+from .bulk import BOOTSTRAP_WRITE_CONCERN
+from .crud import \
+database, history_pipeline, profiles_pipeline, store_file, store_rollups
+from .download import MISSING, fetch_daily_files
+from .indexes import ensure_indexes
+
+def months(start, end):
+    '''
+    Split the range of days from "start" to "end" (both included) into
+    the (year, month, first day, last day) tuples of each of its months.
+    '''
+    partitions = []
+    first = start
+    while first <= end:
+        following_month = date(
+            first.year+first.month//12, first.month%12+1, 1)
+        last = min(end, following_month-timedelta(days=1))
+        partitions.append((first.year, first.month, first, last))
+        first = following_month
+    return partitions
+
+def staging_name(year, month, day_type):
+    return "backfill_"+str(year)+"_"+str(month).zfill(2)+"_"+day_type
+
+def ingest_month(year, month, first, last):
+    '''
+    Download the daily files of the days from "first" to "last" and
+    store their records in the staging collections of the month (run
+    by the worker processes). Return the number of stored records, the
+    dates whose file could not be downloaded and those whose file is
+    missing for good (see "download.MISSING").
+    '''
+    for day_type in ["working_days","weekends"]:
+        database.drop_collection(staging_name(year, month, day_type))
+    dates = [first+timedelta(days=n) for n in range((last-first).days+1)]
+    n_records = 0
+    failed, missing = [], []
+    for DATE, path in fetch_daily_files(dates):
+        if path is None:
+            failed.append(DATE)
+        elif path is MISSING:
+            missing.append(DATE)
+        else:
+            # The staging collections are only read once all the months
+            # are stored, so the fastest write concern can be used.
+            n_records += store_file(
+                path,
+                BOOTSTRAP_WRITE_CONCERN,
+                prefix=staging_name(year, month, ""))
+    return n_records, failed, missing
+
+def ingest_file(path, prefix):
+    '''
+    Store the records of the "FR_E2" file at "path" (covering any number
+    of days) within the retention window in the staging collections
+    whose names start with "prefix" (run by the worker processes).
+    Return the number of stored records.
+    '''
+    for day_type in ["working_days","weekends"]:
+        database.drop_collection(prefix+day_type)
+    n_records = store_file(path, BOOTSTRAP_WRITE_CONCERN, prefix=prefix)
+    # The records leaving the retention window would expire as soon as
+    # merged.
+    DATE = date.today()-timedelta(days=RETENTION_DAYS)
+    for day_type in ["working_days","weekends"]:
+        n_records -= database[prefix+day_type].delete_many(
+            {"dateTime": {"$lt": datetime(DATE.year, DATE.month, DATE.day)}}
+        ).deleted_count
+    return n_records
+
+def raw_records_pipeline():
+    '''
+    Return the aggregation stages turning the histories of a collection
+    back into one record per (station, pollutant, date) value, shaped
+    like the records of the staging collections.
+    '''
+    return [
+        {"$project":
+            {"_id": 0,
+             "key": "$_id",
+             "pairs": {"$zip": {"inputs": ["$history.dates",
+                                           "$history.values"]}}}},
+        {"$unwind": "$pairs"},
+        {"$project":
+            {"code site": "$key.station",
+             "Polluant": "$key.pollutant",
+             "hour": "$key.hour",
+             "dateTime": {"$arrayElemAt": ["$pairs", 0]},
+             "valeur brute": {"$arrayElemAt": ["$pairs", 1]}}}]
+
+def merge_staging(prefixes):
+    '''
+    Merge the staging collections whose names start with the given
+    prefixes (those of the months, or of the files, ingested) with the
+    data already stored, and rebuild the histories, the rollups, the
+    profiles and the "distribution_pollutants" collection.
+
+    The rebuilt collections are first written under the names prefixed
+    by "rebuilt_", while the API keeps serving the former ones, which
+    are only replaced at the end (each one in a single step by "$out",
+    which keeps its indexes).
+    '''
+    fields = ["code site","Polluant","hour","dateTime","valeur brute"]
+    rebuilt = [
+        "working_days", "weekends",
+        "working_days_rollups", "weekends_rollups",
+        "profiles"]
+    # Drop the collections left by an interrupted backfill.
+    for name in rebuilt:
+        database.drop_collection("rebuilt_"+name)
+    for day_type in ["working_days","weekends"]:
+        names = [prefix+day_type for prefix in prefixes]
+        # Gather all the records, keeping a single value per station,
+        # pollutant and hour in case some days were already stored.
+        database[day_type].aggregate(raw_records_pipeline()+[
+            {"$unionWith":
+                {"coll": name,
+                 "pipeline": [{"$project": {e: 1 for e in fields}}]}}
+            for name in names]+[
+            {"$group":
+                {"_id": {"station": "$code site",
+                         "pollutant": "$Polluant",
+                         "hour": "$hour",
+                         "dateTime": "$dateTime"},
+                 "value": {"$first": "$valeur brute"}}},
+            {"$project":
+                {"_id": 0,
+                 "code site": "$_id.station",
+                 "Polluant": "$_id.pollutant",
+                 "hour": "$_id.hour",
+                 "dateTime": "$_id.dateTime",
+                 "valeur brute": "$value"}},
+            {"$out": "backfill_"+day_type}])
+        for name in names:
+            database.drop_collection(name)
+        # Add the stations (or pollutants) which did not provide any
+        # data before.
+        database["backfill_"+day_type].aggregate([
+            {"$group":
+                {"_id": "$code site",
+                 "monitored_pollutants": {"$addToSet": "$Polluant"}}},
+            {"$merge":
+                {"into": "distribution_pollutants",
+                 "whenMatched": [
+                    {"$set":
+                        {"monitored_pollutants":
+                            {"$setUnion": ["$monitored_pollutants",
+                                           "$$new.monitored_pollutants"]}}}],
+                 "whenNotMatched": "insert"}}])
+        # Rebuild the rollups, the profiles and the histories.
+        store_rollups(
+            "backfill_"+day_type, into="rebuilt_"+day_type+"_rollups")
+        database["backfill_"+day_type].aggregate(
+            profiles_pipeline(into="rebuilt_profiles"))
+        database["backfill_"+day_type].aggregate(
+            history_pipeline()+[{"$out": "rebuilt_"+day_type}])
+        database.drop_collection("backfill_"+day_type)
+    for name in rebuilt:
+        database["rebuilt_"+name].aggregate([{"$out": name}])
+        database.drop_collection("rebuilt_"+name)
+    ensure_indexes(database)
+    database["last_update"].update_one({}, {"$inc": {"revision": 1}})
+
+async def locked_merge(prefixes):
+    '''
+    Run function "merge_staging" while holding the lock of the updates
+    (see function "async_crud.update_database"), waiting for the update
+    in progress to end if there is one.
+    '''
+    from .async_crud import acquire_lock, release_lock, renew_lock
+    from .scheduler import OWNER
+    while not(await acquire_lock("update", OWNER)):
+        print("Waiting for the update in progress...")
+        await asyncio.sleep(10)
+    renewal = asyncio.create_task(renew_lock("update", OWNER))
+    try:
+        await asyncio.to_thread(merge_staging, prefixes)
+    finally:
+        renewal.cancel()
+        await release_lock("update", OWNER)
+
+def backfill(start, end, workers=BACKFILL_WORKERS):
+    '''
+    Ingest the pollution data of the days from "start" to "end" (both
+    included), "workers" months at a time, reporting the progress.
+    '''
+    partitions = months(start, end)
+    started = time.perf_counter()
+    n_records = 0
+    failed, missing = [], []
+    # Worker processes are spawned rather than forked, since MongoDB
+    # clients must not be shared across a fork.
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {
+            executor.submit(ingest_month, *partition): partition
+            for partition in partitions}
+        for i, future in enumerate(as_completed(futures), start=1):
+            year, month, _, _ = futures[future]
+            n, month_failed, month_missing = future.result()
+            n_records += n
+            failed += month_failed
+            missing += month_missing
+            print("["+str(i)+"/"+str(len(partitions))+"] "+
+                  str(year)+"-"+str(month).zfill(2)+" ingested: "+
+                  format(n_records, ",")+" records in "+
+                  format(time.perf_counter()-started, ".0f")+" s"+
+                  "".join(
+                    ", "+str(len(dates))+" days "+label
+                    for dates, label in [
+                        (month_failed, "not downloaded"),
+                        (month_missing, "missing at the source")]
+                    if dates))
+    # The days which could not be downloaded are left out: the backfill
+    # of their range can be run again later.
+    for dates, label in [
+        (failed, "Not downloaded (to backfill again): "),
+        (missing, "Missing at the source: ")]:
+        if dates:
+            print(label+", ".join(DATE.isoformat() for DATE in sorted(dates)))
+    print("Merging "+str(len(partitions))+" months...")
+    asyncio.run(locked_merge([
+        staging_name(year, month, "") for year, month, _, _ in partitions]))
+    print("Done in "+format(time.perf_counter()-started, ".0f")+" s")
+
+def backfill_archive(paths, workers=BACKFILL_WORKERS):
+    '''
+    Ingest the pollution data of the "FR_E2" files at "paths", "workers"
+    files at a time, reporting the progress.
+    '''
+    prefixes = ["backfill_file_"+str(i)+"_" for i in range(len(paths))]
+    started = time.perf_counter()
+    n_records = 0
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {
+            executor.submit(ingest_file, path, prefix): path
+            for path, prefix in zip(paths, prefixes)}
+        for i, future in enumerate(as_completed(futures), start=1):
+            n_records += future.result()
+            print("["+str(i)+"/"+str(len(paths))+"] "+
+                  futures[future]+" ingested: "+
+                  format(n_records, ",")+" records in "+
+                  format(time.perf_counter()-started, ".0f")+" s")
+    print("Merging "+str(len(paths))+" files...")
+    asyncio.run(locked_merge(prefixes))
+    print("Done in "+format(time.perf_counter()-started, ".0f")+" s")
+
+def archive_files(paths):
+    '''
+    Return the paths of the "csv" files given by "paths" (files, or
+    directories whose "csv" files are taken in name order).
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.lower().endswith(".csv"))
+        else:
+            files.append(path)
+    return files
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ingest the pollution data of a range of past days "
+                    "(or of files on disk).")
+    parser.add_argument("start", type=date.fromisoformat, nargs="?")
+    parser.add_argument("end", type=date.fromisoformat, nargs="?")
+    parser.add_argument(
+        "--archive",
+        nargs="+",
+        metavar="PATH",
+        help="\"FR_E2\" files (or directories of them) to ingest "
+             "instead of downloading a range of days")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=BACKFILL_WORKERS,
+        help="number of months (or files) ingested in parallel")
+    arguments = parser.parse_args()
+    if arguments.archive:
+        if arguments.start is not None:
+            parser.error("a range of days cannot be given with --archive")
+        paths = archive_files(arguments.archive)
+        if not(paths):
+            parser.error("no \"csv\" file in "+" ".join(arguments.archive))
+        for path in paths:
+            if not(os.path.isfile(path)):
+                parser.error("no such file: "+path)
+        backfill_archive(paths, arguments.workers)
+        return
+    if arguments.end is None:
+        parser.error("the start and the end of the range are required")
+    oldest_date = date.today()-timedelta(days=RETENTION_DAYS)
+    if arguments.start < oldest_date:
+        parser.error(
+            "days before "+oldest_date.isoformat()+" are outside of the "
+            "retention window ("+str(RETENTION_DAYS)+" days) and would be "
+            "removed as soon as stored: set GARY_RETENTION_DAYS first")
+    if arguments.end < arguments.start:
+        parser.error("the end of the range precedes its start")
+    backfill(arguments.start, arguments.end, arguments.workers)
+
+if __name__=="__main__":
+    main()
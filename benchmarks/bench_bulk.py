@@ -0,0 +1,80 @@
+'''
+Compare the throughput (documents per second) of the former loading of
+the daily records (conversion of the whole dataframe into dictionaries
+and ordered "insert_many") with the batched, unordered loading of the
+"bulk" module, with the default and the initial-load write concerns.
+
+The cost of the encoding of the documents by the client, which needs no
+server, is measured first. The records are then written to a dedicated
+database of the MongoDB server given by GARY_MONGO_URI (this part is
+skipped when no server answers).
+
+Usage: python -m gary.benchmarks.bench_bulk [n_stations] [n_days]
+'''
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+# Never touch the database of the application.
+os.environ.setdefault("GARY_DATABASE_NAME", "air_quality_benchmark")
+
+from bson import encode
+from pymongo.errors import ServerSelectionTimeoutError
+
+from ..bulk import BOOTSTRAP_WRITE_CONCERN, encode_records, load
+from ..crud import database
+from ..parsing import prepare_data, read_daily_file
+from .synthetic import e2_file
+
+def legacy_load(collection, data):
+    collection.insert_many(data.to_dict("records"))
+    return len(data)
+
+def legacy_encode(data):
+    # Encoding performed by "insert_many" on the dictionaries.
+    return [encode(document) for document in data.to_dict("records")]
+
+def bulk_encode(data):
+    return list(encode_records(data))
+
+def main():
+    n_stations = int(sys.argv[1]) if len(sys.argv) > 1 else 700
+    n_days = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+    frames = [
+        prepare_data(read_daily_file(
+            e2_file(date.today()-timedelta(days=n), n_stations=n_stations)))
+        for n in range(n_days, 0, -1)]
+    n_documents = sum(len(data) for data in frames)
+    for label, function in [
+        ("encoding, to_dict (before)", legacy_encode),
+        ("encoding, bulk", bulk_encode)]:
+        start = time.perf_counter()
+        for data in frames:
+            function(data)
+        duration = time.perf_counter()-start
+        print(label.ljust(30)+format(n_documents/duration, ",.0f")+
+              " documents/s")
+    try:
+        database.command("ping")
+    except ServerSelectionTimeoutError:
+        print("No MongoDB server answering: inserts not measured.")
+        return
+    scenarios = [
+        ("to_dict + ordered (before)", legacy_load),
+        ("bulk, default concern", load),
+        ("bulk, initial-load concern",
+         lambda collection, data: load(
+             collection, data, BOOTSTRAP_WRITE_CONCERN))]
+    for label, function in scenarios:
+        database.drop_collection("bulk_benchmark")
+        start = time.perf_counter()
+        n_documents = sum(
+            function(database["bulk_benchmark"], data) for data in frames)
+        duration = time.perf_counter()-start
+        print(label.ljust(30)+format(n_documents/duration, ",.0f")+
+              " documents/s")
+    database.drop_collection("bulk_benchmark")
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,143 @@
+'''
+Measure the peak memory (resident set size) of the ingestion of "FR_E2"
+files of increasing size, each measurement running in a new interpreter:
+    - "whole file" and "chunks": the file is read from disk at once, or
+      by chunks (see function "read_chunks" of the "parsing" module),
+      then goes through the filter, transform and BSON encoding stages
+      (the documents are encoded as for the database, but not sent),
+    - "download": the same by chunks, the file being first downloaded
+      from a local HTTP server into the mirror (see function
+      "download.fetch"), as by the updates,
+    - "archive": the file is stored in staging collections as by
+      "python -m gary.backfill --archive" (see function
+      "backfill.ingest_file"), in a dedicated database of the MongoDB
+      server given by GARY_MONGO_URI (skipped when no server answers).
+
+Usage: python -m gary.benchmarks.bench_memory [n_stations]
+'''
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import date, timedelta
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# Never touch the database of the application.
+os.environ.setdefault("GARY_DATABASE_NAME", "air_quality_benchmark")
+
+from ..bulk import batches, encode_records
+from ..config import CHUNK_ROWS, MONGO_URI
+from ..parsing import prepare_data, read_chunks
+from .synthetic import e2_file
+
+def write_file(path, n_days, n_stations):
+    '''
+    Write a synthetic file covering the "n_days" last days to "path".
+    '''
+    with open(path, "wb") as f:
+        for n in range(n_days):
+            content = e2_file(
+                date.today()-timedelta(days=n_days-n), n_stations)
+            # Keep the header of the first day only.
+            f.write(content if not(n) else content[content.find(b"\n")+1:])
+
+def ingest(path, chunksize):
+    '''
+    Run the ingestion stages on the file at "path" and return the
+    number of encoded documents.
+    '''
+    n_documents = 0
+    for data in read_chunks(path, chunksize=chunksize):
+        for batch in batches(encode_records(prepare_data(data))):
+            n_documents += len(batch)
+    return n_documents
+
+def run_child(mode, source):
+    '''
+    Ingest "source" (path or url of the file) as described by "mode"
+    (see the module documentation).
+    '''
+    if mode == "whole file":
+        ingest(source, 0)
+    elif mode == "chunks":
+        ingest(source, CHUNK_ROWS)
+    elif mode == "download":
+        from ..download import fetch
+        ingest(fetch(source, retries=0), CHUNK_ROWS)
+    else:
+        from ..backfill import ingest_file
+        from ..crud import database
+        ingest_file(source, "bench_memory_")
+        for day_type in ["working_days","weekends"]:
+            database.drop_collection("bench_memory_"+day_type)
+
+def server_answers():
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+class quietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        run_child(sys.argv[2], sys.argv[3])
+        # Peak resident set size, in kilobytes on Linux.
+        print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        return
+    n_stations = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    modes = ["whole file", "chunks", "download"]
+    if server_answers():
+        modes.append("archive")
+    else:
+        print("No MongoDB server answering: archive ingestion not measured.")
+    print("Peak RSS (MB), chunks of "+str(CHUNK_ROWS)+" rows")
+    print("days".ljust(6)+"size (MB)".rjust(11)+
+          "".join(mode.rjust(13) for mode in modes))
+    with tempfile.TemporaryDirectory() as directory:
+        server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), partial(quietHandler, directory=directory))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            for n_days in [1, 4, 16, 32]:
+                name = "FR_E2_"+str(n_days)+".csv"
+                path = os.path.join(directory, name)
+                write_file(path, n_days, n_stations)
+                sources = {
+                    "download":
+                        "http://127.0.0.1:"+str(server.server_address[1])+
+                        "/"+name}
+                peaks = [
+                    int(subprocess.run(
+                        [sys.executable, "-m", __spec__.name,
+                         "--child", mode, sources.get(mode, path)],
+                        # A new mirror for each download.
+                        env=dict(os.environ,
+                                 GARY_OFFLINE="0",
+                                 GARY_MIRROR_DIR=tempfile.mkdtemp(
+                                    dir=directory)),
+                        capture_output=True,
+                        text=True,
+                        check=True).stdout)/1024
+                    for mode in modes]
+                print(str(n_days).ljust(6)+
+                      format(os.path.getsize(path)/1e6, ".0f").rjust(11)+
+                      "".join(format(peak, ".0f").rjust(13) for peak in peaks))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__=="__main__":
+    main()
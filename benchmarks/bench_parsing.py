@@ -0,0 +1,74 @@
+'''
+Compare the throughput (rows per second) of the former row-wise
+transformation of the daily "FR_E2" files with the columnar one of
+the "parsing" module.
+
+Usage: python -m gary.benchmarks.bench_parsing [n_stations] [repeat]
+'''
+import importlib.util
+import sys
+import time
+from datetime import date, datetime
+from io import BytesIO
+
+from pandas import read_csv
+
+from ..parsing import prepare_data, read_daily_file
+from .synthetic import e2_file
+
+def legacy_transform(content):
+    '''
+    Row-wise transformation performed by "store_pollution_data"
+    before the columnar parsing pipeline was introduced.
+    '''
+    data = read_csv(BytesIO(content), sep=";")
+    data = data[data["validité"]==1]
+    data = data[data["valeur brute"]>0]
+    data["pollutant_to_ignore"] = data["Polluant"].apply(
+        lambda x: x in ["NO","NOX as NO2","C6H6"])
+    data = data[data["pollutant_to_ignore"]==False]
+    data["dateTime"] = data["Date de début"].apply(
+        lambda x: datetime.strptime(x,"%Y/%m/%d %H:%M:%S"))
+    data["hour"] = data["dateTime"].apply(lambda x: x.hour)
+    data["working_days"] = data["dateTime"].apply(lambda x: x.weekday() < 5)
+    return data[
+        ["code site",
+        "Polluant",
+        "hour",
+        "valeur brute",
+        "dateTime",
+        "working_days"]]
+
+def columnar_transform(content, engine="c"):
+    return prepare_data(read_daily_file(content, engine=engine))
+
+def measure(function, content, repeat):
+    '''
+    Return the best of "repeat" durations of "function(content)".
+    '''
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(content)
+        durations.append(time.perf_counter()-start)
+    return min(durations)
+
+def main():
+    n_stations = int(sys.argv[1]) if len(sys.argv) > 1 else 700
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    content = e2_file(date(2023, 1, 2), n_stations=n_stations)
+    n_rows = content.count(b"\n")-1
+    candidates = [
+        ("row-wise (before)", legacy_transform),
+        ("columnar, c engine", columnar_transform)]
+    if importlib.util.find_spec("pyarrow") is not None:
+        candidates.append((
+            "columnar, pyarrow engine",
+            lambda content: columnar_transform(content, engine="pyarrow")))
+    print(str(n_rows)+" rows")
+    for label, function in candidates:
+        duration = measure(function, content, repeat)
+        print(label.ljust(28)+format(n_rows/duration, ",.0f")+" rows/s")
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,44 @@
+'''
+Measure the time taken by the API to start (that is, to import the
+"main" module), reusing the existing database ("warm" start) and
+rebuilding it from scratch ("cold" start, skipped unless "--cold" is
+given since it downloads the source files).
+
+A MongoDB server must be running (see GARY_MONGO_URI).
+
+Usage: python -m gary.benchmarks.bench_startup [--cold] [repeat]
+'''
+import os
+import subprocess
+import sys
+import time
+
+def measure(package, rebuild):
+    '''
+    Return the duration (in seconds) of the import of the "main"
+    module of "package" in a new interpreter.
+    '''
+    environment = dict(os.environ, GARY_REBUILD="1" if rebuild else "0")
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", "import "+package+".main"],
+        env=environment,
+        check=True)
+    return time.perf_counter()-start
+
+def main():
+    arguments = [e for e in sys.argv[1:] if e != "--cold"]
+    repeat = int(arguments[0]) if arguments else 3
+    package = __package__.rsplit(".", 1)[0]
+    scenarios = [("warm", False)]
+    if "--cold" in sys.argv:
+        # The cold start comes first so that the warm ones find a
+        # database built with the current layout.
+        scenarios.insert(0, ("cold", True))
+    for label, rebuild in scenarios:
+        durations = [measure(package, rebuild) for _ in range(repeat)]
+        print(label.ljust(6)+format(min(durations), ".2f")+" s (best of "+
+              str(repeat)+")")
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,315 @@
+'''
+Run the timed scenarios of the application against synthetic sources
+(see module "source") and the selected storage (a local MongoDB server
+or a SQLite file, see module "storage"), and write the results to a JSON
+file so that they can be compared across commits and storages:
+    - "create_database", building the storage from the first days,
+    - "update_database", adding the days published afterwards,
+    - "get_values", for short and long periods,
+    - "get_quantiles", giving the medians from the merged sketches,
+    - "get_profiles", giving the profiles by day of the week, month and
+      season (whose averages of working days and week-end days must be
+      those of "get_values" over the same days),
+    - the "/" endpoint, on cold and cached queries,
+    - the "/plot" endpoint, rendering the charts then serving them from
+      the cache of images,
+    - the same queries answered by the NumPy engine (see module "cube"),
+      for single pairs, batches and all the stations at once.
+The averages returned are checked against those calculated directly
+from the synthetic files, so that every storage is validated by the
+same scenarios.
+
+The storage (GARY_DATABASE_NAME, "air_quality_benchmark" by default, or
+a temporary SQLite file) is rebuilt by each run, and the files are
+downloaded into a temporary mirror so that every run starts from the
+same state.
+
+Usage: python -m gary.benchmarks.run_suite [--storage mongodb|sqlite]
+       [--stations N] [--pollutants P] [--days D] [--update-days K]
+       [--queries Q] [--port PORT] [--output FILE] [--compare FILE]
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from pandas import concat
+
+from .source import sourceServer
+
+def summary(durations):
+    '''
+    Return the statistics (in milliseconds) of the given durations
+    (in seconds).
+    '''
+    durations = sorted(1000*e for e in durations)
+    return {
+        "n": len(durations),
+        "mean_ms": statistics.fmean(durations),
+        "p50_ms": statistics.median(durations),
+        "p95_ms": durations[int(0.95*(len(durations)-1))],
+        "max_ms": durations[-1]}
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter()-start
+
+def commit():
+    '''
+    Return the hash of the commit being benchmarked (None outside of
+    a git repository).
+    '''
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def endpoint_latencies(app, queries, path="/"):
+    '''
+    Return the durations (in seconds) of the requests sent to the "/"
+    endpoint (or to "path") for each (station, pollutant, n_days) query.
+    '''
+    import httpx
+    durations = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for station, pollutant, n_days in queries:
+            start = time.perf_counter()
+            response = await client.get(
+                path, params={"s": station, "p": pollutant, "n": n_days})
+            durations.append(time.perf_counter()-start)
+            response.raise_for_status()
+    return durations
+
+def synthetic_records(server, n_days):
+    '''
+    Return the records of the synthetic files of the "n_days" last days
+    (but the missing ones), as prepared for the storage.
+    '''
+    from ..parsing import prepare_data, read_daily_file
+    from .synthetic import e2_file
+    dates = [date.today()-timedelta(days=n) for n in range(n_days, 0, -1)]
+    return concat([
+        prepare_data(read_daily_file(e2_file(
+            DATE,
+            n_stations=server.n_stations,
+            pollutants=server.pollutants)))
+        for DATE in dates if DATE not in server.missing_days])
+
+def expected_values(server, pairs, n_days, q=None):
+    '''
+    Return the averages of "get_values" (or the exact "q" quantiles) for
+    the given (station, pollutant) pairs, calculated with pandas from
+    the synthetic files.
+    '''
+    groups = synthetic_records(server, n_days).groupby(
+        ["code site","Polluant","working_days","hour"])["valeur brute"]
+    averages = groups.mean() if q is None else \
+    groups.quantile(q, interpolation="lower")
+    return {
+        pair: tuple(
+            [float(averages.get((*pair, working_days, hour), 0))
+             for hour in range(24)]
+            for working_days in [True, False])
+        for pair in pairs}
+
+def run(args, server):
+    '''
+    Run the scenarios and return their results.
+    '''
+    # The settings are read when the modules of the application are
+    # imported, so the environment must be complete beforehand.
+    from .. import metrics
+    from ..parsing import IGNORED_POLLUTANTS
+    from ..storage import get_backend
+    from .synthetic import station_codes
+    storage = get_backend()
+    results = {}
+    # Build the storage while the last "update_days" days are not yet
+    # published, as if it had been built that many days ago.
+    server.last_day = date.today()-timedelta(days=args.update_days+1)
+    results["create_database"] = {"seconds": timed(storage.create)}
+    storage.set_last_update(datetime(
+        server.last_day.year, server.last_day.month, server.last_day.day))
+    server.last_day = date.today()
+    results["update_database"] = {"seconds": timed(storage.update)}
+    results["rows"] = {
+        "ingested": metrics.rows_ingested.samples()[0][2],
+        **{"rejected_"+labels[0][1]: value
+           for _, labels, value in metrics.rows_rejected.samples()}}
+
+    rng = random.Random(0)
+    pollutants = [e for e in server.pollutants if e not in IGNORED_POLLUTANTS]
+    pairs = [
+        (rng.choice(station_codes(args.stations)), rng.choice(pollutants))
+        for _ in range(args.queries)]
+    for n_days in sorted({7, args.days}):
+        results["get_values_"+str(n_days)+"d"] = summary([
+            timed(storage.get_values, station, pollutant, n_days)
+            for station, pollutant in pairs])
+
+    # Check the averages of a few pairs over the whole period.
+    expected = expected_values(server, pairs[:20], args.days)
+    error = max(
+        abs(a-b)
+        for pair, values in expected.items()
+        for row, expected_row in zip(
+            storage.get_values(*pair, args.days), values)
+        for a, b in zip(row, expected_row))
+    results["validation"] = {"max_error": error}
+    if error > 1e-6:
+        raise AssertionError("Wrong averages (error: "+str(error)+")")
+
+    # Medians merged from the daily sketches, given within the relative
+    # accuracy of the sketches.
+    from ..sketch import ACCURACY
+    results["get_quantiles_"+str(args.days)+"d"] = summary([
+        timed(storage.get_quantiles, station, pollutant, args.days, 0.5)
+        for station, pollutant in pairs])
+    error = max(
+        abs(a-b)/b if b else abs(a)
+        for pair, values in expected_values(
+            server, pairs[:20], args.days, q=0.5).items()
+        for row, expected_row in zip(
+            storage.get_quantiles(*pair, args.days, 0.5), values)
+        for a, b in zip(row, expected_row))
+    results["quantile_validation"] = {"max_relative_error": error}
+    if error > ACCURACY*(1+1e-9):
+        raise AssertionError("Wrong medians (error: "+str(error)+")")
+
+    # Profiles of all the stored months, which hold the same days as the
+    # period of "args.days" days.
+    from ..storage import format_profiles
+    first_month = date.today()-timedelta(days=args.days)
+    results["get_profiles"] = summary([
+        timed(storage.get_profiles, station, pollutant, first_month)
+        for station, pollutant in pairs])
+    profiles = {
+        pair: format_profiles(storage.get_profiles(*pair, first_month))
+        for pair in pairs[:20]}
+    error = max(
+        abs(a-b)
+        for pair, profile in profiles.items()
+        for row, expected_row in zip(
+            [profile["working_days"], profile["weekends"]],
+            storage.get_values(*pair, args.days))
+        for a, b in zip(row, expected_row))
+    results["profiles_validation"] = {"max_error": error}
+    if error > 1e-6:
+        raise AssertionError("Wrong profiles (error: "+str(error)+")")
+
+    # Same queries answered by the NumPy engine.
+    from .. import cube
+    directory = os.path.join(os.environ["GARY_MIRROR_DIR"], "..", "cube")
+    results["cube_refresh"] = {
+        "seconds": timed(cube.refresh, storage, directory)}
+    engine = cube.cubeEngine(directory)
+    for n_days in sorted({7, args.days}):
+        results["cube_get_values_"+str(n_days)+"d"] = summary([
+            timed(engine.get_values, station, pollutant, n_days)
+            for station, pollutant in pairs])
+    results["cube_batch_"+str(len(pairs))+"_pairs"] = summary([
+        timed(engine.get_batch_values, pairs, [], args.days)
+        for _ in range(20)])
+    results["storage_batch_"+str(len(pairs))+"_pairs"] = summary([
+        timed(storage.get_batch_values, pairs, [], args.days)
+        for _ in range(20)])
+    results["cube_all_stations"] = summary([
+        timed(engine.get_all_values, pollutant, args.days)
+        for pollutant in pollutants])
+    # The values are stored as float32 by the engine.
+    error = max(
+        abs(a-b)/max(1, abs(b))
+        for pair, values in expected.items()
+        for row, expected_row in zip(
+            engine.get_values(*pair, args.days), values)
+        for a, b in zip(row, expected_row))
+    results["cube_validation"] = {"max_relative_error": error}
+    if error > 1e-5:
+        raise AssertionError("Wrong averages of the engine (error: "+str(error)+")")
+
+    from .. import main
+    queries = [(station, pollutant, args.days) for station, pollutant in pairs]
+    # Distinct queries first (computed by the database), then the same
+    # ones again (served by the cache).
+    queries = list(dict.fromkeys(queries))
+    results["endpoint_cold"] = summary(
+        asyncio.run(endpoint_latencies(main.app, queries)))
+    results["endpoint_cached"] = summary(
+        asyncio.run(endpoint_latencies(main.app, queries)))
+    # The first chart also starts the rendering processes.
+    results["plot_cold"] = summary(
+        asyncio.run(endpoint_latencies(main.app, queries[:10], "/plot")))
+    results["plot_cached"] = summary(
+        asyncio.run(endpoint_latencies(main.app, queries[:10], "/plot")))
+    main.plots.shutdown()
+    return results
+
+def compare(results, former):
+    '''
+    Print the ratio of each result to the same result of a former run.
+    '''
+    for name, values in results.items():
+        for key, value in values.items():
+            try:
+                ratio = value/former["results"][name][key]
+            except (KeyError, TypeError, ZeroDivisionError):
+                continue
+            print((name+" "+key).ljust(36)+format(ratio, ".2f").rjust(8))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--storage", choices=["mongodb","sqlite"], default="mongodb")
+    parser.add_argument("--stations", type=int, default=100)
+    parser.add_argument("--pollutants", type=int, default=9)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--update-days", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+
+    server = sourceServer(args.stations, args.pollutants, args.port).start()
+    os.environ.update(server.environment())
+    # Never touch the database of the application.
+    os.environ.setdefault("GARY_DATABASE_NAME", "air_quality_benchmark")
+    os.environ["GARY_INITIAL_DAYS"] = str(args.days)
+    os.environ["GARY_RETENTION_DAYS"] = str(max(args.days, 180))
+    os.environ["GARY_OFFLINE"] = "0"
+    os.environ["GARY_STORAGE"] = args.storage
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            os.environ["GARY_MIRROR_DIR"] = os.path.join(directory, "mirror")
+            os.environ.setdefault(
+                "GARY_SQLITE_PATH", os.path.join(directory, "air_quality.db"))
+            results = run(args, server)
+    finally:
+        server.stop()
+
+    report = {
+        "commit": commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "parameters": vars(args),
+        "results": results}
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,102 @@
+'''
+Local stand-in for the LCSQA sources (data.gouv.fr for the daily "FR_E2"
+files, lcsqa.org for the list of stations), serving the synthetic files
+of module "synthetic" over HTTP.
+
+The application is pointed at it with GARY_E2_BASE_URL and
+GARY_STATIONS_URL (see function "environment"), and a different day
+than today can be made the last one published to simulate the days
+missing before an update.
+
+Usage: python -m gary.benchmarks.source [n_stations] [n_pollutants] [port]
+'''
+import re
+import sys
+import threading
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .synthetic import POLLUTANTS, e2_file, stations_file
+
+class sourceServer(ThreadingHTTPServer):
+    '''
+    HTTP server generating the synthetic files of "n_stations" stations
+    and "n_pollutants" pollutants (files of the days after "last_day"
+    are reported as missing, as those of the future days and those of
+    the days of "missing_days", and the files of the days of
+    "incomplete_days" only hold the first half of their rows, as when
+    published before the end of the day).
+    '''
+    daemon_threads = True
+
+    def __init__(self, n_stations=100, n_pollutants=len(POLLUTANTS), port=8765):
+        super().__init__(("127.0.0.1", port), sourceHandler)
+        self.n_stations = n_stations
+        self.pollutants = POLLUTANTS[:n_pollutants]
+        self.last_day = date.today()
+        self.missing_days = set()
+        self.incomplete_days = set()
+        self.stations = stations_file(n_stations)
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:"+str(self.server_address[1])+"/"
+
+    def environment(self):
+        '''
+        Return the environment variables pointing the application at
+        the server.
+        '''
+        return {
+            "GARY_E2_BASE_URL": self.url+"e2/",
+            "GARY_STATIONS_URL": self.url+"stations.xlsx"}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class sourceHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        match = re.fullmatch(
+            r"/e2/[0-9]{4}/FR_E2_([0-9]{4}-[0-9]{2}-[0-9]{2})\.csv", self.path)
+        if self.path == "/stations.xlsx":
+            content = server.stations
+        elif match and date.fromisoformat(match.group(1)) <= server.last_day \
+        and date.fromisoformat(match.group(1)) not in server.missing_days:
+            content = e2_file(
+                date.fromisoformat(match.group(1)),
+                n_stations=server.n_stations,
+                pollutants=server.pollutants)
+            if date.fromisoformat(match.group(1)) in server.incomplete_days:
+                lines = content.splitlines(keepends=True)
+                content = b"".join(lines[:1+(len(lines)-1)//2])
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    n_stations = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    n_pollutants = int(sys.argv[2]) if len(sys.argv) > 2 else len(POLLUTANTS)
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 8765
+    server = sourceServer(n_stations, n_pollutants, port)
+    for name, value in server.environment().items():
+        print(name+"="+value)
+    server.serve_forever()
+
+if __name__=="__main__":
+    main()
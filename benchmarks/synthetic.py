@@ -0,0 +1,143 @@
+import random
+from datetime import datetime, timedelta
+from io import BytesIO
+
+from pandas import DataFrame, ExcelWriter
+
+from ..constants import CODES
+
+# Columns of the daily "FR_E2" files published by the LCSQA.
+E2_COLUMNS = [
+    "Date de début",
+    "Date de fin",
+    "Organisme",
+    "code zas",
+    "Zas",
+    "code site",
+    "nom site",
+    "type d'implantation",
+    "Polluant",
+    "type d'influence",
+    "discriminant",
+    "Réglementaire",
+    "type d'évaluation",
+    "procédure de mesure",
+    "type de valeur",
+    "valeur",
+    "valeur brute",
+    "unité de mesure",
+    "taux de saisie",
+    "couverture temporelle",
+    "couverture de données",
+    "code qualité",
+    "validité"]
+
+POLLUTANTS = ["O3","NO2","SO2","PM2.5","PM10","CO","NO","NOX as NO2","C6H6"]
+
+def station_codes(n_stations):
+    '''
+    Return "n_stations" station codes shaped like the LCSQA ones.
+    '''
+    return ["FR"+str(10000+i).zfill(5) for i in range(n_stations)]
+
+def e2_file(
+    DATE,
+    n_stations=100,
+    pollutants=POLLUTANTS,
+    invalid_rate=0.05,
+    negative_rate=0.01,
+    seed=None):
+    '''
+    Return the content (bytes) of a synthetic "FR_E2" file giving hourly
+    concentrations recorded on "DATE" by "n_stations" stations for each
+    of the given pollutants.
+
+    Arguments:
+    invalid_rate -- proportion of rows flagged as not validated.
+    negative_rate -- proportion of rows with a negative concentration.
+    seed -- seed of the random generator (defaults to the date, so that
+            the same file is produced for the same day).
+    '''
+    rng = random.Random(DATE.toordinal() if seed is None else seed)
+    lines = [";".join(E2_COLUMNS)]
+    start = datetime(DATE.year, DATE.month, DATE.day)
+    for code in station_codes(n_stations):
+        for pollutant in pollutants:
+            for hour in range(24):
+                begin = start + timedelta(hours=hour)
+                value = rng.lognormvariate(3, 0.6)
+                if rng.random() < negative_rate:
+                    value = -value
+                validity = -1 if rng.random() < invalid_rate else 1
+                lines.append(";".join([
+                    begin.strftime("%Y/%m/%d %H:%M:%S"),
+                    (begin+timedelta(hours=1)).strftime("%Y/%m/%d %H:%M:%S"),
+                    "ATMO",
+                    "FR84ZAG01",
+                    "ZAG LYON",
+                    code,
+                    "Station "+code,
+                    "Urbaine",
+                    pollutant,
+                    "Fond",
+                    "A",
+                    "Oui",
+                    "mesures fixes",
+                    "Mesure automatique",
+                    "moyenne horaire",
+                    format(value, ".1f"),
+                    format(value, ".3f"),
+                    "µg-m3",
+                    "100",
+                    "100",
+                    "100",
+                    "A",
+                    str(validity)]))
+    return ("\n".join(lines)+"\n").encode()
+
+# Labels of the columns of the spreadsheet giving the location of the
+# LCSQA stations (see function "crud.store_locations").
+STATION_LABELS = [
+    "Région",
+    "Code commune",
+    "Commune",
+    "Organisme",
+    "Code zas",
+    "Zas",
+    "Date de mise en service",
+    "Nom station",
+    "Code station",
+    "type d'implantation",
+    "type d'influence"]
+
+def stations_file(n_stations=100):
+    '''
+    Return the content (bytes) of a synthetic "xlsx" file shaped like
+    the LCSQA list of stations, locating the stations of "station_codes"
+    in cities spread over the French departments.
+    '''
+    rows = [["Colonne "+str(i) for i in range(len(STATION_LABELS))],
+            ["Liste des points de mesure"]+[""]*(len(STATION_LABELS)-1),
+            STATION_LABELS]
+    for i, code in enumerate(station_codes(n_stations)):
+        department = CODES[i % len(CODES)]
+        city = department+str(i//len(CODES) % 5).zfill(5-len(department))
+        rows.append([
+            "Région "+str(CODES.index(department)//8),
+            city,
+            "Commune "+city,
+            "ATMO",
+            "FR84ZAG01",
+            "ZAG LYON",
+            "2000-01-01",
+            "Station "+code,
+            code,
+            "Urbaine",
+            "Fond"])
+    content = BytesIO()
+    with ExcelWriter(content, engine="openpyxl") as writer:
+        DataFrame([["Notice"]]).to_excel(
+            writer, sheet_name="Notice", header=False, index=False)
+        DataFrame(rows).to_excel(
+            writer, sheet_name="Stations", header=False, index=False)
+    return content.getvalue()
@@ -0,0 +1,61 @@
+from bson import encode
+from bson.raw_bson import RawBSONDocument
+from pymongo import WriteConcern
+
+from .config import BOOTSTRAP_J, BOOTSTRAP_W, BULK_BATCH_BYTES
+
+# Loading of the records of the daily files into the staging collections:
+# the rows of a dataframe are encoded to BSON one at a time (instead of
+# turning the whole dataframe into a list of dictionaries) and sent in
+# unordered batches of bounded size, so that the server can write them
+# in parallel and a single invalid document does not stop the others
+# (see "benchmarks/bench_bulk.py").
+
+BOOTSTRAP_WRITE_CONCERN = WriteConcern(
+    w=int(BOOTSTRAP_W) if BOOTSTRAP_W.isdigit() else BOOTSTRAP_W,
+    j=BOOTSTRAP_J)
+
+def encode_records(data):
+    '''
+    Yield the rows of the "data" dataframe as encoded BSON documents.
+    '''
+    columns = list(data.columns)
+    # Converting each column to a list gives values of Python types,
+    # which can be encoded (unlike those of numpy).
+    for row in zip(*(data[column].tolist() for column in columns)):
+        yield RawBSONDocument(encode(dict(zip(columns, row))))
+
+def batches(documents, max_bytes=BULK_BATCH_BYTES):
+    '''
+    Group the encoded "documents" into lists whose total size does not
+    exceed "max_bytes" (except for a single document larger than that).
+    '''
+    batch, size = [], 0
+    for document in documents:
+        n_bytes = len(document.raw)
+        if batch and size+n_bytes > max_bytes:
+            yield batch
+            batch, size = [], 0
+        batch.append(document)
+        size += n_bytes
+    if batch:
+        yield batch
+
+def load(collection, data, write_concern=None, max_bytes=BULK_BATCH_BYTES):
+    '''
+    Insert the rows of the "data" dataframe into "collection" and
+    return the number of inserted documents.
+
+    Arguments:
+    collection -- pymongo collection.
+    write_concern -- "WriteConcern" of the inserts (that of the collection
+                     by default).
+    max_bytes -- approximate size of each batch of documents.
+    '''
+    if write_concern is not None:
+        collection = collection.with_options(write_concern=write_concern)
+    n_documents = 0
+    for batch in batches(encode_records(data), max_bytes):
+        collection.insert_many(batch, ordered=False)
+        n_documents += len(batch)
+    return n_documents
@@ -0,0 +1,68 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+class resultCache():
+    '''
+    Bounded cache of the results of asynchronous computations, evicting
+    the least recently used entries and ignoring those older than "ttl"
+    seconds. Identical computations requested while one of them is in
+    progress wait for its result instead of running again.
+    '''
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expiry time, result)
+        self.in_flight = {} # key -> task computing the result
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key, compute):
+        '''
+        Return the result associated with "key", calling the coroutine
+        function "compute" to obtain it if it is not cached (exceptions
+        raised by "compute" are not cached).
+        '''
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+        # Wait for the identical computation in progress, if any.
+        if key in self.in_flight:
+            self.coalesced += 1
+            return await asyncio.shield(self.in_flight[key])
+        self.misses += 1
+        task = asyncio.ensure_future(compute())
+        self.in_flight[key] = task
+        try:
+            # Shielding the task lets the other waiters get the result
+            # even if the request which started it is cancelled.
+            result = await asyncio.shield(task)
+        finally:
+            if self.in_flight.get(key) is task:
+                del self.in_flight[key]
+        self.entries[key] = (time.monotonic()+self.ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        '''
+        Remove all the cached results.
+        '''
+        self.entries.clear()
+
+    def stats(self):
+        '''
+        Return the counters of the cache.
+        '''
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced}
@@ -0,0 +1,118 @@
+import os
+
+# Every setting can be overridden with an environment variable of the
+# same name prefixed with "GARY_" (for instance "GARY_MAX_DOWNLOADS=16").
+
+# Storage of the pollution data: "mongodb" (the server below) or "sqlite"
+# (embedded database file at "SQLITE_PATH", for single-node deployments
+# without any MongoDB server).
+STORAGE = os.environ.get("GARY_STORAGE", "mongodb")
+SQLITE_PATH = os.path.expanduser(
+    os.environ.get("GARY_SQLITE_PATH", "~/.local/share/gary/air_quality.db"))
+
+# Address of the MongoDB server hosting the "air_quality" database, and
+# name of that database (a different one can be used by benchmarks).
+MONGO_URI = os.environ.get("GARY_MONGO_URI", "mongodb://localhost:27017")
+DATABASE_NAME = os.environ.get("GARY_DATABASE_NAME", "air_quality")
+# Bounds of the pool of connections opened by the API process.
+MONGO_MAX_POOL_SIZE = int(os.environ.get("GARY_MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("GARY_MONGO_MIN_POOL_SIZE", 0))
+
+# When set, the database is rebuilt from scratch at startup even if an
+# existing one could be reused.
+REBUILD = os.environ.get("GARY_REBUILD", "0") == "1"
+
+# Approximate size (in bytes) of the batches of documents sent to the
+# database when loading the records of the daily files.
+BULK_BATCH_BYTES = int(os.environ.get("GARY_BULK_BATCH_BYTES", 8*1024*1024))
+# Write concern of these loads when the database is built from scratch
+# (number of acknowledging members, or "majority", and whether the write
+# must be journaled): the default favours speed, since a failed build is
+# simply started over.
+BOOTSTRAP_W = os.environ.get("GARY_BOOTSTRAP_W", "1")
+BOOTSTRAP_J = os.environ.get("GARY_BOOTSTRAP_J", "0") == "1"
+
+# Number of days of pollution data kept in the database (older data
+# expire automatically, see function "crud.expiry_date"), and number of
+# days loaded when the database is built from scratch (the following
+# updates only add the new days).
+RETENTION_DAYS = int(os.environ.get("GARY_RETENTION_DAYS", 180))
+INITIAL_DAYS = int(os.environ.get("GARY_INITIAL_DAYS", 7))
+
+# Number of processes ingesting the months of a backfill in parallel.
+BACKFILL_WORKERS = int(os.environ.get("GARY_BACKFILL_WORKERS", os.cpu_count() or 1))
+
+# Time (in seconds) between two checks of the background task adding
+# the latest pollution data to the database.
+UPDATE_INTERVAL = float(os.environ.get("GARY_UPDATE_INTERVAL", 900))
+# Time (in seconds) after which the lock of an update is considered as
+# abandoned (it is renewed while the update is running).
+UPDATE_LOCK_TTL = float(os.environ.get("GARY_UPDATE_LOCK_TTL", 300))
+
+# Root of the directory tree where the LCSQA publishes one "FR_E2" csv
+# file per day (can be pointed at a local server serving synthetic files).
+E2_BASE_URL = os.environ.get(
+    "GARY_E2_BASE_URL",
+    "https://files.data.gouv.fr/lcsqa/concentrations-de"+\
+    "-polluants-atmospheriques-reglementes/temps-reel/")
+
+# Maximum number of daily files downloaded at the same time.
+MAX_DOWNLOADS = int(os.environ.get("GARY_MAX_DOWNLOADS", 8))
+# Number of new attempts made when the download of a file fails, and
+# delay (in seconds) before the first of them (doubled at each attempt).
+DOWNLOAD_RETRIES = int(os.environ.get("GARY_DOWNLOAD_RETRIES", 3))
+DOWNLOAD_BACKOFF = float(os.environ.get("GARY_DOWNLOAD_BACKOFF", 1))
+# Time (in seconds) after which an unanswered download is abandoned.
+DOWNLOAD_TIMEOUT = float(os.environ.get("GARY_DOWNLOAD_TIMEOUT", 30))
+# Number of days after which the file of a day is considered final (its
+# mirrored copy then being used without revalidation): the real-time
+# file of yesterday may still be completed after midnight.
+FINAL_AFTER_DAYS = int(os.environ.get("GARY_FINAL_AFTER_DAYS", 2))
+# Address of the spreadsheet giving the location of the LCSQA stations.
+STATIONS_URL = os.environ.get(
+    "GARY_STATIONS_URL",
+    "https://www.lcsqa.org/system/files/media/documents/"+\
+    "Liste%20points%20de%20mesures%202021%20pour%20site%20"+\
+    "LCSQA_27072022.xlsx")
+
+# Directory of the local mirror keeping a copy of every downloaded file.
+MIRROR_DIR = os.path.expanduser(
+    os.environ.get("GARY_MIRROR_DIR", "~/.cache/gary"))
+# When offline mode is on, no request is sent over the network: files
+# are read from "OFFLINE_DIR" (by name) or, failing that, from the mirror.
+OFFLINE = os.environ.get("GARY_OFFLINE", "0") == "1"
+OFFLINE_DIR = os.path.expanduser(
+    os.environ.get("GARY_OFFLINE_DIR", MIRROR_DIR))
+
+# Parser used to read the daily "csv" files ("c" or "pyarrow", the
+# latter requiring the optional "pyarrow" package). The pyarrow parser
+# cannot read by chunks: it is only used when "CHUNK_ROWS" is 0 (the
+# "c" parser being used otherwise, with a warning at startup).
+CSV_ENGINE = os.environ.get("GARY_CSV_ENGINE", "c")
+# Number of rows of the "csv" files processed at a time (0 to process
+# each file at once), bounding the memory used by ingestion whatever
+# the size of the files.
+CHUNK_ROWS = int(os.environ.get("GARY_CHUNK_ROWS", 100000))
+
+# Maximum number of results kept by the cache of the "/" endpoint, and
+# time (in seconds) during which a cached result can be served.
+CACHE_SIZE = int(os.environ.get("GARY_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.environ.get("GARY_CACHE_TTL", 24*3600))
+# Maximum number of (station, pollutant) pairs and stations given to the
+# "/batch" endpoint.
+MAX_BATCH_SIZE = int(os.environ.get("GARY_MAX_BATCH_SIZE", 1000))
+# Time (in seconds) during which the date of the last update is read
+# from memory instead of the database.
+LAST_UPDATE_TTL = float(os.environ.get("GARY_LAST_UPDATE_TTL", 60))
+# Number of processes rendering the charts of the "/plot" endpoint, and
+# maximum number of rendered images kept in memory.
+PLOT_WORKERS = int(os.environ.get("GARY_PLOT_WORKERS", 2))
+PLOT_CACHE_SIZE = int(os.environ.get("GARY_PLOT_CACHE_SIZE", 500))
+
+# Engine answering the requests of the "/" and "/batch" endpoints: the
+# storage itself ("storage"), or a memory-mapped NumPy array of all the
+# values of the retention window ("numpy", see module "cube") kept in
+# directory "CUBE_DIR".
+QUERY_ENGINE = os.environ.get("GARY_QUERY_ENGINE", "storage")
+CUBE_DIR = os.path.expanduser(
+    os.environ.get("GARY_CUBE_DIR", "~/.local/share/gary/cube"))
@@ -108,6 +108,19 @@ CODES = ["0"+str(x) for x in range(1,10)]+[str(x) for x in range(10,20)]+\
 
 FRENCH_DEPARTMENTS = {
     code: name for code, name in zip(
-        codes,
+        CODES,
         map(lambda name: "".join(map(lambda x: x.capitalize(), list(name))),
-            names))}
+            NAMES))}
+
+# Names of the pollutants displayed on the charts, along with the daily
+# average concentration recommended by the WHO (same values as those of
+# the "run_shell" client).
+POLLUTANT_NAMES = {
+    "O3": "ozone",
+    "NO2": "nitrogen dioxide",
+    "SO2": "sulphur dioxide",
+    "PM2.5": "fine particles",
+    "PM10": "particles",
+    "CO": "carbone monoxide"}
+
+WHO_RECOMMENDATION = dict(zip(POLLUTANT_NAMES, [100,25,40,15,45,4]))
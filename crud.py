@@ -1,36 +1,40 @@
+import itertools
+import threading
 import time
-from datetime import date, datetime, timedelta
-from statistics import mean
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
 
-from bson.code import Code
-from pandas import DataFrame, read_csv, read_excel
+from pandas import DataFrame
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 
-from .constants import FRENCH_DEPARTMENTS
-
-mongoClient = MongoClient() #"mongodb://db:27017"
-database = mongoClient["air_quality"]
-
-stringToDatetime = lambda x: datetime.strptime(x,"%Y/%m/%d %H:%M:%S")
-
-updateList = Code('''
-function (history, data_180_days_ago, data_yesterday){
-  if (!data_180_days_ago && !data_yesterday){
-    return history;
-  } else if (data_180_days_ago && !data_yesterday){
-    return history.slice(1);
-  } else {
-    const new_date = data_yesterday.date
-    const new_value = data_yesterday.value
-    history.dates.push(new_date);
-    history.values.push(new_value);
-    if (data_180_days_ago){
-      history = history.slice(1)
-    }
-    return history;
-  }
-}
-''')
+from . import metrics
+from .bulk import BOOTSTRAP_WRITE_CONCERN, load
+from .config import \
+CHUNK_ROWS, DATABASE_NAME, INITIAL_DAYS, MONGO_URI, REBUILD, RETENTION_DAYS, \
+STATIONS_URL, UPDATE_LOCK_TTL
+from .download import MISSING, fetch, fetch_daily_files
+from .indexes import ensure_indexes
+from .parsing import prepare_data, read_chunks, read_locations
+from .scheduler import OWNER
+from .sketch import LN_GAMMA, format_quantiles
+from .storage import \
+first_stored_date, format_batch, format_values, last_stored_date
+
+mongoClient = MongoClient(MONGO_URI) #"mongodb://db:27017"
+database = mongoClient[DATABASE_NAME]
+
+# Version of the layout of the collections built by "create_database"
+# (to be incremented whenever it changes, so that the databases built
+# by former versions get rebuilt at startup).
+SCHEMA_VERSION = 6
+
+# Levels of the geographic hierarchy over which the pollution data are
+# aggregated, along with the field of "LCSQA_stations" naming the areas.
+AREA_LEVELS = {
+    "city": "Commune",
+    "department": "Département",
+    "region": "Région"}
 
 def store_locations():
     '''
@@ -38,99 +42,377 @@ def store_locations():
     regarding location in France of all the stations owned by the
     Central Laboratory of Air Quality Monitoring (LCSQA).
     '''
-    url = "https://www.lcsqa.org/system/files/media/documents/"+\
-    "Liste points de mesures 2021 pour site LCSQA_27072022.xlsx"
-    # Import file from previous url giving location of LCSQA stations.
-    data = read_excel(url.replace(" ", "%20"), sheet_name=1)
-    # Rearrange and clean the data.
-    c = data.columns.tolist()
-    columns_to_remove = c[3:7]+c[10:]
-    labels = data.iloc[1].tolist()
-    labels_to_keep = labels[:3]+labels[7:10]
-    data = data.drop(
-        columns=columns_to_remove
-    ).drop(
-        [0,1]
-    ).set_axis(
-        labels_to_keep,
-        axis="columns")
-    # Define a function "get_department" to retrieve names of French
-    # departments using postal codes of french cities.
-    get_department = lambda x: (
-        FRENCH_DEPARTMENTS[x[:2]] if not(x[1].isdigit()) or int(x[:2]) < 97
-        else FRENCH_DEPARTMENTS[x[:3]]
-    )
-    # Add a new column "Département" using "get_department".
-    data["Département"] = data["Code commune"].apply(
-        get_department)
-    # Keep only columns with useful informations.
-    data = data[
-        ["Région",
-        "Département",
-        "Commune",
-        "Nom station",
-        "Code station"]]
+    data = read_locations(fetch(STATIONS_URL))
     # Turn the "data" dataframe into the "LCSQA_stations" collection.
     database["LCSQA_stations"].insert_many(data.to_dict("records"))
 
+def store_file(source, write_concern=None, prefix="new_"):
+    '''
+    Add the pollution data of a "FR_E2" file to the "new_working_days"
+    and "new_weekends" staging collections, one chunk of rows at a time
+    (see function "read_chunks"), and return the number of stored
+    records.
+
+    Arguments:
+    source -- bytes of the "csv" file, or path of the file.
+    write_concern -- "WriteConcern" of the inserts.
+    prefix -- prefix of the names of the staging collections.
+    '''
+    n_records = 0
+    for data in metrics.timed(read_chunks(source), "parse"):
+        with metrics.stage("filter"):
+            data = prepare_data(data)
+        # Separate the data recorded on working days from those
+        # recorded on weekends and update the appropriate collection.
+        for name, mask in [
+            (prefix+"working_days", data["working_days"]),
+            (prefix+"weekends", ~data["working_days"])]:
+            if mask.any():
+                with metrics.stage("insert"):
+                    n = load(database[name], data[mask], write_concern)
+                metrics.rows_ingested.inc(n)
+                n_records += n
+    return n_records
 
 def store_pollution_data(n_days, update=False):
     '''
-    Create two collections storing hourly average concentrations of 
-    air pollutants recorded on working days and weekends.
+    Fill the "new_working_days" and "new_weekends" staging collections
+    with the hourly average concentrations of air pollutants recorded
+    on working days and weekends, and return the dates whose data could
+    not be stored.
+
+    The days are stored in date order up to the first one whose file
+    could not be downloaded: the following days are left to the next
+    update, which tries that day again (so that no day is skipped). The
+    days whose file is missing for good (see "download.MISSING") are
+    skipped instead.
 
     Arguments:
     n_days -- number of last pollution days whose data are collected.
-    update -- boolean used to determine the names of the collections
-              storing the pollution data.
-    '''
-
-    DATE = date.today() - timedelta(days=n_days)
-    # Iterate over each day until the current day.
-    while DATE < date.today():
-        url = "https://files.data.gouv.fr/lcsqa/concentrations-de"+\
-        "-polluants-atmospheriques-reglementes/temps-reel/"+\
-        str(DATE.year)+"/FR_E2_"+DATE.isoformat()+".csv"
-        data = read_csv(url, sep=";")
-        # Test whether "csv" file provide some pollution data
-        # (Server errors may occur, making data unavailable).
-        if "validité" in data.columns:
-            # Extract rows with validated data.
-            data = data[data["validité"]==1]
-            # Extract rows with consistent concentration value
-            # (bugs during the recording process may generate 
-            # negative values.)
-            data = data[data["valeur brute"]>0]
-            # Extract rows with pollutants of interest.
-            data["pollutant_to_ignore"] = data["Polluant"].apply(
-                lambda x: x in ["NO","NOX as NO2","C6H6"])
-            data = data[data["pollutant_to_ignore"]==False]
-            data["dateTime"] = data["Date de début"].apply(
-                lambda x: stringToDatetime(x))
-            data["hour"] = data["Date de début"].apply(
-                lambda x: x.hour)
-            data["working_days"] = data["dateTime"].apply(
-                lambda x: x.weekday())
-            data = data[
-                ["code site",
-                "Polluant",
-                "hour"
-                "valeur brute",
-                "dateTime",
-                "working_days"]]
-            # Separate the data recorded on working days from
-            # those recorded on weekends.
-            working_days = data[data["working_days"]]
-            weekends = data[data["working_days"]==False]
-            names = ("working_days","weekends") if not(update) \
-            else ("new_working_days","new_weekends")
-            # Update the appropriate collection.
-            database[names[0]].insert_many(
-                working_days.to_dict("records"))
-            database[names[1]].insert_many(
-                weekends.to_dict("records"))
-        # Move on to the following day.
-        DATE += timedelta(days=1)
+    update -- boolean telling whether the data are added to an existing
+              database (otherwise the faster write concern of the initial
+              load is used).
+    '''
+    write_concern = None if update else BOOTSTRAP_WRITE_CONCERN
+    dates = [
+        date.today() - timedelta(days=n) for n in range(n_days, 0, -1)]
+    # Iterate over each day until the current day (the files are
+    # downloaded concurrently but handed over in date order).
+    for DATE, path in fetch_daily_files(dates):
+        if path is None:
+            return dates[dates.index(DATE):]
+        if path is MISSING:
+            continue
+        store_file(path, write_concern)
+    return []
+
+def bucket(date):
+    '''
+    Return the aggregation expression giving the first day of the month
+    of "date", which identifies the document holding the values of that
+    month in the histories (split into one document per month, so that
+    old data can be removed a whole document at a time).
+    '''
+    return {"$dateTrunc": {"date": date, "unit": "month"}}
+
+def expiry_date(bucket):
+    '''
+    Return the aggregation expression giving the date after which the
+    document of the month starting on "bucket" only holds data older
+    than "RETENTION_DAYS" days, and is removed by the database server
+    (see the "expiry" index of module "indexes").
+    '''
+    return {"$dateAdd":
+        {"startDate": {"$dateAdd": {"startDate": bucket,
+                                    "unit": "month",
+                                    "amount": 1}},
+         "unit": "day",
+         "amount": RETENTION_DAYS}}
+
+def history_pipeline():
+    '''
+    Return the aggregation stages grouping the records of a collection
+    filled by "store_pollution_data" into one document per (station,
+    pollutant, hour) triple and month.
+
+    Along with the values and their dates, the history of each document
+    holds their cumulative sums and counts (from the beginning of the
+    month), so that the sum over any trailing period is obtained with a
+    single subtraction per month (see function "window_totals"), and
+    the bins of their quantile sketches (see module "sketch").
+    '''
+    return [
+        {"$setWindowFields":
+            {"partitionBy": {"station": "$code site",
+                             "pollutant": "$Polluant",
+                             "hour": "$hour",
+                             "bucket": bucket("$dateTime")},
+             "sortBy": {"dateTime": 1},
+             "output":
+                {"sum": {"$sum": "$valeur brute",
+                         "window": {"documents": ["unbounded","current"]}},
+                 "count": {"$count": {},
+                           "window": {"documents": ["unbounded","current"]}}}}},
+        {"$sort": {"dateTime": 1}},
+        {"$group":
+            {"_id": {"station": "$code site",
+                     "pollutant": "$Polluant",
+                     "hour": "$hour",
+                     "bucket": bucket("$dateTime")},
+             "values": {"$push": "$valeur brute"},
+             "dates": {"$push": "$dateTime"},
+             "bins": {"$push":
+                {"$ceil": {"$divide": [{"$ln": "$valeur brute"}, LN_GAMMA]}}},
+             "sums": {"$push": "$sum"},
+             "counts": {"$push": "$count"}}},
+        {"$project":
+            {"expiry": expiry_date("$_id.bucket"),
+             "history": {"values": "$values",
+                         "dates": "$dates",
+                         "bins": "$bins",
+                         "sums": "$sums",
+                         "counts": "$counts"}}}]
+
+def rollup_pipeline(level):
+    '''
+    Return the aggregation stages grouping the records of a collection
+    filled by "store_pollution_data" into one document per (area,
+    pollutant, hour) triple and month, the areas being those of "level"
+    (see "AREA_LEVELS").
+
+    The history of each triple has the same layout as those of the
+    stations (without the bins), except that its values are the daily
+    sums of the values of all the stations of the area, the number of
+    which is given by the "weights" array (the cumulative counts being
+    the cumulative sums of the weights).
+    '''
+    return [
+        {"$lookup":
+            {"from": "LCSQA_stations",
+             "localField": "code site",
+             "foreignField": "Code station",
+             "as": "location"}},
+        {"$unwind": "$location"},
+        {"$group":
+            {"_id": {"area": "$location."+AREA_LEVELS[level],
+                     "pollutant": "$Polluant",
+                     "hour": "$hour",
+                     "dateTime": "$dateTime"},
+             "value": {"$sum": "$valeur brute"},
+             "weight": {"$sum": 1}}},
+        {"$setWindowFields":
+            {"partitionBy": {"area": "$_id.area",
+                             "pollutant": "$_id.pollutant",
+                             "hour": "$_id.hour",
+                             "bucket": bucket("$_id.dateTime")},
+             "sortBy": {"_id.dateTime": 1},
+             "output":
+                {"sum": {"$sum": "$value",
+                         "window": {"documents": ["unbounded","current"]}},
+                 "count": {"$sum": "$weight",
+                           "window": {"documents": ["unbounded","current"]}}}}},
+        {"$sort": {"_id.dateTime": 1}},
+        {"$group":
+            {"_id": {"level": {"$literal": level},
+                     "area": "$_id.area",
+                     "pollutant": "$_id.pollutant",
+                     "hour": "$_id.hour",
+                     "bucket": bucket("$_id.dateTime")},
+             "values": {"$push": "$value"},
+             "weights": {"$push": "$weight"},
+             "dates": {"$push": "$_id.dateTime"},
+             "sums": {"$push": "$sum"},
+             "counts": {"$push": "$count"}}},
+        {"$project":
+            {"expiry": expiry_date("$_id.bucket"),
+             "history": {"values": "$values",
+                         "weights": "$weights",
+                         "dates": "$dates",
+                         "sums": "$sums",
+                         "counts": "$counts"}}}]
+
+def merge_stage(into, keys=["dates","values","bins"]):
+    '''
+    Return the "$merge" stage appending the histories produced by
+    "history_pipeline" (or "rollup_pipeline") to those of the same
+    triples and months in collection "into" (the other documents are
+    left untouched, those of new triples or months are inserted).
+
+    Only the new values recorded after the last date of the existing
+    history are appended, so that merging the same data again (when an
+    update failed partway and is run again) leaves the history as it is.
+
+    Arguments:
+    into -- name of the collection to update.
+    keys -- arrays of the histories simply concatenated (the cumulative
+            sums and counts of the new data being shifted by the last
+            ones of the existing history).
+    '''
+    new = lambda key: "$$new.history."+key
+    # Positions of the new values recorded after the last stored date
+    # (the end of the new history, whose dates are sorted).
+    kept = {"$filter":
+        {"input": {"$range": [0, {"$size": new("dates")}]},
+         "as": "i",
+         "cond": {"$gt": [{"$arrayElemAt": [new("dates"), "$$i"]},
+                          {"$last": "$history.dates"}]}}}
+    # Position of the first of them.
+    first = {"$subtract": [{"$size": new("dates")}, {"$size": "$kept"}]}
+    appended = lambda key: {"$map":
+        {"input": "$kept",
+         "as": "i",
+         "in": {"$arrayElemAt": [new(key), "$$i"]}}}
+    # The cumulative sums (and counts) of the kept values restart from
+    # the last ones of the existing history.
+    shifted = lambda key: {"$map":
+        {"input": appended(key),
+         "in": {"$add": [
+            {"$subtract": ["$$this",
+                           {"$cond": [{"$gt": [first, 0]},
+                                      {"$arrayElemAt": [new(key),
+                                                        {"$subtract": [first, 1]}]},
+                                      0]}]},
+            {"$ifNull": [{"$last": "$history."+key}, 0]}]}}}
+    concatenated = {
+        "history."+key: {"$concatArrays": ["$history."+key, appended(key)]}
+        for key in keys}
+    concatenated.update({
+        "history."+key: {"$concatArrays": ["$history."+key, shifted(key)]}
+        for key in ["sums","counts"]})
+    return {"$merge":
+        {"into": into,
+         "whenMatched": [
+            {"$set": {"kept": kept}},
+            {"$set": concatenated},
+            {"$unset": "kept"}],
+         "whenNotMatched": "insert"}}
+
+def recent_filter(since):
+    '''
+    Return the filter of the documents of the histories (or profiles)
+    of the months which may hold values recorded since "since" (a
+    datetime), using their expiry date (see function "expiry_date").
+    '''
+    first = datetime(since.year, since.month, 1)
+    following_month = datetime(
+        first.year+first.month//12, first.month%12+1, 1)
+    return {"expiry":
+        {"$gte": following_month+timedelta(days=RETENTION_DAYS)}}
+
+def truncate_histories(name, keys, since):
+    '''
+    Remove the values recorded since "since" (a datetime) from the
+    histories of collection "name", so that they can be merged again
+    (see function "update_database"), along with the documents left
+    without any value.
+
+    Arguments:
+    keys -- arrays of the histories (all sorted by date, the cumulative
+            sums and counts of the values kept being left unchanged).
+    '''
+    recent = recent_filter(since)
+    database[name].delete_many(
+        {**recent, "history.dates": {"$not": {"$elemMatch": {"$lt": since}}}})
+    kept = {"$size": {"$filter":
+        {"input": "$history.dates",
+         "cond": {"$lt": ["$$this", since]}}}}
+    database[name].update_many(
+        {**recent, "history.dates": {"$gte": since}},
+        [{"$set": {"kept": kept}},
+         {"$set": {
+            "history."+key: {"$slice": ["$history."+key, "$kept"]}
+            for key in keys+["sums","counts"]}},
+         {"$unset": "kept"}])
+
+def truncate_profiles(since):
+    '''
+    Remove the values recorded since "since" (a datetime) from the
+    "profiles" collection, like function "truncate_histories" (the
+    dates of the profiles being in no particular order).
+    '''
+    recent = recent_filter(since)
+    database["profiles"].delete_many(
+        {**recent, "dates": {"$not": {"$elemMatch": {"$lt": since}}}})
+    # Positions of the values recorded before "since".
+    kept = {"$filter":
+        {"input": {"$range": [0, {"$size": "$dates"}]},
+         "as": "i",
+         "cond": {"$lt": [{"$arrayElemAt": ["$dates", "$$i"]}, since]}}}
+    kept_values = lambda key: {"$map":
+        {"input": "$kept",
+         "as": "i",
+         "in": {"$arrayElemAt": ["$"+key, "$$i"]}}}
+    database["profiles"].update_many(
+        {**recent, "dates": {"$gte": since}},
+        [{"$set": {"kept": kept}},
+         {"$set":
+            {"dates": kept_values("dates"),
+             "values": kept_values("values")}},
+         {"$set":
+            {"sum": {"$sum": "$values"},
+             "count": {"$size": "$values"}}},
+         {"$unset": "kept"}])
+
+def store_rollups(name, into=None):
+    '''
+    Aggregate the records of collection "name" (filled by
+    "store_pollution_data") by city, department and region and add
+    them to the corresponding "rollups" collection (or to "into").
+    '''
+    into = into or name.replace("new_", "")+"_rollups"
+    for level in AREA_LEVELS:
+        database[name].aggregate(rollup_pipeline(level)+[
+            merge_stage(into, ["dates","values","weights"])])
+
+def profiles_pipeline(into="profiles"):
+    '''
+    Return the aggregation stages adding the records of a collection
+    filled by "store_pollution_data" to the "profiles" collection (or to
+    "into"), which
+    holds the sum and the number of the values of each (station,
+    pollutant, month, day of the week, hour) combination (the days of
+    the week being numbered from 0, for monday, to 6), along with their
+    dates and values (at most five of them).
+
+    The sums and counts are incremented by the records of the dates not
+    merged yet, so that the profiles are maintained without reading the
+    former values again, and merging the same data again (when an update
+    failed partway and is run again) leaves them as they are.
+    '''
+    # Positions of the new values whose dates are not merged yet.
+    kept = {"$filter":
+        {"input": {"$range": [0, {"$size": "$$new.dates"}]},
+         "as": "i",
+         "cond": {"$not": [{"$in": [{"$arrayElemAt": ["$$new.dates", "$$i"]},
+                                    "$dates"]}]}}}
+    appended = lambda key: {"$map":
+        {"input": "$kept",
+         "as": "i",
+         "in": {"$arrayElemAt": ["$$new."+key, "$$i"]}}}
+    return [
+        {"$group":
+            {"_id": {"station": "$code site",
+                     "pollutant": "$Polluant",
+                     "bucket": bucket("$dateTime"),
+                     "weekday": {"$subtract": [{"$isoDayOfWeek": "$dateTime"}, 1]},
+                     "hour": "$hour"},
+             "dates": {"$push": "$dateTime"},
+             "values": {"$push": "$valeur brute"}}},
+        {"$set":
+            {"sum": {"$sum": "$values"},
+             "count": {"$size": "$values"},
+             "expiry": expiry_date("$_id.bucket")}},
+        {"$merge":
+            {"into": into,
+             "whenMatched": [
+                {"$set": {"kept": kept}},
+                {"$set":
+                    {"dates": {"$concatArrays": ["$dates", appended("dates")]},
+                     "values": {"$concatArrays": ["$values", appended("values")]},
+                     "sum": {"$add": ["$sum", {"$sum": appended("values")}]},
+                     "count": {"$add": ["$count", {"$size": "$kept"}]}}},
+                {"$unset": "kept"}],
+             "whenNotMatched": "insert"}}]
 
 def create_database():
     '''
@@ -139,12 +421,24 @@ def create_database():
         - "cities", grouping air quality monitoring stations by cities.
         - "departments", grouping cities by French department.
         - "regions", grouping French departments by French region.
-        - "LCSQA_data", containing air pollution data collected over 
-           the last 180 days.
+        - "LCSQA_stations", giving the location of each station.
+        - "working_days" and "weekends", containing air pollution
+          data collected over the last "RETENTION_DAYS" days (starting
+          with the last "INITIAL_DAYS" days).
+        - "working_days_rollups" and "weekends_rollups", containing
+          the same data aggregated by city, department and region.
+        - "profiles", giving the sums and counts of the same data by
+          month, day of the week and hour (see "profiles_pipeline").
+        - "metadata", giving the version of the layout of the database.
     '''
-    if "air_quality" in mongoClient.list_database_names():
-        mongoClient.drop_database("air_quality")
-    database = mongoClient["air_quality"]
+    start = time.perf_counter()
+    # Drop the former collections (the metadata first, so that the
+    # database is no longer considered as ready), but the locks held by
+    # the processes sharing the database (this one among them).
+    for name in sorted(
+        database.list_collection_names(), key=lambda name: name != "metadata"):
+        if name != "locks":
+            database.drop_collection(name)
     # Create the "LCSQA_stations" collection.
     store_locations()
     # Create the "cities" collection using "LCSQA_stations".
@@ -168,107 +462,234 @@ def create_database():
             {"_id": "$Région",
              "departments": {"$push": "$Département"}}},
         {"$out": "regions"}])
-    # Remove the "LCSQA_stations" intermediate collection.
-    database.drop_collection("LCSQA_stations")
-    
-    # Create the "working_days" and "weekends" collections.
-    store_pollution_data(7)
-    # Create the "distribution_pollutants" collection giving, for
-    # each station, the pollutant(s) whose air concentration is 
-    # being recorded.
-    database["working_days"].aggregate([
-        {"$group":
-            {"_id": "$code site",
-             "monitored_pollutants":
-                {"$push": "$Polluant"}}},
-        {"$out": "distribution_pollutants"}])
-    # Group the pollution data to allow fast calculation of the 
-    # wanted averages (see function "get_values") and fast updates 
-    # of the database (see function "update_database").
-    for name in ["working_days","weekends"]:
-        database[name].aggregate([
+    # The "LCSQA_stations" collection is kept as the catalogue of the
+    # existing stations (see function "get_station_codes").
+    # Fill the staging collections with the pollution data.
+    missing = store_pollution_data(INITIAL_DAYS)
+    with metrics.stage("aggregate"):
+        # Create the "distribution_pollutants" collection giving, for
+        # each station, the pollutant(s) whose air concentration is 
+        # being recorded.
+        database["new_working_days"].aggregate([
+            {"$unionWith": "new_weekends"},
             {"$group":
-                {"_id": {"station": "$code site",
-                         "pollutant": "$Polluant",
-                         "hour": "$hour"},
-                 "values": {"$push": "$valeur brute"},
-                 "dates": {"$push": "$dateTime"}}},
-            {"$project":
-                {"history": {"values": "$values",
-                             "dates": "$dates"}}},
-            {"$out": name}])
-    # Save the current date in a new collection "last_update" 
-    # (necessary to know how many pollution days are missing
-    # when performing the next update).
-    DATE = date.today()
-    database["last_update"].insert_one(
-        {"date": datetime(
-            DATE.year, DATE.month, DATE.day)-timedelta(days=1)})
+                {"_id": "$code site",
+                 "monitored_pollutants":
+                    {"$addToSet": "$Polluant"}}},
+            {"$out": "distribution_pollutants"}])
+        # Group the pollution data to allow fast calculation of the 
+        # wanted averages (see function "get_values") and fast updates 
+        # of the database (see function "update_database"), creating the
+        # "working_days" and "weekends" collections, along with their
+        # aggregation by city, department and region (creating the
+        # "working_days_rollups" and "weekends_rollups" collections).
+        for name in ["working_days","weekends"]:
+            store_rollups("new_"+name)
+            database["new_"+name].aggregate(profiles_pipeline())
+            database["new_"+name].aggregate(history_pipeline()+[{"$out": name}])
+    for name in ["working_days","weekends"]:
+        database.drop_collection("new_"+name)
+    # Save the date of the last stored day in a new collection
+    # "last_update" (necessary to know how many pollution days are
+    # missing when performing the next update).
+    database["last_update"].insert_one({"date": last_stored_date(missing)})
+    # Create the indexes needed by the queries of the application.
+    ensure_indexes(database)
+    # Record the layout version last, so that a database whose creation
+    # was interrupted is never considered as ready.
+    database["metadata"].replace_one(
+        {"_id": "schema"},
+        {"_id": "schema",
+         "version": SCHEMA_VERSION,
+         "retention_days": RETENTION_DAYS},
+        upsert=True)
+    metrics.ingestion_seconds.observe(
+        time.perf_counter()-start, operation="create")
+
+def apply_retention():
+    '''
+    Recompute the expiry dates of the histories after a change of
+    "RETENTION_DAYS" (the data already removed by a former, shorter
+    retention window are not restored).
+    '''
+    for collection in [
+        "working_days", "weekends",
+        "working_days_rollups", "weekends_rollups",
+        "profiles"]:
+        database[collection].update_many(
+            {}, [{"$set": {"expiry": expiry_date("$_id.bucket")}}])
+    database["metadata"].update_one(
+        {"_id": "schema"}, {"$set": {"retention_days": RETENTION_DAYS}})
+
+def database_is_ready():
+    '''
+    Test whether the "air_quality" database has been completely built
+    with the current layout (and can therefore be reused as it is).
+    '''
+    metadata = database["metadata"].find_one({"_id": "schema"})
+    return metadata is not None and metadata["version"] == SCHEMA_VERSION
+
+def acquire_lock(name, owner, ttl=UPDATE_LOCK_TTL):
+    '''
+    See function "acquire_lock" of the "async_crud" module.
+    '''
+    now = datetime.now(timezone.utc)
+    try:
+        database["locks"].update_one(
+            {"_id": name, "expiry": {"$lt": now}},
+            {"$set": {"owner": owner,
+                      "expiry": now+timedelta(seconds=ttl)}},
+            upsert=True)
+        return True
+    except DuplicateKeyError:
+        return False
+
+@contextmanager
+def holding_lock(name, owner, ttl=UPDATE_LOCK_TTL):
+    '''
+    Hold the lock "name" (see function "acquire_lock") on behalf of
+    "owner" while in the block, which is given True if another process
+    held it first (the lock is then waited for), and False otherwise.
+    The lock is extended every third of "ttl" seconds meanwhile.
+    '''
+    waited = False
+    while not(acquire_lock(name, owner, ttl)):
+        waited = True
+        time.sleep(1)
+    stop = threading.Event()
+    def renew():
+        while not(stop.wait(ttl/3)):
+            database["locks"].update_one(
+                {"_id": name, "owner": owner},
+                {"$set": {"expiry":
+                    datetime.now(timezone.utc)+timedelta(seconds=ttl)}})
+    renewal = threading.Thread(target=renew, daemon=True)
+    renewal.start()
+    try:
+        yield waited
+    finally:
+        stop.set()
+        renewal.join()
+        database["locks"].delete_one({"_id": name, "owner": owner})
+
+def initialize_database(rebuild=REBUILD, owner=OWNER):
+    '''
+    Build the "air_quality" database, unless an existing one can be
+    reused (the missing pollution days are then added by the next
+    update instead).
+
+    The processes sharing the database (the workers of the API) take
+    turns with the lock of the updates: those which have to wait for it
+    reuse the database initialized meanwhile, even when "rebuild" is
+    True.
+
+    Arguments:
+    rebuild -- boolean forcing the database to be built from scratch.
+    owner -- string identifying the calling process.
+    '''
+    with holding_lock("update", owner) as waited:
+        if (rebuild and not(waited)) or not(database_is_ready()):
+            create_database()
+        elif database["metadata"].find_one(
+            {"_id": "schema"}).get("retention_days") != RETENTION_DAYS:
+            apply_retention()
+
+def get_station_codes():
+    '''
+    Return the set of the codes of all the LCSQA stations.
+    '''
+    return set(database["LCSQA_stations"].distinct("Code station"))
+
+def get_stations():
+    '''
+    Return the location of every LCSQA station along with the pollutants
+    it records (see method "storageBackend.get_stations").
+    '''
+    monitored = {
+        document["_id"]: sorted(document["monitored_pollutants"])
+        for document in database["distribution_pollutants"].find()}
+    return [
+        {"code": document["Code station"],
+         "name": document["Nom station"],
+         "city": document["Commune"],
+         "department": document["Département"],
+         "region": document["Région"],
+         "pollutants": monitored.get(document["Code station"], [])}
+        for document in database["LCSQA_stations"].find(
+            {}, {"_id": 0}).sort("Code station")]
 
 def update_database():
     '''
     Complete the database with the latest pollution data recorded since
-    the last update and remove those being more than 180 days old.
+    the last update (within the last "RETENTION_DAYS" days, storing
+    again those which may not have been final yet, see function
+    "storage.first_stored_date"). The data leaving the retention window
+    are removed by the database server itself, as their documents expire
+    (see function "expiry_date").
     '''
+    start = time.perf_counter()
+    # Drop the staging collections left by an update which failed
+    # partway.
+    for name in ["new_working_days","new_weekends"]:
+        database.drop_collection(name)
     # Retrieve the date when the last update occured.
     last_update = database["last_update"].find_one()["date"]
     # Found the number of pollution days (given by "n_days")
     # whose data we want to add to the database.
-    following_date = last_update.date() + timedelta(days=1)
-    oldest_date = date.today() - timedelta(days=180)
-    DATE = following_date if oldest_date < following_date \
-    else oldest_date
+    DATE = first_stored_date(last_update)
     n_days = (date.today()-DATE).days
-    # Create the "new_working_days" and "new_weekends" collections
-    # storing the missing data.
-    store_pollution_data(n_days, update=True)
-    # Rearrange the data the same way as in the "working_days" and
-    # "weekends" collections.
+    # Fill the "new_working_days" and "new_weekends" staging
+    # collections with the missing data.
+    missing = store_pollution_data(n_days, update=True)
+    # Remove the days stored again (as well as the ones merged by an
+    # update which failed partway) from the histories and profiles, so
+    # that they are replaced by the merges.
+    since = datetime(DATE.year, DATE.month, DATE.day)
+    with metrics.stage("aggregate"):
+        for name in ["working_days","weekends"]:
+            truncate_histories(name, ["dates","values","bins"], since)
+            truncate_histories(
+                name+"_rollups", ["dates","values","weights"], since)
+        truncate_profiles(since)
     for name in ["new_working_days","new_weekends"]:
-        database[name].aggregate([
-            {"$match": {"validité": 1}},
-            {"$project": {"_id": {"station": "$code site",
-                                  "pollutant": "$Polluant",
-                                  "hour": "$hour"},
-                          "history": {"date": "$dateTime",
-                                      "value": "$valeur brute"}}}])
-        # Join the collection containing the current data with the one 
-        # containing the new data (line 239), update the history (line 245)
-        # and update the boolean flags identifying the last values of the
-        # new history (line 253).
-        database[name[4:]].aggregate([
-            {"$lookup": 
-                {"from": name,
-                 "localField": "_id",
-                 "foreignField": "_id",
-                 "as": name}},
-            {"$set":
-                {"history":
-                    {"$function": 
-                        {"body": updateList,
-                         "args": ["$history",
-                                  "$data_180_days_ago",
-                                  "$"+name],
-                         "lang": "js"}}}},
-            {"$set":
-                {"data_180_days_ago":
-                    {"$eq": ["history.dates.$",
-                            date.today()-timedelta(days=180)]}}},
-            {"$out": name[4:]}])
+        with metrics.stage("aggregate"):
+            # Add the stations (or pollutants) which did not provide
+            # any data before.
+            database[name].aggregate([
+                {"$group":
+                    {"_id": "$code site",
+                     "monitored_pollutants": {"$addToSet": "$Polluant"}}},
+                {"$merge":
+                    {"into": "distribution_pollutants",
+                     "whenMatched": [
+                        {"$set":
+                            {"monitored_pollutants":
+                                {"$setUnion": ["$monitored_pollutants",
+                                               "$$new.monitored_pollutants"]}}}],
+                     "whenNotMatched": "insert"}}])
+            # Group the new data by (station, pollutant, hour) triple and
+            # month and append them to the history of the triple (only the
+            # documents of the current months of the triples having new data
+            # are written), then do the same with their aggregation by area.
+            database[name].aggregate(history_pipeline()+[merge_stage(name[4:])])
+            store_rollups(name)
+            database[name].aggregate(profiles_pipeline())
         # Remove the collection used to store the new data.
-        database.drop_collection("new_data")
-    # Change the date of the last update.
-    database["last_update"].replace_one(
+        database.drop_collection(name)
+    # Create the indexes of the collections created by the update, if any.
+    ensure_indexes(database)
+    # Change the date of the last update (the days which could not be
+    # downloaded are tried again by the next update).
+    database["last_update"].update_one(
         {"date": last_update},
-        {"date": datetime(
-            DATE.year,
-            DATE.month,
-            DATE.day)-timedelta(days=1)})
+        {"$set": {"date": last_stored_date(missing)}})
+    metrics.ingestion_seconds.observe(
+        time.perf_counter()-start, operation="update")
 
 def history_is_updated():
     '''
-    Test whether the pollution data recorded over the last
-    180 days are stored in the "air_quality" database.
+    Test whether the pollution data recorded up to yesterday
+    are stored in the "air_quality" database.
     '''
     DATE = date.today()
     # Check the date of the last update to know whether some 
@@ -281,53 +702,307 @@ def is_monitored_by(pollutant, station):
     Test whether air concentration of "pollutant" is recorded by the
     air quality monitoring station identified by "station_code".
     '''
-    return pollutant in \
-    list(set(database["distribution_pollutants"].find_one(
-        {"_id": station})
-    ["monitored_pollutants"]))
+    document = database["distribution_pollutants"].find_one({"_id": station})
+    return document is not None and \
+    pollutant in document["monitored_pollutants"]
 
-def get_values(station, pollutant, n_days):
+def window_totals(start):
     '''
-    Query the "LCSQA_data" collection to retrieve average values of 
-    air concentration (calculated over the "n_days" last days with
-    data coming from "station") of "pollutant" associated to each 
-    of the 24 hours of both working days and week-end days.
+    Return the aggregation expression giving the sum and the number of
+    the values of a monthly history recorded since "start" (fields "sum"
+    and "count", both 0 when there is none).
+
+    The difference between the last cumulative sum (resp. count) and
+    the one preceding the first value of the period gives the sum
+    (resp. number) of the values of the period (each value counting
+    for one, or for its weight in the histories of areas).
+    '''
+    preceding = lambda key, offset: {"$subtract": [
+        {"$arrayElemAt": ["$history."+key, "$$k"]}, offset]}
+    return {"$let":
+        {"vars":
+            # Position of the first value of the period.
+            {"k": {"$size":
+                {"$filter":
+                    {"input": "$history.dates",
+                     "cond": {"$lt": ["$$this", start]}}}}},
+         "in":
+            {"$cond": [
+                {"$lt": ["$$k", {"$size": "$history.dates"}]},
+                {"sum": {"$subtract": [
+                    {"$last": "$history.sums"},
+                    preceding("sums", {"$arrayElemAt": ["$history.values", "$$k"]})]},
+                 "count": {"$subtract": [
+                    {"$last": "$history.counts"},
+                    preceding("counts", {"$ifNull": [
+                        {"$arrayElemAt": ["$history.weights", "$$k"]},
+                        1]})]}},
+                {"sum": 0, "count": 0}]}}}
+
+def averages_pipeline(query_filter, n_days, rollups=False):
+    '''
+    Return the aggregation pipeline run on the "working_days" collection
+    (or "working_days_rollups" if "rollups" is True) which yields, for
+    each triple matching "query_filter" and for both working days and
+    week-end days, the average concentration recorded over the "n_days"
+    last days (one document per triple and type of day having data).
+
+    Only the documents of the months overlapping the period are read,
+    and their totals are added up for each triple.
     '''
     DATE = date.today()
-    DATETIME = datetime(DATE.year, DATE.month, DATE.day)
-    working_days, weekends = [{str(x): float(0) for x in range(24)}]*2
-    query_filter = {"_id.station": station, "_id.pollutant": pollutant}
-    # Check whether "n_days" is not null (the zero value is used when
-    # we send the web request only to allow an update of the database).
-    if n_days:
-        # Retrieve all the documents with the wanted informations.
-        working_days = database["working_days"].find(query_filter)
-        weekends = database["weekends"].find(query_filter)
-    for name in ["working_days","weekends"]:
-        data = database[name].find(query_filter)
-        # Check whether some data have been found.
-        if data:
-            # For each hour of the day retrieved from a document,
-            # calculate the expected averages and update the
-            # "working_days and week_end" dictionaries.
-            for document in data:
-                hour = document["_id"]["hour"]
-                # Build list "history" with the (concentration,date) 
-                # pair of values, ordered from the most recent date
-                # to the oldest.
-                history = list(zip(
-                    document["history"]["values"],
-                    document["history"]["dates"]))[::-1]
-                # Extract only elements of "history" with a date less 
-                # than "n_days" days before the current date (the last 
-                # element to consider is given by the "i" variable at 
-                # the end of the "while" loop) and update the appropriate 
-                # dictionary with the wanted average.
-                i = 0
-                duration = DATETIME - history[i][1]
-                while duration.days <= n_days:
-                    i += 1
-                    duration = DATETIME - history[i][1]
-                averages[str(hour)] = float(mean([e[0] for e in history[:i]]))
-            
-    return list(working_days.values()), list(weekends.values())
+    start = datetime(DATE.year, DATE.month, DATE.day)-timedelta(days=n_days)
+    query_filter = dict(
+        query_filter, **{"_id.bucket": {"$gte": datetime(start.year, start.month, 1)}})
+    project = lambda name: {"$project":
+        {"_id": 0,
+         "day_type": name,
+         "station": "$_id.station",
+         "area": "$_id.area",
+         "pollutant": "$_id.pollutant",
+         "hour": "$_id.hour",
+         "totals": window_totals(start)}}
+    return [
+        {"$match": query_filter},
+        project("working_days"),
+        {"$unionWith":
+            {"coll": "weekends"+("_rollups" if rollups else ""),
+             "pipeline": [{"$match": query_filter}, project("weekends")]}},
+        {"$group":
+            {"_id": {"day_type": "$day_type",
+                     "station": "$station",
+                     "area": "$area",
+                     "pollutant": "$pollutant",
+                     "hour": "$hour"},
+             "sum": {"$sum": "$totals.sum"},
+             "count": {"$sum": "$totals.count"}}},
+        {"$project":
+            {"_id": 0,
+             "day_type": "$_id.day_type",
+             "station": "$_id.station",
+             "area": "$_id.area",
+             "pollutant": "$_id.pollutant",
+             "hour": "$_id.hour",
+             "average":
+                {"$cond": [{"$gt": ["$count", 0]},
+                           {"$divide": ["$sum", "$count"]},
+                           0]}}}]
+
+def values_pipeline(station, pollutant, n_days):
+    '''
+    Return the pipeline of "averages_pipeline" restricted to "pollutant"
+    and "station" (one document per hour having data).
+    '''
+    return averages_pipeline(
+        {"_id.station": station, "_id.pollutant": pollutant}, n_days)
+
+def area_pipeline(level, area, pollutant, n_days):
+    '''
+    Return the pipeline of "averages_pipeline" run on the rollups of
+    "area" (of the given level) and "pollutant".
+    '''
+    return averages_pipeline(
+        {"_id.level": level, "_id.area": area, "_id.pollutant": pollutant},
+        n_days,
+        rollups=True)
+
+def batch_pipeline(pairs, stations, n_days):
+    '''
+    Return the pipeline of "averages_pipeline" restricted to the given
+    (station, pollutant) pairs and to all the pollutants of the given
+    stations.
+    '''
+    conditions = [
+        {"_id.station": station, "_id.pollutant": pollutant}
+        for station, pollutant in pairs]
+    if stations:
+        conditions.append({"_id.station": {"$in": list(stations)}})
+    return averages_pipeline({"$or": conditions}, n_days)
+
+def quantiles_pipeline(station, pollutant, n_days):
+    '''
+    Return the aggregation pipeline run on the "working_days" collection
+    which merges the daily sketches of "station" and "pollutant" over
+    the "n_days" last days, yielding the number of values of each type
+    of day, hour and bin (see module "sketch").
+    '''
+    DATE = date.today()
+    start = datetime(DATE.year, DATE.month, DATE.day)-timedelta(days=n_days)
+    query_filter = {
+        "_id.station": station,
+        "_id.pollutant": pollutant,
+        "_id.bucket": {"$gte": datetime(start.year, start.month, 1)}}
+    stages = lambda name: [
+        {"$match": query_filter},
+        {"$project":
+            {"_id": 0,
+             "day_type": name,
+             "hour": "$_id.hour",
+             "pairs":
+                {"$filter":
+                    {"input": {"$zip": {"inputs": ["$history.dates",
+                                                   "$history.bins"]}},
+                     "cond": {"$gte": [{"$arrayElemAt": ["$$this", 0]},
+                                       start]}}}}},
+        {"$unwind": "$pairs"}]
+    return stages("working_days")+[
+        {"$unionWith": {"coll": "weekends", "pipeline": stages("weekends")}},
+        {"$group":
+            {"_id": {"day_type": "$day_type",
+                     "hour": "$hour",
+                     "bin": {"$arrayElemAt": ["$pairs", 1]}},
+             "count": {"$sum": 1}}},
+        {"$project":
+            {"_id": 0,
+             "day_type": "$_id.day_type",
+             "hour": "$_id.hour",
+             "bin": "$_id.bin",
+             "count": 1}}]
+
+def profiles_filter(station, pollutant, first_month):
+    '''
+    Return the query of the profiles of "station" and "pollutant" since
+    the month starting on "first_month".
+    '''
+    return {
+        "_id.station": station,
+        "_id.pollutant": pollutant,
+        "_id.bucket": {"$gte": datetime(first_month.year, first_month.month, 1)}}
+
+def profile_entry(document):
+    '''
+    Turn a document of the "profiles" collection into the entry returned
+    by "get_profiles".
+    '''
+    return {
+        "month": document["_id"]["bucket"].date(),
+        "weekday": document["_id"]["weekday"],
+        "hour": document["_id"]["hour"],
+        "sum": document["sum"],
+        "count": document["count"]}
+
+def get_values(station, pollutant, n_days):
+    '''
+    Query the "working_days" and "weekends" collections to retrieve
+    average values of air concentration (calculated over the "n_days"
+    last days with data coming from "station") of "pollutant" associated
+    to each of the 24 hours of both working days and week-end days.
+
+    The averages are calculated by the database server, so that only
+    the 48 resulting values are sent back.
+    '''
+    # No average can be calculated over zero day.
+    if not(n_days):
+        return format_values([])
+    return format_values(database["working_days"].aggregate(
+        values_pipeline(station, pollutant, n_days)))
+
+def get_batch_values(pairs, stations, n_days):
+    '''
+    See function "get_batch_values" of the "async_crud" module.
+    '''
+    if not(n_days):
+        return format_batch([], pairs)
+    return format_batch(database["working_days"].aggregate(
+        batch_pipeline(pairs, stations, n_days)), pairs)
+
+def get_area_values(level, area, pollutant, n_days):
+    '''
+    See function "get_area_values" of the "async_crud" module.
+    '''
+    if not(n_days):
+        return format_values([])
+    documents = list(database["working_days_rollups"].aggregate(
+        area_pipeline(level, area, pollutant, n_days)))
+    if not(documents):
+        return None
+    return format_values(documents)
+
+def get_quantiles(station, pollutant, n_days, q):
+    '''
+    Return the "q" quantiles (instead of the averages) of "get_values",
+    obtained by merging the daily sketches of the period.
+    '''
+    if not(n_days):
+        return format_quantiles([], q)
+    return format_quantiles(database["working_days"].aggregate(
+        quantiles_pipeline(station, pollutant, n_days)), q)
+
+def get_profiles(station, pollutant, first_month):
+    '''
+    Return the documents of the "profiles" collection (see function
+    "profiles_pipeline") of "station" and "pollutant" since the month
+    starting on "first_month" (a date), shaped as described in method
+    "get_profiles" of "storage.storageBackend".
+    '''
+    return [
+        profile_entry(document)
+        for document in database["profiles"].find(
+            profiles_filter(station, pollutant, first_month),
+            {"sum": 1, "count": 1})]
+
+def get_last_update():
+    '''
+    Return the date of the last update of the database.
+    '''
+    return database["last_update"].find_one()["date"]
+
+def get_revision():
+    '''
+    Return the number of backfills merged into the database (see module
+    "backfill").
+    '''
+    return database["last_update"].find_one().get("revision", 0)
+
+def set_last_update(DATE):
+    '''
+    Record "DATE" (a datetime) as the date of the last update.
+    '''
+    database["last_update"].update_one({}, {"$set": {"date": DATE}}, upsert=True)
+
+def records_pipeline(first_datetime):
+    '''
+    Return the aggregation pipeline run on the "working_days" collection
+    which yields one document per value recorded since "first_datetime"
+    (on any type of day), giving its station, pollutant, hour, date and
+    value.
+    '''
+    stages = [
+        {"$match": {"_id.bucket": {"$gte": datetime(
+            first_datetime.year, first_datetime.month, 1)}}},
+        {"$project":
+            {"_id": 0,
+             "station": "$_id.station",
+             "pollutant": "$_id.pollutant",
+             "hour": "$_id.hour",
+             "pairs":
+                {"$filter":
+                    {"input": {"$zip": {"inputs": ["$history.dates",
+                                                   "$history.values"]}},
+                     "cond": {"$gte": [{"$arrayElemAt": ["$$this", 0]},
+                                       first_datetime]}}}}},
+        {"$unwind": "$pairs"},
+        {"$project":
+            {"station": 1,
+             "pollutant": 1,
+             "hour": 1,
+             "dateTime": {"$arrayElemAt": ["$pairs", 0]},
+             "value": {"$arrayElemAt": ["$pairs", 1]}}}]
+    return stages+[{"$unionWith": {"coll": "weekends", "pipeline": stages}}]
+
+def get_records(first_datetime, batch_size=CHUNK_ROWS):
+    '''
+    Yield the values recorded since "first_datetime" by dataframes of at
+    most "batch_size" rows, giving the station, pollutant, day (number of
+    days since 1970-01-01), hour and value of each of them.
+    '''
+    cursor = database["working_days"].aggregate(
+        records_pipeline(first_datetime), batchSize=batch_size)
+    while True:
+        documents = list(itertools.islice(cursor, batch_size))
+        if not(documents):
+            return
+        data = DataFrame(documents)
+        data["day"] = data.pop("dateTime").values.astype(
+            "datetime64[D]").astype("int64")
+        yield data[["station","pollutant","day","hour","value"]]
@@ -0,0 +1,431 @@
+import asyncio
+import fcntl
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from .config import CUBE_DIR, REBUILD, RETENTION_DAYS
+from .storage import first_stored_date, storageBackend
+
+# Query engine keeping all the values of the retention window in a dense
+# float32 array of shape (stations, pollutants, days, 24), NaN standing
+# for the hours without any value. The array is stored in a ".npy" file
+# of "CUBE_DIR" mapped in memory by every worker (so that it is only
+# loaded once by the system), and described by the index file "INDEX":
+#   - "file": name of the ".npy" file,
+#   - "stations" and "pollutants": labels of the first two axes,
+#   - "first_day" and "last_day": dates of the first and last rows of
+#     the day axis,
+#   - "revision": revision of the data of the storage (see method
+#     "storageBackend.revision"), the array being rebuilt from scratch
+#     when it changes,
+#   - "present": (station, pollutant) positions having at least a value.
+# After each ingestion a new file is written and the index is replaced in
+# one step, so readers always see a complete array (see function
+# "refresh"). The writers of the processes sharing the directory take
+# turns with a lock on the file "LOCK".
+
+INDEX = "cube.json"
+LOCK = "cube.lock"
+
+EPOCH = date(1970, 1, 1)
+
+def read_index(directory=CUBE_DIR):
+    try:
+        with open(os.path.join(directory, INDEX)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_index(directory, index):
+    path = os.path.join(directory, INDEX)
+    temporary = path+"."+uuid.uuid4().hex
+    with open(temporary, "w") as f:
+        json.dump(index, f)
+    os.replace(temporary, path)
+
+@contextmanager
+def writer_lock(directory, wait=True):
+    '''
+    Hold the lock of the writers of the array of "directory" while in
+    the block, which is given False instead (without waiting) when
+    "wait" is False and another process holds it.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK), "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if wait else fcntl.LOCK_EX|fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def refresh(storage, directory=CUBE_DIR, n_days=RETENTION_DAYS, wait=True):
+    '''
+    Bring the array up to the last day stored by "storage" (see module
+    "storage"), and return True if it changed. The days of the current
+    array still in the window are kept, only the following ones (and
+    those stored again since) being read from the storage.
+
+    Arguments:
+    wait -- whether to wait for the refresh run by another process
+    (otherwise nothing is done and False is returned).
+    '''
+    with writer_lock(directory, wait) as locked:
+        return locked and refresh_locked(storage, directory, n_days)
+
+def refresh_locked(storage, directory, n_days):
+    '''
+    Body of function "refresh", run while holding the lock of the
+    writers.
+    '''
+    last_day = storage.last_update().date()
+    revision = storage.revision()
+    first_day = last_day-timedelta(days=n_days-1)
+    index = read_index(directory)
+    if index is not None and index["n_days"] == n_days and \
+    date.fromisoformat(index["last_day"]) == last_day and \
+    index.get("revision", 0) == revision:
+        return False
+    stations, pollutants = [], []
+    cube = numpy.full((0, 0, n_days, 24), numpy.nan, dtype=numpy.float32)
+    read_from = first_day
+    if index is not None and index["n_days"] == n_days and \
+    index.get("revision", 0) == revision:
+        stations, pollutants = index["stations"], index["pollutants"]
+        previous = numpy.load(
+            os.path.join(directory, index["file"]), mmap_mode="r")
+        cube = numpy.full(previous.shape, numpy.nan, dtype=numpy.float32)
+        # Shift the days still in the window to their new position, but
+        # the ones stored again by the update (see function
+        # "storage.first_stored_date").
+        shift = (first_day-date.fromisoformat(index["first_day"])).days
+        if 0 <= shift < n_days:
+            cube[:, :, :n_days-shift] = previous[:, :, shift:]
+            read_from = max(first_day, first_stored_date(
+                datetime.fromisoformat(index["last_day"])))
+            cube[:, :, (read_from-first_day).days:] = numpy.nan
+        del previous
+    positions = {
+        "station": {e: i for i, e in enumerate(stations)},
+        "pollutant": {e: i for i, e in enumerate(pollutants)}}
+    for data in storage.iter_records(read_from):
+        # Add the stations and pollutants seen for the first time.
+        for key, labels in [("station", stations), ("pollutant", pollutants)]:
+            for label in data[key].unique():
+                if label not in positions[key]:
+                    positions[key][label] = len(labels)
+                    labels.append(label)
+        if len(stations) > cube.shape[0] or len(pollutants) > cube.shape[1]:
+            grown = numpy.full(
+                (max(len(stations), 2*cube.shape[0]), len(pollutants), n_days, 24),
+                numpy.nan,
+                dtype=numpy.float32)
+            grown[:cube.shape[0], :cube.shape[1]] = cube
+            cube = grown
+        days = data["day"].to_numpy()-(first_day-EPOCH).days
+        kept = (days >= 0) & (days < n_days)
+        cube[data["station"].map(positions["station"]).to_numpy()[kept],
+             data["pollutant"].map(positions["pollutant"]).to_numpy()[kept],
+             days[kept],
+             data["hour"].to_numpy()[kept]] = data["value"].to_numpy()[kept]
+    cube = cube[:len(stations), :len(pollutants)]
+    present = ~numpy.isnan(cube).all(axis=(2, 3))
+    # Write the new array next to the current one, then switch the index
+    # to it (the workers still reading the former file keep it open).
+    name = "cube-"+uuid.uuid4().hex+".npy"
+    array = open_memmap(
+        os.path.join(directory, name),
+        mode="w+",
+        dtype=numpy.float32,
+        shape=cube.shape)
+    array[:] = cube
+    array.flush()
+    del array
+    write_index(directory, {
+        "file": name,
+        "n_days": n_days,
+        "stations": stations,
+        "pollutants": pollutants,
+        "first_day": first_day.isoformat(),
+        "last_day": last_day.isoformat(),
+        "revision": revision,
+        "present": numpy.argwhere(present).tolist()})
+    # Remove the former array, as well as the ones left by the writers
+    # interrupted before switching the index (the workers still mapping
+    # the former array keep reading it until they switch too).
+    for e in os.listdir(directory):
+        if e.startswith("cube-") and e.endswith(".npy") and e != name:
+            os.remove(os.path.join(directory, e))
+    return True
+
+def window_means(values, working_days):
+    '''
+    Return the means over the day axis (the one before the last) of the
+    non-NaN "values" of the days where "working_days" is True, then False
+    (0 when there is none).
+    '''
+    means = []
+    for mask in [working_days, ~working_days]:
+        selected = values[..., mask, :]
+        valid = ~numpy.isnan(selected)
+        counts = valid.sum(axis=-2)
+        sums = numpy.where(valid, selected, 0).sum(axis=-2, dtype=numpy.float64)
+        means.append(numpy.divide(
+            sums, counts, out=numpy.zeros(sums.shape), where=counts > 0))
+    return means
+
+class cubeEngine():
+    '''
+    Averages of the "/" and "/batch" endpoints calculated from the array
+    of directory "directory" (reloaded whenever a new one is written).
+    '''
+    def __init__(self, directory=CUBE_DIR):
+        self.directory = directory
+        self.version = None
+        self.index = None
+        self.cube = None
+        self.checked = float(0)
+
+    def load(self):
+        '''
+        Map the current array in memory if the index has changed since the
+        last call (checked at most once per second).
+        '''
+        if time.monotonic() < self.checked+1:
+            return
+        self.checked = time.monotonic()
+        try:
+            version = os.stat(os.path.join(self.directory, INDEX)).st_mtime_ns
+            if version == self.version:
+                return
+            index = read_index(self.directory)
+            if index is None:
+                raise FileNotFoundError(os.path.join(self.directory, INDEX))
+            cube = numpy.load(
+                os.path.join(self.directory, index["file"]), mmap_mode="r")
+        except FileNotFoundError:
+            # The index has been replaced meanwhile: keep the current
+            # array until the next check.
+            if self.cube is None:
+                raise
+            return
+        self.cube = cube
+        self.index = index
+        self.stations = {e: i for i, e in enumerate(index["stations"])}
+        self.pollutants = {e: i for i, e in enumerate(index["pollutants"])}
+        self.first_day = date.fromisoformat(index["first_day"])
+        self.working_days = numpy.array([
+            (self.first_day+timedelta(days=i)).weekday() < 5
+            for i in range(index["n_days"])])
+        self.monitored = {}
+        for s, p in index["present"]:
+            self.monitored.setdefault(
+                index["stations"][s], []).append(index["pollutants"][p])
+        self.version = version
+
+    def last_day(self):
+        '''
+        Return the last day of the array (to be used in the keys of the
+        cached results).
+        '''
+        self.load()
+        return self.index["last_day"]
+
+    def revision(self):
+        '''
+        Return the revision of the data of the array.
+        '''
+        self.load()
+        return self.index.get("revision", 0)
+
+    def start(self, n_days):
+        # Position of the first day of the "n_days" last days.
+        return max(0, (date.today()-timedelta(days=n_days)-self.first_day).days)
+
+    def is_monitored_by(self, pollutant, station):
+        self.load()
+        return pollutant in self.monitored.get(station, [])
+
+    def get_values(self, station, pollutant, n_days):
+        '''
+        See function "get_values" of the "crud" module.
+        '''
+        self.load()
+        s = self.stations.get(station)
+        p = self.pollutants.get(pollutant)
+        if not(n_days) or s is None or p is None:
+            return [float(0)]*24, [float(0)]*24
+        start = self.start(n_days)
+        working_days, weekends = window_means(
+            self.cube[s, p, start:], self.working_days[start:])
+        return working_days.tolist(), weekends.tolist()
+
+    def get_batch_values(self, pairs, stations, n_days):
+        '''
+        See function "get_batch_values" of the "async_crud" module.
+        '''
+        self.load()
+        requested = set(pairs)
+        keys = list(pairs)+sorted(
+            (station, pollutant)
+            for station in stations
+            for pollutant in self.monitored.get(station, [])
+            if (station, pollutant) not in requested)
+        known = [
+            i for i, (station, pollutant) in enumerate(keys)
+            if station in self.stations and pollutant in self.pollutants]
+        working_days = numpy.zeros((len(keys), 24))
+        weekends = numpy.zeros((len(keys), 24))
+        if n_days and known:
+            start = self.start(n_days)
+            values = self.cube[
+                [self.stations[keys[i][0]] for i in known],
+                [self.pollutants[keys[i][1]] for i in known],
+                start:]
+            working_days[known], weekends[known] = window_means(
+                values, self.working_days[start:])
+        return keys, working_days.tolist(), weekends.tolist()
+
+    def get_all_values(self, pollutant, n_days):
+        '''
+        Return the stations recording "pollutant" along with the two
+        matrices of their averages of working days and week-end days
+        (see function "get_batch_values").
+        '''
+        self.load()
+        p = self.pollutants.get(pollutant)
+        stations = sorted(
+            station for station, pollutants in self.monitored.items()
+            if pollutant in pollutants)
+        if not(n_days) or p is None:
+            zeros = [[float(0)]*24 for _ in stations]
+            return stations, zeros, [list(e) for e in zeros]
+        start = self.start(n_days)
+        positions = [self.stations[station] for station in stations]
+        working_days, weekends = window_means(
+            self.cube[positions, p, start:], self.working_days[start:])
+        return stations, working_days.tolist(), weekends.tolist()
+
+class cubeStorage(storageBackend):
+    '''
+    Storage "storage" (see module "storage") whose averages of single
+    stations are calculated from the array of directory "directory",
+    refreshed after each update. The averages of areas, the quantiles
+    (see module "sketch") and the profiles are still calculated by
+    "storage".
+    '''
+    def __init__(self, storage, directory=CUBE_DIR):
+        self.storage = storage
+        self.directory = directory
+        self.engine = cubeEngine(directory)
+        self.last_update_cache = storage.last_update_cache
+
+    def is_ready(self):
+        return self.storage.is_ready()
+
+    def create(self):
+        self.storage.create()
+        refresh(self.storage, self.directory)
+
+    def initialize(self, rebuild=REBUILD):
+        self.storage.initialize(rebuild)
+        refresh(self.storage, self.directory)
+
+    def update(self):
+        updated = self.storage.update()
+        return refresh(self.storage, self.directory) or updated
+
+    def last_update(self):
+        return self.storage.last_update()
+
+    def set_last_update(self, DATE):
+        self.storage.set_last_update(DATE)
+
+    def revision(self):
+        return self.storage.revision()
+
+    def iter_records(self, first_day):
+        return self.storage.iter_records(first_day)
+
+    def station_codes(self):
+        return self.storage.station_codes()
+
+    def is_monitored_by(self, pollutant, station):
+        return self.engine.is_monitored_by(pollutant, station)
+
+    def get_stations(self):
+        return self.storage.get_stations()
+
+    def get_values(self, station, pollutant, n_days):
+        return self.engine.get_values(station, pollutant, n_days)
+
+    def get_batch_values(self, pairs, stations, n_days):
+        return self.engine.get_batch_values(pairs, stations, n_days)
+
+    def get_area_values(self, level, area, pollutant, n_days):
+        return self.storage.get_area_values(level, area, pollutant, n_days)
+
+    def get_quantiles(self, station, pollutant, n_days, q):
+        return self.storage.get_quantiles(station, pollutant, n_days, q)
+
+    def get_profiles(self, station, pollutant, first_month):
+        return self.storage.get_profiles(station, pollutant, first_month)
+
+    async def async_last_update(self, refresh=False):
+        # The results calculated from the array depend on its last day
+        # rather than on the last update of the storage.
+        return datetime.fromisoformat(self.engine.last_day())
+
+    async def async_revision(self, refresh=False):
+        return self.engine.revision()
+
+    async def async_history_is_updated(self, refresh=False):
+        # The array is also behind the storage after a backfill.
+        last_update = await self.storage.async_last_update(refresh)
+        return await self.storage.async_history_is_updated() and \
+        self.engine.last_day() == last_update.date().isoformat() and \
+        self.engine.revision() == await self.storage.async_revision()
+
+    async def async_update(self, owner):
+        # The array is written by the process which updated the storage,
+        # or, when it is behind the storage (the writer having been
+        # interrupted for instance), by the first process finding it so:
+        # the others do not wait for it.
+        updated = await self.storage.async_update(owner)
+        changed = await asyncio.to_thread(
+            refresh, self.storage, self.directory, RETENTION_DAYS, updated)
+        return updated or changed
+
+    async def async_is_monitored_by(self, pollutant, station):
+        return self.is_monitored_by(pollutant, station)
+
+    async def async_get_stations(self):
+        return await self.storage.async_get_stations()
+
+    async def async_get_values(self, station, pollutant, n_days):
+        return self.get_values(station, pollutant, n_days)
+
+    async def async_get_batch_values(self, pairs, stations, n_days):
+        return self.get_batch_values(pairs, stations, n_days)
+
+    async def async_get_area_values(self, level, area, pollutant, n_days):
+        return await self.storage.async_get_area_values(
+            level, area, pollutant, n_days)
+
+    async def async_get_quantiles(self, station, pollutant, n_days, q):
+        return await self.storage.async_get_quantiles(
+            station, pollutant, n_days, q)
+
+    async def async_get_profiles(self, station, pollutant, first_month):
+        return await self.storage.async_get_profiles(
+            station, pollutant, first_month)
@@ -1,6 +1,5 @@
 import subprocess
 import time
-from datetime import date, datetime, timedelta
 
 import requests
 from matplotlib import pyplot
@@ -309,21 +308,6 @@ def main():
         i += 1
         time.sleep(0.7)
 
-    DATE = date.today() - timedelta(days=1)
-    DATETIME = datetime(DATE.year, DATE.month, DATE.day)
-    # If some pollution days are missing from the database, send a special
-    # request (with a pollution period of "zero day") to allow the server to
-    # perform an update of the data.
-    if database["last_update"].find_one()["date"] != DATETIME:
-        dictionary = database["distribution_pollutants"].find_one()
-        parameters = {
-            "s": dictionary["_id"],
-            "p": dictionary["monitored_pollutants"][0],
-            "n": "0"}
-        _ = requests.get(
-            "http://127.0.0.1:8000",
-            params=parameters,
-            verify=False)
     # Start the process of interacting with the user to get the query parameters
     # corresponding to his choices.
     process = userChoices()
@@ -0,0 +1,141 @@
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import requests
+
+from . import metrics, mirror
+from .config import \
+DOWNLOAD_BACKOFF, DOWNLOAD_RETRIES, DOWNLOAD_TIMEOUT, E2_BASE_URL, \
+FINAL_AFTER_DAYS, MAX_DOWNLOADS, OFFLINE, RETENTION_DAYS
+
+# Content given for the files missing for good (not found although they
+# no longer change), as opposed to None for those which could not be
+# retrieved for now.
+MISSING = object()
+
+def daily_url(DATE):
+    '''
+    Return the url of the "csv" file giving the pollution data
+    recorded on "DATE".
+    '''
+    return E2_BASE_URL+str(DATE.year)+"/FR_E2_"+DATE.isoformat()+".csv"
+
+def fetch(url, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF, final_since=None):
+    '''
+    Return the path of a local copy of the file located at "url" (the
+    file being downloaded into the mirror when needed, see function
+    "mirror.store"), "MISSING" when a file which can no longer change is
+    not found, or
+    None when the file could not be retrieved.
+
+    Arguments:
+    url -- address of the file to download.
+    retries -- number of new attempts made after a failed download.
+    backoff -- delay (in seconds) before the first new attempt, doubled
+               after each failure.
+    final_since -- date from which the file can no longer change (None
+                   if it always may): from then on, its mirrored copy is
+                   used without revalidation if it was validated since.
+    '''
+    if OFFLINE:
+        return mirror.read_offline(url)
+    immutable = final_since is not None and date.today() >= final_since
+    if immutable:
+        path = mirror.lookup(url, validated_since=final_since)
+        if path is not None:
+            return path
+    for attempt in range(retries+1):
+        try:
+            # Send a conditional request so that the file is only
+            # transferred if it differs from the mirrored copy.
+            response = requests.get(
+                url,
+                headers=mirror.validators(url),
+                timeout=DOWNLOAD_TIMEOUT,
+                stream=True)
+            if response.status_code == 304:
+                response.close()
+                path = mirror.lookup(url)
+                if path is not None:
+                    mirror.revalidated(url)
+                    return path
+                # The mirrored copy has disappeared: download it again.
+                response = requests.get(
+                    url, timeout=DOWNLOAD_TIMEOUT, stream=True)
+            with response:
+                # A missing file will not show up on a later attempt (nor
+                # ever, if it can no longer change).
+                if response.status_code == 404:
+                    return MISSING if immutable else None
+                response.raise_for_status()
+                return mirror.store(url, response)
+        except requests.RequestException:
+            if attempt < retries:
+                time.sleep(backoff*2**attempt)
+    # Fall back on the (possibly outdated) mirrored copy.
+    return mirror.lookup(url)
+
+def timed_fetch(url, *args, **kwargs):
+    '''
+    Call function "fetch", recording its duration as the "download"
+    stage of the ingestion (see module "metrics").
+    '''
+    with metrics.stage("download"):
+        return fetch(url, *args, **kwargs)
+
+def fetch_daily_files(
+    dates,
+    max_workers=MAX_DOWNLOADS,
+    retries=DOWNLOAD_RETRIES,
+    backoff=DOWNLOAD_BACKOFF):
+    '''
+    Download concurrently the daily "csv" files of the given dates and
+    yield the (date, path) pairs in the order of "dates" (path being
+    that of the local copy of the file, see function "fetch": None for
+    the files which could not be retrieved, "MISSING" for those which
+    will never be). Files at least "FINAL_AFTER_DAYS" days old no longer
+    change, so their mirrored copies are used as they are once validated
+    at that age (the others are revalidated), and they are missing for
+    good when not found.
+
+    Arguments:
+    dates -- iterable of "date" objects.
+    max_workers -- maximum number of files downloaded at the same time.
+    retries, backoff -- see function "fetch".
+    '''
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    # The downloads queued when the consumer stops early are cancelled
+    # instead of being waited for.
+    try:
+        pending = deque()
+        for DATE in dates:
+            pending.append((DATE, executor.submit(
+                timed_fetch,
+                daily_url(DATE),
+                retries,
+                backoff,
+                final_since=DATE+timedelta(days=FINAL_AFTER_DAYS))))
+            # Limit the number of files downloaded in advance so that a
+            # slow consumer does not make every file pile up on disk.
+            if len(pending) > 2*max_workers:
+                DATE, future = pending.popleft()
+                yield DATE, future.result()
+        while pending:
+            DATE, future = pending.popleft()
+            yield DATE, future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def prune_mirror():
+    '''
+    Remove from the mirror the daily files of the days which left the
+    retention window ("RETENTION_DAYS"), and no longer need to be read.
+    '''
+    oldest_date = (date.today()-timedelta(days=RETENTION_DAYS)).isoformat()
+    def expired(url):
+        match = re.search(r"FR_E2_([0-9]{4}-[0-9]{2}-[0-9]{2})\.csv$", url)
+        return match is not None and match.group(1) < oldest_date
+    mirror.prune(expired)
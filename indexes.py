@@ -0,0 +1,56 @@
+from pymongo import ASCENDING
+
+# Secondary indexes needed by the queries of the application, for each
+# collection (the "_id" index, always present, serves the lookups of
+# "distribution_pollutants", "locks", "cities", "departments" and
+# "regions").
+INDEXES = {
+    # Queries of "values_pipeline" and "batch_pipeline".
+    "working_days": [
+        [("_id.station", ASCENDING),
+         ("_id.pollutant", ASCENDING),
+         ("_id.bucket", ASCENDING)]],
+    "weekends": [
+        [("_id.station", ASCENDING),
+         ("_id.pollutant", ASCENDING),
+         ("_id.bucket", ASCENDING)]],
+    # Queries of "area_pipeline".
+    "working_days_rollups": [
+        [("_id.level", ASCENDING),
+         ("_id.area", ASCENDING),
+         ("_id.pollutant", ASCENDING),
+         ("_id.bucket", ASCENDING)]],
+    "weekends_rollups": [
+        [("_id.level", ASCENDING),
+         ("_id.area", ASCENDING),
+         ("_id.pollutant", ASCENDING),
+         ("_id.bucket", ASCENDING)]],
+    # Queries of "profiles_pipeline".
+    "profiles": [
+        [("_id.station", ASCENDING),
+         ("_id.pollutant", ASCENDING),
+         ("_id.bucket", ASCENDING)]],
+    # Station codes read at startup and joined in "rollup_pipeline".
+    "LCSQA_stations": [
+        [("Code station", ASCENDING)]]}
+
+# Collections whose documents are removed by the database server once
+# their "expiry" date is past (see function "crud.expiry_date").
+EXPIRING = [
+    "working_days",
+    "weekends",
+    "working_days_rollups",
+    "weekends_rollups",
+    "profiles"]
+
+def ensure_indexes(database):
+    '''
+    Create the indexes of "INDEXES" in "database" which do not exist
+    (to be called whenever collections are rebuilt, since "$out"
+    creates collections without any secondary index).
+    '''
+    for name, indexes in INDEXES.items():
+        for keys in indexes:
+            database[name].create_index(keys)
+    for name in EXPIRING:
+        database[name].create_index("expiry", expireAfterSeconds=0)
@@ -1,15 +1,38 @@
-from typing import Annotated
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from typing import Annotated, Literal
 
 from fastapi import FastAPI, HTTPException, Query
-from pandas import read_excel
+from fastapi.responses import PlainTextResponse, Response
 from pydantic import BaseModel, Field
 
-from .crud import \
-get_values, history_is_updated, is_monitored_by, create_database, update_database
+from . import metrics, plots
+from .cache import resultCache
+from .config import \
+CACHE_SIZE, CACHE_TTL, MAX_BATCH_SIZE, PLOT_CACHE_SIZE, RETENTION_DAYS
+from .scheduler import run_updates
+from .sketch import QUANTILES
+from .storage import format_profiles, get_backend
 
-app = FastAPI()
+# Storage of the pollution data selected by the configuration (see
+# module "storage"), reused if possible (see method "initialize", during
+# which the other workers wait).
+storage = get_backend()
+storage.initialize()
 
-create_database()
+@asynccontextmanager
+async def lifespan(app):
+    # Add the latest pollution data in the background, so that
+    # requests never wait for an update.
+    updates = asyncio.create_task(
+        run_updates(storage, on_update=lambda: values_cache.clear()))
+    yield
+    updates.cancel()
+    plots.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # Define the "averageConcentrations" response Pydantic model
 # (the interest here is on providing a description of what is
@@ -20,20 +43,150 @@ class averageConcentrations(BaseModel):
         description="The average values of air concentration of the given pollutant \
         calculated for each of the 24 hours of the day (set to 0 when not enough data)\
         with data recorded by the given station, over the given period and on working\
-        days only."
+        days only (or the statistic given by the 'stat' parameter)."
     )
     weekends : list[float] = Field(
         description="The same averages values as previously described, but involving\
         pollution data recorded on saturday and sunday only"
     )
 
-# Retrieve all the "LCSQA" station codes (will be used at line 60
-# to verify the existence of the given station).
-url = "https://www.lcsqa.org/system/files/media/documents/"+\
-"Liste points de mesures 2021 pour site LCSQA_27072022.xlsx"
-LCSQA_stations = read_excel(
-    url.replace(" ", "%20"),
-    sheet_name=1).iloc[:,0][2:].tolist()
+# Define the Pydantic models of the body and of the response of the
+# "/batch" endpoint.
+class stationPollutant(BaseModel):
+    station: str = Field(pattern="^FR([0-9]{5}$)")
+    pollutant: str
+
+class batchQuery(BaseModel):
+    pairs: list[stationPollutant] = Field(
+        default=[],
+        description="The (station, pollutant) pairs whose averages are wanted."
+    )
+    stations: list[str] = Field(
+        default=[],
+        description="Stations whose averages are wanted for all the monitored\
+        pollutants."
+    )
+    n_days: int = Field(
+        description="Number of last days whose pollution data are used.",
+        ge=0
+    )
+
+class batchConcentrations(BaseModel):
+    keys: list[tuple[str, str]] = Field(
+        description="The (station, pollutant) pairs, in the order of the rows of\
+        the two following matrices (the requested pairs first)."
+    )
+    working_days: list[list[float]] = Field(
+        description="For each pair, the 24 hourly averages described in the\
+        response of the '/' endpoint, for working days."
+    )
+    weekends: list[list[float]] = Field(
+        description="The same averages for saturday and sunday."
+    )
+
+# Define the response Pydantic model of the "/profiles" endpoint.
+class profileConcentrations(BaseModel):
+    weekdays: list[list[float]] = Field(
+        description="For each day of the week (from monday to sunday), the\
+        average values of air concentration of the given pollutant calculated\
+        for each of the 24 hours of the day (set to 0 when not enough data)."
+    )
+    months: dict[str, list[float]] = Field(
+        description="The same 24 averages for each month having data (keyed by\
+        'YYYY-MM')."
+    )
+    seasons: dict[str, list[float]] = Field(
+        description="The same 24 averages for each season (winter being made of\
+        december, january and february)."
+    )
+    working_days: list[float] = Field(
+        description="The same 24 averages for working days, as returned by the\
+        '/' endpoint over the same months."
+    )
+    weekends: list[float] = Field(
+        description="The same 24 averages for saturday and sunday."
+    )
+
+# Define the response Pydantic model of the "/stations" endpoint.
+class stationDescription(BaseModel):
+    code: str = Field(description="Code identifying the station.")
+    name: str = Field(description="Name of the station.")
+    city: str = Field(description="City where the station is located.")
+    department: str = Field(description="French department of the city.")
+    region: str = Field(description="French region of the department.")
+    pollutants: list[str] = Field(
+        description="Pollutants whose air concentration is recorded by the\
+        station (none when it has no data)."
+    )
+
+# Retrieve all the "LCSQA" station codes from the stored catalogue
+# (will be used to verify the existence of the given station).
+LCSQA_stations = storage.station_codes()
+
+# Cache of the computed averages, keyed on the query parameters and the
+# version of the data (so that the results computed before an update or
+# a backfill are never served after it).
+values_cache = resultCache(CACHE_SIZE, CACHE_TTL)
+
+async def data_version():
+    '''
+    Return the version of the stored data: the date of the last update
+    and the number of backfills merged since (see module "backfill"),
+    which change the data without changing that date.
+    '''
+    return (await storage.async_last_update(), await storage.async_revision())
+
+# Cache of the images of the "/plot" endpoint, keyed on the hash of the
+# plotted values and of the parameters of the chart (so that it needs no
+# clearing after updates).
+images_cache = resultCache(PLOT_CACHE_SIZE, CACHE_TTL)
+
+# Metrics read from the cache and from the date of the last update when
+# the "/metrics" endpoint is called (see module "metrics").
+metrics.counterMetric(
+    "gary_cache_requests_total",
+    "Lookups of the cache of the averages, by result (hit, miss, or "
+    "coalesced with an identical computation in progress).",
+    labels=("result",),
+    function=lambda: {
+        ("hit",): values_cache.hits,
+        ("miss",): values_cache.misses,
+        ("coalesced",): values_cache.coalesced})
+metrics.gaugeMetric(
+    "gary_cache_hit_ratio",
+    "Proportion of the lookups of the cache of the averages served by it.",
+    function=lambda: values_cache.hits/max(1, values_cache.hits+values_cache.misses))
+metrics.gaugeMetric(
+    "gary_cache_entries",
+    "Number of results held by the cache of the averages.",
+    function=lambda: len(values_cache.entries))
+metrics.gaugeMetric(
+    "gary_last_update_age_seconds",
+    "Time elapsed since the end of the last day stored in the database.",
+    function=lambda: None if storage.last_update_cache["date"] is None else (
+        datetime.now()-storage.last_update_cache["date"]-timedelta(days=1)
+    ).total_seconds())
+
+# Record the time taken to answer each request, labelled with the path
+# of the endpoint (rather than the requested url, which has no bound).
+@app.middleware("http")
+async def record_duration(request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.request_seconds.observe(
+        time.perf_counter()-start,
+        endpoint=route.path if route is not None else "unmatched",
+        status=response.status_code)
+    return response
+
+# Define the "/metrics" endpoint giving the metrics of the process in
+# the Prometheus text format.
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    await storage.async_last_update()
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4")
 
 # Define the only endpoint of the API, that is a "GET" method
 # returning the expected 24 average values of air concentration.
@@ -55,30 +208,232 @@ async def get_response(
                 "Pollutant whose average daily variation of air\
                  concentration we want to display."))],
     n_days: Annotated[
-        str,
+        int,
         Query(
             alias="n",
             description=(
                 "Parameter telling the API that we are interested in\
                  pollution data recorded over the 'n_days' last days."),
-            pattern="\d+")]):
+            ge=0)],
+    stat: Annotated[
+        Literal["mean", "median", "p90", "p95"],
+        Query(
+            description=(
+                "Statistic of the values of each hour returned instead of\
+                 their average (median or 90th and 95th percentiles, less\
+                 sensitive to pollution spikes, given within 1%)."))] = "mean"):
     # Notify an error when the given station does not exist.
     if station not in LCSQA_stations:
         raise HTTPException(
             status_code=400,
             detail="This station does not exist!")
-    # Notify an error when air concentration of the given 
-    # pollutant is not monitored by the given station.
-    if not(is_monitored_by(pollutant, station)):
-        raise HTTPException(
-            status_code=400,
-            detail="Pollutant not available!")
-    # Notify an error when the given number of days is greater than 180.
-    if int(n_days) not in list(range(181)):
+    # Notify an error when the given number of days goes beyond the
+    # retention window.
+    if n_days not in range(RETENTION_DAYS+1):
         raise HTTPException(status_code=400, detail="Number of days too high!")
-    # Update the database if necessary.
-    if not(history_is_updated):
-        update_database()
+
+    async def compute_values():
+        # Notify an error when air concentration of the given 
+        # pollutant is not monitored by the given station.
+        if not(await storage.async_is_monitored_by(pollutant, station)):
+            raise HTTPException(
+                status_code=400,
+                detail="Pollutant not available!")
+        if stat != "mean":
+            # Merge the quantile sketches of the period (see module
+            # "sketch").
+            return await storage.async_get_quantiles(
+                station, pollutant, n_days, QUANTILES[stat])
+        return await storage.async_get_values(station, pollutant, n_days)
+
     # Return the expected values.
-    working_days, weekends = get_values(station, pollutant, int(n_days))
+    working_days, weekends = await values_cache.get(
+        (station, pollutant, n_days, stat, await data_version()),
+        compute_values)
     return {"working_days": working_days, "weekends": weekends}
+
+# Define the "/batch" endpoint returning the averages of many (station,
+# pollutant) pairs at once (see function "get_batch_values").
+@app.post("/batch", response_model=batchConcentrations)
+async def get_batch_response(query: batchQuery):
+    pairs = list(dict.fromkeys((e.station, e.pollutant) for e in query.pairs))
+    stations = list(dict.fromkeys(query.stations))
+    # Notify an error when the request is empty or too large.
+    if not(pairs or stations):
+        raise HTTPException(status_code=400, detail="Nothing requested!")
+    if len(pairs)+len(stations) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail="Too many items requested!")
+    # Notify an error when one of the given stations does not exist.
+    for station in stations+[pair[0] for pair in pairs]:
+        if station not in LCSQA_stations:
+            raise HTTPException(
+                status_code=400,
+                detail="Station "+station+" does not exist!")
+    if query.n_days not in range(RETENTION_DAYS+1):
+        raise HTTPException(status_code=400, detail="Number of days too high!")
+    keys, working_days, weekends = await storage.async_get_batch_values(
+        pairs, stations, query.n_days)
+    return {"keys": keys, "working_days": working_days, "weekends": weekends}
+
+# Define the "/area" endpoint returning the same averages as the "/"
+# endpoint, calculated with the data of all the stations of a city, a
+# department or a region (read from the rollups maintained at ingestion).
+@app.get("/area", response_model=averageConcentrations)
+async def get_area_response(
+    level: Annotated[
+        Literal["city", "department", "region"],
+        Query(
+            alias="l",
+            description="Level of the area in the geographic hierarchy.")],
+    area: Annotated[
+        str,
+        Query(
+            alias="a",
+            description=(
+                "Name of the city, department or region (as given by\
+                 the 'cities', 'departments' and 'regions' collections)."))],
+    pollutant: Annotated[
+        str,
+        Query(
+            alias="p",
+            description=(
+                "Pollutant whose average daily variation of air\
+                 concentration we want to display."))],
+    n_days: Annotated[
+        int,
+        Query(
+            alias="n",
+            description=(
+                "Parameter telling the API that we are interested in\
+                 pollution data recorded over the 'n_days' last days."),
+            ge=0)]):
+    if n_days not in range(RETENTION_DAYS+1):
+        raise HTTPException(status_code=400, detail="Number of days too high!")
+
+    async def compute_values():
+        values = await storage.async_get_area_values(
+            level, area, pollutant, n_days)
+        # Notify an error when no station of the area records air
+        # concentration of the given pollutant.
+        if values is None:
+            raise HTTPException(
+                status_code=400,
+                detail="No data available for this area and pollutant!")
+        return values
+
+    working_days, weekends = await values_cache.get(
+        ("area", level, area, pollutant, n_days, await data_version()),
+        compute_values)
+    return {"working_days": working_days, "weekends": weekends}
+
+# Define the "/profiles" endpoint returning the averages of each hour by
+# day of the week, month and season (see function "format_profiles"),
+# calculated from the sums and counts maintained at ingestion over whole
+# months.
+@app.get("/profiles", response_model=profileConcentrations)
+async def get_profiles_response(
+    station: Annotated[
+        str,
+        Query(
+            alias="s",
+            description=(
+                "Code identifying the air quality monitoring station\
+                 whose data we are interested in."),
+            pattern="^FR([0-9]{5}$)")],
+    pollutant: Annotated[
+        str,
+        Query(
+            alias="p",
+            description=(
+                "Pollutant whose average daily variation of air\
+                 concentration we want to display."))],
+    n_months: Annotated[
+        int | None,
+        Query(
+            alias="m",
+            description=(
+                "Number of last months (including the current one) whose\
+                 pollution data are used (all the stored months by default)."),
+            ge=1)] = None):
+    if station not in LCSQA_stations:
+        raise HTTPException(
+            status_code=400,
+            detail="This station does not exist!")
+    DATE = date.today()
+    # Months beyond the retention window hold no data: asking for more
+    # months than it spans amounts to asking for all the stored ones.
+    first_month = DATE-timedelta(days=RETENTION_DAYS)
+    stored_months = (DATE.year-first_month.year)*12+DATE.month-first_month.month+1
+    if n_months is not None and n_months < stored_months:
+        months = DATE.year*12+DATE.month-n_months
+        first_month = date(months//12, months%12+1, 1)
+
+    async def compute_profiles():
+        if not(await storage.async_is_monitored_by(pollutant, station)):
+            raise HTTPException(
+                status_code=400,
+                detail="Pollutant not available!")
+        return format_profiles(await storage.async_get_profiles(
+            station, pollutant, first_month))
+
+    return await values_cache.get(
+        ("profiles", station, pollutant, first_month.replace(day=1),
+         await data_version()),
+        compute_profiles)
+
+# Define the "/plot" endpoint returning the chart of the values of the
+# "/" endpoint (see module "plots"), as a PNG or SVG image.
+@app.get(
+    "/plot",
+    response_class=Response,
+    responses={200: {"content": {e: {} for e in plots.MEDIA_TYPES.values()}}})
+async def get_plot_response(
+    station: Annotated[
+        str,
+        Query(
+            alias="s",
+            description=(
+                "Code identifying the air quality monitoring station\
+                 whose data we are interested in."),
+            pattern="^FR([0-9]{5}$)")],
+    pollutant: Annotated[
+        str,
+        Query(
+            alias="p",
+            description=(
+                "Pollutant whose average daily variation of air\
+                 concentration we want to display."))],
+    n_days: Annotated[
+        int,
+        Query(
+            alias="n",
+            description=(
+                "Parameter telling the API that we are interested in\
+                 pollution data recorded over the 'n_days' last days."),
+            ge=0)],
+    stat: Annotated[
+        Literal["mean", "median", "p90", "p95"],
+        Query(description="Statistic plotted (see the '/' endpoint).")] = "mean",
+    image_format: Annotated[
+        Literal["png", "svg"],
+        Query(alias="f", description="Format of the image.")] = "png"):
+    # The values (and the errors) are those of the "/" endpoint.
+    values = await get_response(station, pollutant, n_days, stat)
+    values = [values["working_days"], values["weekends"]]
+    key = plots.image_key(station, pollutant, values, image_format, stat)
+    image = await images_cache.get(
+        key,
+        lambda: plots.render(station, pollutant, values, image_format, stat))
+    return Response(
+        image,
+        media_type=plots.MEDIA_TYPES[image_format],
+        headers={"ETag": '"'+key+'"'})
+
+# Define the "/stations" endpoint giving the catalogue of the stations
+# (location and recorded pollutants), from which the clients build the
+# choices of their users.
+@app.get("/stations", response_model=list[stationDescription])
+async def get_stations_response():
+    return await values_cache.get(
+        ("stations", await data_version()),
+        storage.async_get_stations)
@@ -0,0 +1,179 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Metrics of the application, rendered in the Prometheus text format by
+# the "/metrics" endpoint (see function "render"). They are kept in the
+# memory of the process, so the ingestion is only measured when it runs
+# in the API process (initial build and background updates).
+
+REGISTRY = []
+
+# Upper bounds (in seconds) of the buckets of the duration histograms.
+LATENCY_BUCKETS = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+INGESTION_BUCKETS = [
+    0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+
+def label_string(labels):
+    if not(labels):
+        return ""
+    return "{"+",".join(
+        name+'="'+str(value).replace("\\", "\\\\").replace('"', '\\"')+'"'
+        for name, value in labels)+"}"
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+class counterMetric():
+    '''
+    Metric whose values (one per combination of labels) only increase.
+    When "function" is given, the values are read from it instead (a
+    dictionary mapping tuples of label values to values, or a single
+    value when there is no label).
+    '''
+    kind = "counter"
+
+    def __init__(self, name, description, labels=(), function=None):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0)+value
+
+    def samples(self):
+        if self.function is None:
+            with self.lock:
+                values = dict(self.values)
+        else:
+            values = self.function()
+            if values is None:
+                return []
+            if not(isinstance(values, dict)):
+                values = {(): values}
+        return [
+            (self.name, list(zip(self.labels, key)), value)
+            for key, value in sorted(values.items())]
+
+class gaugeMetric(counterMetric):
+    '''
+    Metric whose values can go up and down.
+    '''
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+class histogramMetric(counterMetric):
+    '''
+    Metric counting observed values (typically durations) by bucket,
+    along with their sum and number.
+    '''
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = list(buckets)+[math.inf]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0]*len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total+value)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(e[0]), e[1]) for key, e in self.values.items()}
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            labels = list(zip(self.labels, key))
+            samples += [
+                (self.name+"_bucket", labels+[("le", format_value(bound))], count)
+                for bound, count in zip(self.buckets, counts)]
+            samples.append((self.name+"_sum", labels, total))
+            samples.append((self.name+"_count", labels, counts[-1]))
+        return samples
+
+def render():
+    '''
+    Return the text giving the current values of all the metrics, in
+    the Prometheus exposition format.
+    '''
+    lines = []
+    for metric in REGISTRY:
+        lines.append("# HELP "+metric.name+" "+metric.description)
+        lines.append("# TYPE "+metric.name+" "+metric.kind)
+        for name, labels, value in metric.samples():
+            lines.append(name+label_string(labels)+" "+format_value(value))
+    return "\n".join(lines)+"\n"
+
+request_seconds = histogramMetric(
+    "gary_request_duration_seconds",
+    "Time taken to answer the requests, by endpoint and status code.",
+    labels=("endpoint", "status"))
+
+ingestion_stage_seconds = histogramMetric(
+    "gary_ingestion_stage_duration_seconds",
+    "Time spent in each stage of the ingestion (download of one file, "
+    "parsing and filtering of one chunk, insertion of one batch, "
+    "aggregation of the stored records); downloads run concurrently.",
+    labels=("stage",),
+    buckets=INGESTION_BUCKETS)
+
+ingestion_seconds = histogramMetric(
+    "gary_ingestion_duration_seconds",
+    "Total time taken to build (create) or update the database.",
+    labels=("operation",),
+    buckets=INGESTION_BUCKETS)
+
+rows_ingested = counterMetric(
+    "gary_rows_ingested_total",
+    "Records of the daily files stored in the database.")
+
+rows_rejected = counterMetric(
+    "gary_rows_rejected_total",
+    "Rows of the daily files left out, by reason (not validated, "
+    "negative or zero value, pollutant not of interest).",
+    labels=("reason",))
+
+@contextmanager
+def stage(name):
+    '''
+    Record the time spent in the block as stage "name" of the ingestion.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        ingestion_stage_seconds.observe(time.perf_counter()-start, stage=name)
+
+def timed(iterable, name):
+    '''
+    Yield the items of "iterable", recording the time taken to produce
+    each of them as stage "name" of the ingestion.
+    '''
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        ingestion_stage_seconds.observe(time.perf_counter()-start, stage=name)
+        yield item
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import date
+from urllib.parse import unquote, urlparse
+
+from .config import MIRROR_DIR, OFFLINE_DIR
+
+# The mirror is made of two directories:
+#   - "objects", storing the content of the files under the name of
+#     their SHA-256 hash (identical files are only stored once),
+#   - "urls", storing for each downloaded url a small "json" file giving
+#     the hash of its last known content along with the "ETag" and
+#     "Last-Modified" headers needed to revalidate it, and the date when
+#     it was last validated (downloaded, or confirmed by the server).
+# The copies of the urls no longer needed are removed by "prune".
+
+def _write_atomically(path, content):
+    '''
+    Write "content" (bytes) to "path" so that concurrent readers (other
+    threads or processes) never see a partially written file.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path+"."+str(os.getpid())+".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def _entry_path(url):
+    return os.path.join(
+        MIRROR_DIR, "urls", hashlib.sha256(url.encode()).hexdigest()+".json")
+
+def _object_path(digest):
+    return os.path.join(MIRROR_DIR, "objects", digest[:2], digest)
+
+def get_entry(url):
+    '''
+    Return the dictionary describing the mirrored copy of "url",
+    or None if the url has never been downloaded.
+    '''
+    try:
+        with open(_entry_path(url)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def lookup(url, validated_since=None):
+    '''
+    Return the path of the mirrored copy of "url", or None if there is
+    none (or if it was last validated before the date "validated_since",
+    when given).
+    '''
+    entry = get_entry(url)
+    if entry is None:
+        return None
+    if validated_since is not None and \
+    entry.get("validated", "") < validated_since.isoformat():
+        return None
+    path = _object_path(entry["sha256"])
+    return path if os.path.isfile(path) else None
+
+def validators(url):
+    '''
+    Return the headers making the request for "url" conditional
+    (the server then answers "304 Not Modified" if the mirrored
+    copy is still up to date).
+    '''
+    entry = get_entry(url)
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+def store(url, response, chunk_size=1<<20):
+    '''
+    Save the content of "response" (a "requests" response to a
+    request sent to "url" with "stream=True") in the mirror, writing
+    it as it is received ("chunk_size" bytes at a time) so that the file
+    is never held in memory, and return the path of the mirrored copy.
+    '''
+    directory = os.path.join(MIRROR_DIR, "objects")
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, str(os.getpid())+"."+
+                            str(threading.get_ident())+".tmp")
+    sha256 = hashlib.sha256()
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size):
+                sha256.update(chunk)
+                f.write(chunk)
+        digest = sha256.hexdigest()
+        os.makedirs(os.path.dirname(_object_path(digest)), exist_ok=True)
+        os.replace(tmp_path, _object_path(digest))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    entry = {
+        "url": url,
+        "sha256": digest,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "validated": date.today().isoformat()}
+    _write_atomically(_entry_path(url), json.dumps(entry).encode())
+    return _object_path(digest)
+
+def revalidated(url):
+    '''
+    Record that the mirrored copy of "url" has been confirmed as up to
+    date by the server today.
+    '''
+    entry = get_entry(url)
+    if entry is not None:
+        entry["validated"] = date.today().isoformat()
+        _write_atomically(_entry_path(url), json.dumps(entry).encode())
+
+def prune(expired, grace=3600):
+    '''
+    Remove the mirrored copies of the urls for which function "expired"
+    returns True, then the contents no longer referenced by any url
+    (but those written less than "grace" seconds ago, which may be
+    about to be referenced). Files removed meanwhile by another process
+    are ignored.
+    '''
+    referenced = set()
+    directory = os.path.join(MIRROR_DIR, "urls")
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        if not(name.endswith(".json")):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if expired(entry["url"]):
+                os.remove(path)
+            else:
+                referenced.add(entry["sha256"])
+        except (FileNotFoundError, ValueError):
+            continue
+    oldest = time.time()-grace
+    directory = os.path.join(MIRROR_DIR, "objects")
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                if name not in referenced and os.path.getmtime(path) < oldest:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+
+def read_offline(url):
+    '''
+    Return the path of a local copy of "url", without using the network:
+    the file bearing the same name in "OFFLINE_DIR" if it exists,
+    otherwise the mirrored copy (None if there is none).
+    '''
+    name = os.path.basename(unquote(urlparse(url).path))
+    path = os.path.join(OFFLINE_DIR, name)
+    if os.path.isfile(path):
+        return path
+    return lookup(url)
@@ -0,0 +1,158 @@
+import logging
+from io import BytesIO
+
+from pandas import DataFrame, read_csv, read_excel, to_datetime
+
+from . import metrics
+from .config import CHUNK_ROWS, CSV_ENGINE
+from .constants import FRENCH_DEPARTMENTS
+
+# Columns of the daily "FR_E2" files used by the application, along
+# with the type they are read as (the other columns are never parsed).
+COLUMNS = {
+    "Date de début": "string",
+    "code site": "string",
+    "Polluant": "string",
+    "valeur brute": "float64",
+    "validité": "float64"}
+
+DATE_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+IGNORED_POLLUTANTS = ["NO","NOX as NO2","C6H6"]
+
+logger = logging.getLogger(__name__)
+
+if CSV_ENGINE != "c" and CHUNK_ROWS:
+    logger.warning(
+        "GARY_CSV_ENGINE=%s is ignored since the files are read by chunks "
+        "of %d rows with the \"c\" parser (set GARY_CHUNK_ROWS=0 to use it)",
+        CSV_ENGINE, CHUNK_ROWS)
+
+def has_columns(header):
+    '''
+    Test whether the header line (bytes) of a "FR_E2" file contains all
+    the useful columns (server errors may occur, making data unavailable).
+    '''
+    names = header.decode("utf-8-sig").strip().split(";")
+    return set(COLUMNS) <= set(names)
+
+def read_daily_file(content, engine=CSV_ENGINE):
+    '''
+    Parse the content of a daily "FR_E2" file and return a dataframe
+    made of the useful columns only, or None when some of them are
+    missing.
+
+    Arguments:
+    content -- bytes of the "csv" file.
+    engine -- name of the parser used by pandas ("c" or "pyarrow").
+    '''
+    # Read the header first, as the pyarrow parser does not allow
+    # selecting columns which may be absent.
+    if not(has_columns(content[:content.find(b"\n")])):
+        return None
+    return read_csv(
+        BytesIO(content),
+        sep=";",
+        usecols=list(COLUMNS),
+        dtype=COLUMNS,
+        engine=engine)
+
+def read_chunks(source, chunksize=CHUNK_ROWS, engine=CSV_ENGINE):
+    '''
+    Parse a "FR_E2" file and yield dataframes made of the useful columns
+    of at most "chunksize" rows (nothing is yielded when some columns are
+    missing), so that only one chunk of the file is held in memory at a
+    time when it is read from disk.
+
+    Arguments:
+    source -- bytes of the "csv" file, or path of the file.
+    chunksize -- number of rows of each dataframe (0 to read the whole
+                 file at once).
+    engine -- name of the parser used by pandas when the whole file is
+              read at once (the pyarrow parser cannot read by chunks).
+    '''
+    if not(chunksize):
+        if not(isinstance(source, bytes)):
+            with open(source, "rb") as f:
+                source = f.read()
+        data = read_daily_file(source, engine)
+        if data is not None:
+            yield data
+        return
+    f = BytesIO(source) if isinstance(source, bytes) else open(source, "rb")
+    with f:
+        if not(has_columns(f.readline())):
+            return
+        f.seek(0)
+        yield from read_csv(
+            f,
+            sep=";",
+            usecols=list(COLUMNS),
+            dtype=COLUMNS,
+            chunksize=chunksize)
+
+def prepare_data(data):
+    '''
+    Keep the validated, positive concentration values of the pollutants
+    of interest and return them along with the station, the pollutant,
+    the date and hour of the record and a boolean flag telling whether
+    it was recorded on a working day.
+    '''
+    # Extract rows with validated data, with consistent concentration
+    # value (bugs during the recording process may generate negative
+    # values) and with pollutants of interest.
+    valid = data["validité"]==1
+    positive = data["valeur brute"]>0
+    monitored = ~(data["Polluant"].isin(IGNORED_POLLUTANTS))
+    metrics.rows_rejected.inc(int((~valid).sum()), reason="validity")
+    metrics.rows_rejected.inc(int((valid & ~positive).sum()), reason="negative")
+    metrics.rows_rejected.inc(
+        int((valid & positive & ~monitored).sum()), reason="pollutant")
+    data = data[valid & positive & monitored]
+    dateTime = to_datetime(data["Date de début"], format=DATE_FORMAT)
+    return DataFrame({
+        "code site": data["code site"],
+        "Polluant": data["Polluant"],
+        "hour": dateTime.dt.hour,
+        "valeur brute": data["valeur brute"],
+        "dateTime": dateTime,
+        "working_days": dateTime.dt.weekday < 5})
+
+def read_locations(source):
+    '''
+    Parse the spreadsheet (bytes, or path of the file) giving the
+    location of the LCSQA stations and return the region, department,
+    city, name and code of each station.
+    '''
+    # Import file giving location of LCSQA stations.
+    data = read_excel(
+        BytesIO(source) if isinstance(source, bytes) else source,
+        sheet_name=1)
+    # Rearrange and clean the data.
+    c = data.columns.tolist()
+    columns_to_remove = c[3:7]+c[10:]
+    labels = data.iloc[1].tolist()
+    labels_to_keep = labels[:3]+labels[7:10]
+    data = data.drop(
+        columns=columns_to_remove
+    ).drop(
+        [0,1]
+    ).set_axis(
+        labels_to_keep,
+        axis="columns")
+    # Define a function "get_department" to retrieve names of French
+    # departments using postal codes of french cities.
+    get_department = lambda x: (
+        FRENCH_DEPARTMENTS[x[:2]] if not(x[1].isdigit()) or int(x[:2]) < 97
+        else FRENCH_DEPARTMENTS[x[:3]]
+    )
+    # Add a new column "Département" using "get_department".
+    data["Département"] = data["Code commune"].apply(
+        get_department)
+    # Keep only columns with useful informations.
+    return data[
+        ["Région",
+        "Département",
+        "Commune",
+        "Nom station",
+        "Code station"]]
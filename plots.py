@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .config import PLOT_WORKERS
+from .constants import POLLUTANT_NAMES, WHO_RECOMMENDATION
+
+# Server-side rendering of the chart of the "run_shell" client (see
+# function "plot_variation" there), so that the clients of the "/plot"
+# endpoint need no plotting library. The charts are drawn with the Agg
+# backend of matplotlib (imported by the rendering processes only) in a
+# pool of "PLOT_WORKERS" processes, so that rendering neither blocks the
+# event loop nor competes with it for the GIL.
+
+MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+# Words of the title describing the statistic of the values.
+STATISTICS = {
+    "mean": "Average",
+    "median": "Median",
+    "p90": "90th percentile of the",
+    "p95": "95th percentile of the"}
+
+pool = None
+
+def get_pool():
+    '''
+    Return the pool of rendering processes, started on first use (the
+    processes are spawned rather than forked, since the API process
+    runs threads and database clients).
+    '''
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(
+            PLOT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return pool
+
+def shutdown():
+    global pool
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+        pool = None
+
+def image_key(station, pollutant, values, image_format, stat):
+    '''
+    Return the hash identifying the image of "values" rendered with the
+    given parameters (the same values always giving the same image).
+    '''
+    return hashlib.sha256(json.dumps(
+        [station, pollutant, stat, image_format, values]).encode()).hexdigest()
+
+def render_variation(station, pollutant, values, image_format="png", stat="mean"):
+    '''
+    Return the bytes of the image (in "image_format", "png" or "svg")
+    showing the 24 hourly values of working days and week-end days given
+    by "values" for "pollutant" at "station", over colored zones set by
+    the WHO recommendation when there is one.
+    '''
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(17,14))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    x = [str(x)+"h00" for x in range(24)]
+    colors = ("dodgerblue","cyan")
+    labels = ("Working days","Week-end")
+    markers = ("o","s")
+    # Plot each type of day using either a continuous line (if all the
+    # 24 values are different from zero) or points.
+    for i in range(2):
+        if all(values[i]):
+            ax.plot(x, values[i], c=colors[i], label=labels[i])
+        else:
+            ax.scatter(x, values[i], marker=markers[i], c=colors[i], label=labels[i])
+    highest_value = max(max(values[0]), max(values[1]))
+    if pollutant in WHO_RECOMMENDATION:
+        # Compute four threshold values based on the corresponding WHO
+        # recommendation, splitting the graph into colored zones.
+        thresholds = [
+            (x/3)*WHO_RECOMMENDATION[pollutant]
+            for x in range(1,5)]
+        ax.plot(
+            range(24),
+            [thresholds[2]]*24,
+            color="blueviolet",
+            ls="--",
+            lw=1.7,
+            label="Average daily air\nconcentration\nrecommended by WHO")
+        # Determine the maximum value of the Y-axis so that the values
+        # stay readable.
+        max_level = 2
+        while max_level < 3 and thresholds[max_level] < highest_value:
+            max_level += 1
+        space = (0.40)*thresholds[0]
+        lim = thresholds[max_level] if max_level == 2 else highest_value
+        ax.set_ylim(0, lim+(space if max_level == 2 else 0))
+        zone_colors = ["limegreen","yellow","orange","red"]
+        y_min = 0
+        for j in range(max_level+1):
+            ax.fill_between(
+                list(range(24)),
+                thresholds[j],
+                y2=y_min,
+                color=zone_colors[j],
+                alpha=0.1)
+            y_min = thresholds[j]
+        # Add a fifth zone if one or several values are above the
+        # highest threshold.
+        if highest_value > thresholds[max_level]:
+            ax.fill_between(
+                list(range(24)),
+                ax.get_ylim()[1],
+                y2=thresholds[max_level],
+                color="magenta",
+                alpha=0.1)
+        ax.set_yticks([0])
+        ax.set_yticklabels([" "])
+    ax.legend(loc="upper right")
+    ax.set_title(
+        STATISTICS[stat]+" daily "+POLLUTANT_NAMES.get(pollutant, pollutant)+
+        " pollution\nrecorded at :\n"+station,
+        ha="center")
+    image = io.BytesIO()
+    fig.savefig(image, format=image_format)
+    return image.getvalue()
+
+async def render(station, pollutant, values, image_format="png", stat="mean"):
+    '''
+    Run function "render_variation" in the pool of rendering processes.
+    A pool broken by the abrupt end of one of its processes (killed for
+    lack of memory for instance) is replaced and the rendering is tried
+    once more.
+    '''
+    arguments = (station, pollutant, values, image_format, stat)
+    used_pool = get_pool()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            used_pool, render_variation, *arguments)
+    except BrokenProcessPool:
+        # The renderings failing at the same time must not shut down
+        # the pool already replaced by the first of them.
+        if pool is used_pool:
+            shutdown()
+        return await asyncio.get_running_loop().run_in_executor(
+            get_pool(), render_variation, *arguments)
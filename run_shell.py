@@ -1,10 +1,9 @@
+import os
 import subprocess
 import time
-from datetime import date, datetime, timedelta
 
 import requests
 from matplotlib import pyplot
-from pymongo import MongoClient
 
 overseas_departments = [
     "GUADELOUPE",
@@ -31,44 +30,72 @@ WHO_recommendation = {
     )
 }
 
-mongoClient = MongoClient("mongodb://localhost:8001")
-database = mongoClient["air_quality"]
+# Address of the API (whatever the storage of its pollution data).
+API_URL = os.environ.get("GARY_API_URL", "http://127.0.0.1:8000")
+
+# Catalogue of the stations given by the "/stations" endpoint of the API
+# (see function "load_catalogue").
+catalogue = []
+
+def load_catalogue():
+    '''
+    Retrieve the catalogue of the stations from the API, displaying a
+    message to the user while the API is not started yet (the database
+    may still be being initialized).
+    '''
+    i = 0
+    while not(catalogue):
+        try:
+            response = requests.get(API_URL+"/stations")
+            response.raise_for_status()
+            catalogue.extend(response.json())
+        except requests.RequestException:
+            if i == 4:
+                i = 0
+            print(
+                " Sorry, the initialization of the database\nis not complete"+
+                ("    " if not(i) else "."*i),
+                end="\r")
+            i += 1
+            time.sleep(0.7)
 
 def get_items(about, query_filter):
     '''
-    Query the "air_quality" database to retrieve the items
+    Search the catalogue of the stations to retrieve the items
     representing the available choices proposed to the user.
 
     Arguments:
-    about -- string determining the name of the collection
-             to query within the database.
-    query_filter -- dictionary used as filter for the query.
+    about -- string determining the kind of the items.
+    query_filter -- dictionary giving the item chosen at the previous
+                    step ("_id").
     '''
-    # Query the appropriate collection and store the retrieved
-    # elements in a list "items".
+    # Select the appropriate elements of the catalogue and store them
+    # in a list "items".
     match about:
         case "regions":
-            items = database["regions"].find().distinct("_id")
-            for e in overseas_departments:
-                items.remove(e)
+            items = list(
+                {e["region"] for e in catalogue}-set(overseas_departments))
         case "departments":
             if query_filter["_id"] == "OUTRE-MER":
                 items = overseas_departments
             else:
-                items = list(set(database["regions"].find_one(
-                    query_filter)["departments"]))
+                items = list({
+                    e["department"] for e in catalogue
+                    if e["region"] == query_filter["_id"]})
         case "cities":
-            items = list(set(database["departments"].find_one(
-                query_filter)["cities"]))
+            # The overseas regions are proposed as departments.
+            items = list({
+                e["city"] for e in catalogue
+                if query_filter["_id"] in (e["department"], e["region"])})
         case "stations":
-            list_of_stations = database["cities"].find_one(
-                query_filter)["stations"]
-            items = list(set([
-                e["name"]+"#"+e["code"]
-                for e in list_of_stations]))
+            items = list({
+                e["name"]+"#"+e["code"] for e in catalogue
+                if e["city"] == query_filter["_id"]})
         case "pollutants":
-            items = list(set(database["distribution_pollutants"].find_one(
-                query_filter)["monitored_pollutants"]))
+            items = [
+                pollutant for e in catalogue
+                if e["code"] == query_filter["_id"]
+                for pollutant in e["pollutants"]]
     # Build the "listed_items" list giving the ordered set of the retrieved
     # items along with their corresponding position.
     listed_items = list(zip(sorted(items), range(1,len(items)+1)))
@@ -77,7 +104,11 @@ def get_items(about, query_filter):
     return listed_items
 
 
-all_the_stations = database["distribution_pollutants"].distinct("_id")
+def has_data(code):
+    '''
+    Test whether pollution data are recorded by the station "code".
+    '''
+    return any(e["pollutants"] for e in catalogue if e["code"] == code)
 
 def is_number(string):
     '''
@@ -137,7 +168,7 @@ def get_input(about, items, shorter_period=False, first_choice=False):
         # Check avaibility of pollution data recorded by the chosen station.
         if number < n and about == "stations":
             item = items[number-1][0]
-            station_found = item[item.index("#")+1:] in all_the_stations
+            station_found = has_data(item[item.index("#")+1:])
             if not(station_found):
                 print("Sorry, no data available for this station.\n")
                 return None
@@ -182,7 +213,7 @@ class userChoices():
         elif current_step != "n_days":
             items = get_items(
                 current_step,
-                search_filter=self.current_filter)
+                query_filter=self.current_filter)
         # No items listed at the last step.
         else:
             items = []
@@ -332,32 +363,8 @@ def main():
     
     # Display a message to the user if the initialization process
     # of the pollution data is still running.
-    i = 0
-    while "last_update" not in database.list_collection_names():
-        if i == 4:
-            i = 0
-        print(
-            " Sorry, the initialization of the database\nis not complete"+
-            ("    " if not(i) else "."*i),
-            end="\r")
-        i += 1
-        time.sleep(0.7)
+    load_catalogue()
 
-    DATE = date.today() - timedelta(days=1)
-    DATETIME = datetime(DATE.year, DATE.month, DATE.day)
-    # If some pollution days are missing from the database, send a special
-    # request (with a pollution period of "zero day") to allow the server to
-    # perform an update of the data.
-    if database["last_update"].find_one()["date"] != DATETIME:
-        dictionary = database["distribution_pollutants"].find_one()
-        parameters = {
-            "s": dictionary["_id"],
-            "p": dictionary["monitored_pollutants"][0],
-            "n": "0"}
-        _ = requests.get(
-            "http://127.0.0.1:8000",
-            params=parameters,
-            verify=False)
     # Start the process of interacting with the user to get the query parameters
     # corresponding to his choices.
     process = userChoices()
@@ -366,19 +373,19 @@ def main():
         process.next_step()
     # Send the given query parameters to the endpoint.
     response = requests.get(
-        "http://127.0.0.1:8000",
+        API_URL,
         params=process.query_parameters,
-        verify=False).json()
+        verify=False)
     # If an error occured, indicate the cause to the user.
     if response.status_code != 200:
-        print("\n"+response["detail"])
+        print("\n"+str(response.json()["detail"]))
     # If not, generate the expected data visualization using
     # the values provided by the response.
     else:
         plot_variation(
             process.query_parameters["station_name"],
             process.query_parameters["p"],
-            response["values"])
+            [response.json()["working_days"], response.json()["weekends"]])
         subprocess.run(["xdg-open","image.png"])
 
 if __name__=="__main__":
@@ -0,0 +1,39 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+
+from .config import UPDATE_INTERVAL
+from .download import prune_mirror
+
+logger = logging.getLogger(__name__)
+
+# Identifier of the current process in the lock of the updates.
+OWNER = socket.gethostname()+":"+str(os.getpid())+":"+uuid.uuid4().hex[:8]
+
+async def run_updates(storage, interval=UPDATE_INTERVAL, on_update=None):
+    '''
+    Check every "interval" seconds whether some pollution days are
+    missing from the database and, if so, add them (among all the
+    processes running this task, only one performs the update), then
+    remove the files leaving the retention window from the mirror.
+
+    Arguments:
+    storage -- storage of the pollution data (see module "storage").
+    interval -- time (in seconds) between two checks.
+    on_update -- function called after each update performed by the
+                 current process.
+    '''
+    while True:
+        try:
+            if not(await storage.async_history_is_updated(refresh=True)):
+                if await storage.async_update(OWNER) and on_update is not None:
+                    on_update()
+            await asyncio.to_thread(prune_mirror)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Keep the task alive: the update is tried again later.
+            logger.exception("Update of the database failed")
+        await asyncio.sleep(interval)
@@ -0,0 +1,71 @@
+import math
+
+import numpy
+
+# Mergeable quantile sketches of the concentrations, in the manner of
+# DDSketch: the positive values are counted in logarithmic bins, bin "i"
+# holding the values between GAMMA**(i-1) and GAMMA**i, so that any
+# quantile is given with a relative error of at most "ACCURACY". Merging
+# sketches (those of several days, for instance) only requires adding up
+# the counts of the same bins, whatever the number of merged values.
+#
+# The bin of each value is calculated once at ingestion and stored next
+# to it (see "crud.history_pipeline" and the "records" table of module
+# "sqlite_storage"), each stored value being the sketch of its day. The
+# stored bins must therefore be recomputed (by rebuilding the storage)
+# whenever "ACCURACY" changes.
+
+ACCURACY = 0.01
+
+GAMMA = (1+ACCURACY)/(1-ACCURACY)
+
+LN_GAMMA = math.log(GAMMA)
+
+# Statistics which can be requested from the API instead of the mean,
+# along with the corresponding quantile.
+QUANTILES = {"median": 0.5, "p90": 0.9, "p95": 0.95}
+
+def bin_index(values):
+    '''
+    Return the bins of the (positive) "values", a numpy array.
+    '''
+    return numpy.ceil(numpy.log(values)/LN_GAMMA).astype("int64")
+
+def bin_value(index):
+    '''
+    Return the value representing bin "index" (the one whose relative
+    distance to both bounds of the bin is "ACCURACY").
+    '''
+    return 2*GAMMA**index/(GAMMA+1)
+
+def quantile(counts, q):
+    '''
+    Return the "q" quantile of the sketch "counts" (dictionary mapping
+    bins to their numbers of values), or 0 if it is empty.
+    '''
+    total = sum(counts.values())
+    if not(total):
+        return float(0)
+    # Rank of the quantile among the sorted values (starting from 0).
+    rank = q*(total-1)
+    seen = 0
+    for index in sorted(counts):
+        seen += counts[index]
+        if seen > rank:
+            return bin_value(index)
+
+def format_quantiles(documents, q):
+    '''
+    Turn the documents giving the number of values ("count") of a type
+    of day, an hour and a bin into the lists of the "q" quantiles of the
+    24 hours of working days and week-end days (the hours without any
+    data keep a zero value), as "storage.format_values" does with
+    averages.
+    '''
+    sketches = {"working_days": {}, "weekends": {}}
+    for document in documents:
+        counts = sketches[document["day_type"]].setdefault(document["hour"], {})
+        counts[document["bin"]] = counts.get(document["bin"], 0)+document["count"]
+    return tuple(
+        [quantile(sketches[day_type].get(hour, {}), q) for hour in range(24)]
+        for day_type in ["working_days","weekends"])
@@ -0,0 +1,423 @@
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from pandas import read_sql
+
+from . import metrics
+from .config import \
+CHUNK_ROWS, INITIAL_DAYS, REBUILD, RETENTION_DAYS, STATIONS_URL
+from .download import MISSING, fetch, fetch_daily_files
+from .parsing import prepare_data, read_chunks, read_locations
+from .sketch import bin_index, format_quantiles
+from .storage import \
+first_stored_date, format_batch, format_values, last_stored_date, \
+storageBackend
+
+# Embedded storage of the pollution data in a single SQLite file, for the
+# deployments running on a single node (no database server to run, and
+# no network hop between the API and its data). The averages are
+# calculated when they are requested, from one row per value:
+#   - "stations": location of every LCSQA station (catalogue),
+#   - "monitored": pollutants whose concentration is recorded by each
+#     station,
+#   - "records": value recorded by a station for a pollutant, a day
+#     (number of days since 1970-01-01) and an hour, along with its bin
+#     (see module "sketch"), stored in the order of its primary key, so
+#     that the period of a (station, pollutant) pair is read with a
+#     single range scan,
+#   - "profiles": sum and number of the values of each station, pollutant,
+#     month (its first day), day of the week (from 0 for monday to 6) and
+#     hour, incremented by each ingestion,
+#   - "metadata": version of the layout and date of the last update.
+
+# Version of the layout of the tables (to be incremented whenever it
+# changes, so that the files built by former versions get rebuilt).
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE stations (
+    code TEXT PRIMARY KEY,
+    name TEXT,
+    city TEXT,
+    department TEXT,
+    region TEXT);
+CREATE INDEX stations_city ON stations (city);
+CREATE INDEX stations_department ON stations (department);
+CREATE INDEX stations_region ON stations (region);
+CREATE TABLE monitored (
+    station TEXT,
+    pollutant TEXT,
+    PRIMARY KEY (station, pollutant)) WITHOUT ROWID;
+CREATE TABLE records (
+    station TEXT,
+    pollutant TEXT,
+    day INTEGER,
+    hour INTEGER,
+    working_day INTEGER,
+    value REAL,
+    bin INTEGER,
+    PRIMARY KEY (station, pollutant, day, hour)) WITHOUT ROWID;
+CREATE INDEX records_day ON records (day);
+CREATE TABLE profiles (
+    station TEXT,
+    pollutant TEXT,
+    month TEXT,
+    weekday INTEGER,
+    hour INTEGER,
+    sum REAL,
+    count INTEGER,
+    PRIMARY KEY (station, pollutant, month, weekday, hour)) WITHOUT ROWID;
+CREATE TABLE metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT);
+"""
+
+# Columns of table "stations" naming the areas of each level of the
+# geographic hierarchy (see "crud.AREA_LEVELS").
+AREA_COLUMNS = {"city": "city", "department": "department", "region": "region"}
+
+EPOCH = date(1970, 1, 1)
+
+def day_number(DATE):
+    return (DATE-EPOCH).days
+
+def averages_query(condition, by_pair=False):
+    '''
+    Return the query giving the average value of each type of day and
+    hour of the records meeting "condition" (the first parameter of the
+    query being the first day of the period), for each (station,
+    pollutant) pair if "by_pair" is True.
+    '''
+    keys = "station, pollutant, " if by_pair else ""
+    return (
+        "SELECT "+keys+"working_day, hour, AVG(value) FROM records "
+        "WHERE day >= ? AND ("+condition+") "
+        "GROUP BY "+keys+"working_day, hour")
+
+class sqliteBackend(storageBackend):
+    '''
+    Storage of the pollution data in the SQLite file "path" (see the
+    layout above). Each thread uses its own connection, and the file
+    is shared by the processes running on the same node.
+    '''
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Transactions are opened explicitly (see method "update").
+            connection = sqlite3.connect(self.path, isolation_level=None)
+            # Let the readers go on while the data are being updated.
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def is_ready(self):
+        try:
+            row = self.connection().execute(
+                "SELECT value FROM metadata WHERE key = 'version'").fetchone()
+        except sqlite3.OperationalError:
+            return False
+        return row is not None and int(row[0]) == SCHEMA_VERSION
+
+    def initialize(self, rebuild=REBUILD):
+        '''
+        See method "storageBackend.initialize". The processes sharing the
+        file take turns with a lock on the file "<path>.lock": those which
+        have to wait for it reuse the file initialized meanwhile, even
+        when "rebuild" is True.
+        '''
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path+".lock", "a") as f:
+            waited = False
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except BlockingIOError:
+                waited = True
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                super().initialize(rebuild and not(waited))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def store_locations(self):
+        data = read_locations(fetch(STATIONS_URL))
+        self.connection().executemany(
+            "INSERT OR REPLACE INTO stations VALUES (?, ?, ?, ?, ?)",
+            zip(data["Code station"], data["Nom station"], data["Commune"],
+                data["Département"], data["Région"]))
+
+    def store_file(self, source):
+        '''
+        Add the records of a "FR_E2" file (bytes, or path of the file),
+        replacing the values already stored for the same station,
+        pollutant, day and hour, and return their number.
+        '''
+        connection = self.connection()
+        n_records = 0
+        for data in metrics.timed(read_chunks(source), "parse"):
+            with metrics.stage("filter"):
+                data = prepare_data(data)
+                days = data["dateTime"].values.astype("datetime64[D]").astype("int64")
+                bins = bin_index(data["valeur brute"].to_numpy())
+            with metrics.stage("insert"):
+                connection.executemany(
+                    "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (station, pollutant, day, hour) "
+                    "DO UPDATE SET value = excluded.value, bin = excluded.bin",
+                    zip(data["code site"].tolist(),
+                        data["Polluant"].tolist(),
+                        days.tolist(),
+                        data["hour"].tolist(),
+                        data["working_days"].astype("int64").tolist(),
+                        data["valeur brute"].tolist(),
+                        bins.tolist()))
+                connection.executemany(
+                    "INSERT OR IGNORE INTO monitored VALUES (?, ?)",
+                    data[["code site","Polluant"]].drop_duplicates()
+                    .itertuples(index=False))
+            metrics.rows_ingested.inc(len(data))
+            n_records += len(data)
+        return n_records
+
+    def store_pollution_data(self, n_days):
+        '''
+        Add the records of the "n_days" last days (but those missing for
+        good), up to the first one whose file could not be downloaded,
+        and return the dates whose
+        records could not be stored (see "crud.store_pollution_data").
+        '''
+        dates = [date.today()-timedelta(days=n) for n in range(n_days, 0, -1)]
+        for DATE, path in fetch_daily_files(dates):
+            if path is None:
+                return dates[dates.index(DATE):]
+            if path is MISSING:
+                continue
+            self.store_file(path)
+        return []
+
+    def store_profiles(self, first_day, sign=1):
+        '''
+        Add the records of the days since "first_day" (a day number) to
+        the sums and counts of table "profiles", or subtract them if
+        "sign" is -1 (before the records of these days are replaced).
+        '''
+        # 1970-01-01 was a thursday.
+        self.connection().execute(
+            "INSERT INTO profiles "
+            "SELECT station, pollutant, "
+            "date(day*86400, 'unixepoch', 'start of month'), (day+3)%7, hour, "
+            "?*SUM(value), ?*COUNT(*) FROM records WHERE day >= ? "
+            "GROUP BY 1, 2, 3, 4, 5 "
+            "ON CONFLICT (station, pollutant, month, weekday, hour) "
+            "DO UPDATE SET sum = sum+excluded.sum, count = count+excluded.count",
+            (sign, sign, first_day))
+
+    def create(self):
+        '''
+        Build the tables from scratch, with the last "INITIAL_DAYS" days.
+        '''
+        start = time.perf_counter()
+        connection = self.connection()
+        for table in ["stations","monitored","records","profiles","metadata"]:
+            connection.execute("DROP TABLE IF EXISTS "+table)
+        connection.executescript(SCHEMA)
+        connection.execute("BEGIN")
+        self.store_locations()
+        missing = self.store_pollution_data(INITIAL_DAYS)
+        self.store_profiles(self.first_day(INITIAL_DAYS))
+        self.set_last_update(last_stored_date(missing))
+        # Record the layout version last, so that a file whose creation
+        # was interrupted is never considered as ready.
+        connection.execute(
+            "INSERT OR REPLACE INTO metadata VALUES ('version', ?)",
+            (str(SCHEMA_VERSION),))
+        connection.execute("COMMIT")
+        metrics.ingestion_seconds.observe(
+            time.perf_counter()-start, operation="create")
+
+    def update(self):
+        '''
+        Add the days recorded since the last update (within the last
+        "RETENTION_DAYS" days, storing again those which may not have
+        been final yet, see function "storage.first_stored_date") and
+        remove the records leaving the retention window (and the
+        profiles of the months preceding it), in a single transaction.
+        '''
+        start = time.perf_counter()
+        connection = self.connection()
+        # Writers of the other processes wait for the end of the
+        # transaction, after which the days are no longer missing.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            last_update = self.last_update()
+            DATE = date.today()
+            yesterday = datetime(DATE.year, DATE.month, DATE.day)-timedelta(days=1)
+            if last_update == yesterday:
+                connection.execute("ROLLBACK")
+                return False
+            oldest_date = DATE-timedelta(days=RETENTION_DAYS)
+            following_date = first_stored_date(last_update)
+            # The days already stored (the ones which were not final yet,
+            # or those of an update whose date has been set back since)
+            # are replaced, so they are taken out of the profiles and of
+            # the records before being added again.
+            self.store_profiles(day_number(following_date), -1)
+            connection.execute(
+                "DELETE FROM records WHERE day >= ?",
+                (day_number(following_date),))
+            missing = self.store_pollution_data((DATE-following_date).days)
+            self.store_profiles(day_number(following_date))
+            connection.execute(
+                "DELETE FROM records WHERE day < ?", (day_number(oldest_date),))
+            connection.execute(
+                "DELETE FROM profiles WHERE month < ?",
+                (oldest_date.replace(day=1).isoformat(),))
+            # The days which could not be downloaded are tried again by
+            # the next update.
+            self.set_last_update(last_stored_date(missing))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        metrics.ingestion_seconds.observe(
+            time.perf_counter()-start, operation="update")
+        return True
+
+    def last_update(self):
+        row = self.connection().execute(
+            "SELECT value FROM metadata WHERE key = 'last_update'").fetchone()
+        return datetime.fromisoformat(row[0])
+
+    def set_last_update(self, DATE):
+        self.connection().execute(
+            "INSERT OR REPLACE INTO metadata VALUES ('last_update', ?)",
+            (DATE.isoformat(),))
+
+    def iter_records(self, first_day):
+        yield from read_sql(
+            "SELECT station, pollutant, day, hour, value FROM records "
+            "WHERE day >= ?",
+            self.connection(),
+            params=(day_number(first_day),),
+            chunksize=CHUNK_ROWS)
+
+    def station_codes(self):
+        return {row[0] for row in self.connection().execute(
+            "SELECT code FROM stations")}
+
+    def is_monitored_by(self, pollutant, station):
+        return self.connection().execute(
+            "SELECT 1 FROM monitored WHERE station = ? AND pollutant = ?",
+            (station, pollutant)).fetchone() is not None
+
+    def get_stations(self):
+        connection = self.connection()
+        monitored = {}
+        for station, pollutant in connection.execute(
+            "SELECT station, pollutant FROM monitored ORDER BY 1, 2"):
+            monitored.setdefault(station, []).append(pollutant)
+        return [
+            {"code": code,
+             "name": name,
+             "city": city,
+             "department": department,
+             "region": region,
+             "pollutants": monitored.get(code, [])}
+            for code, name, city, department, region in connection.execute(
+                "SELECT code, name, city, department, region FROM stations "
+                "ORDER BY code")]
+
+    def first_day(self, n_days):
+        return day_number(date.today()-timedelta(days=n_days))
+
+    def get_values(self, station, pollutant, n_days):
+        if not(n_days):
+            return format_values([])
+        rows = self.connection().execute(
+            averages_query("station = ? AND pollutant = ?"),
+            (self.first_day(n_days), station, pollutant))
+        return format_values(
+            {"day_type": "working_days" if working_day else "weekends",
+             "hour": hour,
+             "average": average}
+            for working_day, hour, average in rows)
+
+    def get_batch_values(self, pairs, stations, n_days):
+        if not(n_days):
+            return format_batch([], pairs)
+        conditions = ["(station = ? AND pollutant = ?)"]*len(pairs)
+        parameters = [e for pair in pairs for e in pair]
+        if stations:
+            conditions.append(
+                "station IN ("+", ".join(["?"]*len(stations))+")")
+            parameters += list(stations)
+        rows = self.connection().execute(
+            averages_query(" OR ".join(conditions), by_pair=True),
+            [self.first_day(n_days)]+parameters)
+        return format_batch(
+            ({"day_type": "working_days" if working_day else "weekends",
+              "station": station,
+              "pollutant": pollutant,
+              "hour": hour,
+              "average": average}
+             for station, pollutant, working_day, hour, average in rows),
+            pairs)
+
+    def get_area_values(self, level, area, pollutant, n_days):
+        if not(n_days):
+            return format_values([])
+        # The values of all the stations of the area are averaged
+        # together, as in the rollups of the MongoDB storage.
+        rows = self.connection().execute(
+            averages_query(
+                "pollutant = ? AND station IN "
+                "(SELECT code FROM stations WHERE "+AREA_COLUMNS[level]+" = ?)"),
+            (self.first_day(n_days), pollutant, area)).fetchall()
+        if not(rows):
+            return None
+        return format_values(
+            {"day_type": "working_days" if working_day else "weekends",
+             "hour": hour,
+             "average": average}
+            for working_day, hour, average in rows)
+
+    def get_quantiles(self, station, pollutant, n_days, q):
+        if not(n_days):
+            return format_quantiles([], q)
+        rows = self.connection().execute(
+            "SELECT working_day, hour, bin, COUNT(*) FROM records "
+            "WHERE day >= ? AND station = ? AND pollutant = ? "
+            "GROUP BY working_day, hour, bin",
+            (self.first_day(n_days), station, pollutant))
+        return format_quantiles(
+            ({"day_type": "working_days" if working_day else "weekends",
+              "hour": hour,
+              "bin": bin,
+              "count": count}
+             for working_day, hour, bin, count in rows),
+            q)
+
+    def get_profiles(self, station, pollutant, first_month):
+        rows = self.connection().execute(
+            "SELECT month, weekday, hour, sum, count FROM profiles "
+            "WHERE station = ? AND pollutant = ? AND month >= ?",
+            (station, pollutant, first_month.replace(day=1).isoformat()))
+        return [
+            {"month": date.fromisoformat(month),
+             "weekday": weekday,
+             "hour": hour,
+             "sum": sum_,
+             "count": count}
+            for month, weekday, hour, sum_, count in rows]
@@ -0,0 +1,430 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from datetime import date, datetime, timedelta
+
+from .config import \
+FINAL_AFTER_DAYS, LAST_UPDATE_TTL, QUERY_ENGINE, REBUILD, RETENTION_DAYS, \
+SQLITE_PATH, STORAGE
+
+def format_values(documents):
+    '''
+    Turn the documents produced by the pipeline of "crud.values_pipeline"
+    (or by the queries of the other storages), giving the average of a
+    type of day and an hour, into the lists of 24 averages of working
+    days and week-end days (the hours without any data keep a zero
+    value).
+    '''
+    averages = {
+        "working_days": [float(0)]*24,
+        "weekends": [float(0)]*24}
+    for document in documents:
+        averages[document["day_type"]][document["hour"]] = \
+        float(document["average"])
+    return averages["working_days"], averages["weekends"]
+
+def format_batch(documents, pairs):
+    '''
+    Turn the documents produced by the pipeline of "crud.batch_pipeline"
+    (or by the queries of the other storages) into the list of the
+    (station, pollutant) pairs (the requested
+    ones first, in the same order, followed by the other ones found)
+    and the two matrices of averages of working days and week-end
+    days whose rows match the pairs (the hours without any data keep
+    a zero value).
+    '''
+    rows = {pair: ([float(0)]*24, [float(0)]*24) for pair in pairs}
+    for document in documents:
+        row = rows.setdefault(
+            (document["station"], document["pollutant"]),
+            ([float(0)]*24, [float(0)]*24))
+        i = 0 if document["day_type"] == "working_days" else 1
+        row[i][document["hour"]] = float(document["average"])
+    requested = set(pairs)
+    keys = list(pairs)+sorted(pair for pair in rows if pair not in requested)
+    return keys, [rows[k][0] for k in keys], [rows[k][1] for k in keys]
+
+# Meteorological seasons of the months (numbered from 1).
+SEASONS = {
+    "winter": [12, 1, 2],
+    "spring": [3, 4, 5],
+    "summer": [6, 7, 8],
+    "autumn": [9, 10, 11]}
+
+def profile_averages(entries, groups, n_rows):
+    '''
+    Return the "n_rows" lists of 24 averages obtained by adding up the
+    sums and counts of the "entries" of each hour, the row of an entry
+    being given by function "groups" (or None to leave it out).
+    '''
+    sums = [[float(0)]*24 for _ in range(n_rows)]
+    counts = [[0]*24 for _ in range(n_rows)]
+    for entry in entries:
+        row = groups(entry)
+        if row is not None:
+            sums[row][entry["hour"]] += entry["sum"]
+            counts[row][entry["hour"]] += entry["count"]
+    return [
+        [s/c if c else float(0) for s, c in zip(row_sums, row_counts)]
+        for row_sums, row_counts in zip(sums, counts)]
+
+def format_profiles(entries):
+    '''
+    Turn the entries returned by "storageBackend.get_profiles" into the
+    averages of each hour (0 when there is no data):
+        - "weekdays": of each day of the week (from monday),
+        - "months": of each month having data (keyed by "YYYY-MM"),
+        - "seasons": of each season of "SEASONS",
+        - "working_days" and "weekends": of working days and week-end
+          days, as returned by "get_values" for the same period.
+    '''
+    entries = list(entries)
+    months = sorted({entry["month"] for entry in entries})
+    seasons = {
+        month: i for i, numbers in enumerate(SEASONS.values())
+        for month in numbers}
+    working_days, weekends = profile_averages(
+        entries, lambda entry: int(entry["weekday"] >= 5), 2)
+    return {
+        "weekdays": profile_averages(entries, lambda entry: entry["weekday"], 7),
+        "months": dict(zip(
+            [month.strftime("%Y-%m") for month in months],
+            profile_averages(entries, lambda entry: months.index(entry["month"]),
+                             len(months)))),
+        "seasons": dict(zip(
+            SEASONS,
+            profile_averages(entries, lambda entry: seasons[entry["month"].month],
+                             len(SEASONS)))),
+        "working_days": working_days,
+        "weekends": weekends}
+
+def last_stored_date(missing):
+    '''
+    Return the date (a datetime) of the last day stored by an ingestion
+    which could not get the days of "missing" (the list of the dates
+    returned by "store_pollution_data"), that is the day before the
+    first missing one, or yesterday.
+    '''
+    DATE = missing[0] if missing else date.today()
+    return datetime(DATE.year, DATE.month, DATE.day)-timedelta(days=1)
+
+def first_stored_date(last_update):
+    '''
+    Return the first day (a date) stored by an update following the
+    storage of the days up to "last_update" (a datetime): the day after
+    it, preceded by the days which may not have been final yet when
+    stored (the last "FINAL_AFTER_DAYS"-1 ones, see module "download"),
+    whose files are revalidated and whose data are replaced, but never a
+    day out of the retention window.
+    '''
+    DATE = last_update.date()+timedelta(days=1)-\
+    timedelta(days=max(FINAL_AFTER_DAYS-1, 0))
+    return max(DATE, date.today()-timedelta(days=RETENTION_DAYS))
+
+class storageBackend(ABC):
+    '''
+    Operations of the application on the stored pollution data, whatever
+    the storage behind them:
+        - catalogue lookups ("station_codes", "is_monitored_by",
+          "get_stations"),
+        - ingestion writes ("create", building the storage from scratch
+          with the last "INITIAL_DAYS" days),
+        - update merge ("update", adding the days recorded since the
+          last update and dropping those leaving the retention window),
+        - window aggregation ("get_values", "get_batch_values" and
+          "get_area_values", whose results are shaped by functions
+          "format_values" and "format_batch", and "get_quantiles",
+          merging the quantile sketches of module "sketch"),
+        - profiles ("get_profiles", reading the sums and counts by
+          month, day of the week and hour maintained at ingestion).
+
+    Each storage implements the abstract methods, the other ones being
+    built on them. The asynchronous methods used by the API run the
+    synchronous ones in a separate thread, unless the storage has a
+    native asynchronous client.
+    '''
+    def __init__(self):
+        # Date of the last update, along with the time until which it
+        # can be used without querying the storage again.
+        self.last_update_cache = {"date": None, "expiry": float(0)}
+
+    @abstractmethod
+    def is_ready(self):
+        '''
+        Test whether the storage has been completely built with the
+        current layout (and can therefore be reused as it is).
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def create(self):
+        raise NotImplementedError
+
+    def initialize(self, rebuild=REBUILD):
+        '''
+        Build the storage, unless the existing one can be reused (the
+        missing pollution days are then added by the next update).
+        '''
+        if rebuild or not(self.is_ready()):
+            self.create()
+
+    @abstractmethod
+    def update(self):
+        '''
+        Add the days missing since the last update, and return False if
+        there were none (another process may have added them meanwhile).
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def last_update(self):
+        '''
+        Return the last day (a datetime) whose data are stored.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_last_update(self, DATE):
+        raise NotImplementedError
+
+    def revision(self):
+        '''
+        Return the number of backfills merged into the stored data (see
+        module "backfill"), which change them without changing the date
+        of the last update (always 0 for the storages which cannot be
+        backfilled).
+        '''
+        return 0
+
+    @abstractmethod
+    def iter_records(self, first_day):
+        '''
+        Yield the values recorded since "first_day" (a date) by dataframes
+        giving the station, pollutant, day (number of days since
+        1970-01-01), hour and value of each of them.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def station_codes(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_monitored_by(self, pollutant, station):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_stations(self):
+        '''
+        Return the list of the LCSQA stations (ordered by code), each
+        described by a dictionary giving its "code", "name", "city",
+        "department", "region" and the "pollutants" it records.
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_values(self, station, pollutant, n_days):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_batch_values(self, pairs, stations, n_days):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_area_values(self, level, area, pollutant, n_days):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_quantiles(self, station, pollutant, n_days, q):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_profiles(self, station, pollutant, first_month):
+        '''
+        Return the sums and counts of the values of "station" and
+        "pollutant" recorded since the month starting on "first_month"
+        (a date), as a list of dictionaries giving the first day of the
+        month ("month", a date), the day of the week ("weekday", from 0
+        for monday to 6), the hour, the sum and the count of each
+        combination having data (see function "format_profiles").
+        '''
+        raise NotImplementedError
+
+    async def async_last_update(self, refresh=False):
+        '''
+        Return the date of the last update (read from the storage at most
+        once every "LAST_UPDATE_TTL" seconds, unless "refresh" is True).
+        '''
+        cache = self.last_update_cache
+        if refresh or cache["expiry"] <= time.monotonic():
+            cache["date"] = await asyncio.to_thread(self.last_update)
+            cache["expiry"] = time.monotonic()+LAST_UPDATE_TTL
+        return cache["date"]
+
+    async def async_revision(self, refresh=False):
+        '''
+        Return the result of method "revision" (read from the storage
+        along with the date of the last update, see "async_last_update").
+        '''
+        return self.revision()
+
+    async def async_history_is_updated(self, refresh=False):
+        '''
+        Test whether the pollution data recorded up to yesterday are
+        stored.
+        '''
+        DATE = date.today()
+        return await self.async_last_update(refresh) == \
+        datetime(DATE.year, DATE.month, DATE.day) - timedelta(days=1)
+
+    async def async_update(self, owner):
+        '''
+        Run method "update" in a separate thread unless the data are
+        already up to date, and return True if new days were added.
+
+        Arguments:
+        owner -- string identifying the calling process.
+        '''
+        if await self.async_history_is_updated(refresh=True):
+            return False
+        updated = await asyncio.to_thread(self.update)
+        await self.async_last_update(refresh=True)
+        return updated
+
+    async def async_is_monitored_by(self, pollutant, station):
+        return await asyncio.to_thread(self.is_monitored_by, pollutant, station)
+
+    async def async_get_stations(self):
+        return await asyncio.to_thread(self.get_stations)
+
+    async def async_get_values(self, station, pollutant, n_days):
+        return await asyncio.to_thread(self.get_values, station, pollutant, n_days)
+
+    async def async_get_batch_values(self, pairs, stations, n_days):
+        return await asyncio.to_thread(
+            self.get_batch_values, pairs, stations, n_days)
+
+    async def async_get_area_values(self, level, area, pollutant, n_days):
+        return await asyncio.to_thread(
+            self.get_area_values, level, area, pollutant, n_days)
+
+    async def async_get_quantiles(self, station, pollutant, n_days, q):
+        return await asyncio.to_thread(
+            self.get_quantiles, station, pollutant, n_days, q)
+
+    async def async_get_profiles(self, station, pollutant, first_month):
+        return await asyncio.to_thread(
+            self.get_profiles, station, pollutant, first_month)
+
+class mongoBackend(storageBackend):
+    '''
+    Storage in the MongoDB database of the "crud" module (histories and
+    rollups maintained by aggregation pipelines), queried by the API
+    through the asynchronous client of the "async_crud" module.
+    '''
+    def __init__(self):
+        from . import async_crud, crud
+        self.crud = crud
+        self.async_crud = async_crud
+        self.last_update_cache = async_crud.last_update
+
+    def is_ready(self):
+        return self.crud.database_is_ready()
+
+    def create(self):
+        self.crud.create_database()
+
+    def initialize(self, rebuild=REBUILD):
+        self.crud.initialize_database(rebuild)
+
+    def update(self):
+        if self.crud.history_is_updated():
+            return False
+        self.crud.update_database()
+        return True
+
+    def last_update(self):
+        return self.crud.get_last_update()
+
+    def set_last_update(self, DATE):
+        self.crud.set_last_update(DATE)
+
+    def revision(self):
+        return self.crud.get_revision()
+
+    def iter_records(self, first_day):
+        return self.crud.get_records(
+            datetime(first_day.year, first_day.month, first_day.day))
+
+    def station_codes(self):
+        return self.crud.get_station_codes()
+
+    def is_monitored_by(self, pollutant, station):
+        return self.crud.is_monitored_by(pollutant, station)
+
+    def get_stations(self):
+        return self.crud.get_stations()
+
+    def get_values(self, station, pollutant, n_days):
+        return self.crud.get_values(station, pollutant, n_days)
+
+    def get_batch_values(self, pairs, stations, n_days):
+        return self.crud.get_batch_values(pairs, stations, n_days)
+
+    def get_area_values(self, level, area, pollutant, n_days):
+        return self.crud.get_area_values(level, area, pollutant, n_days)
+
+    def get_quantiles(self, station, pollutant, n_days, q):
+        return self.crud.get_quantiles(station, pollutant, n_days, q)
+
+    def get_profiles(self, station, pollutant, first_month):
+        return self.crud.get_profiles(station, pollutant, first_month)
+
+    async def async_last_update(self, refresh=False):
+        return await self.async_crud.get_last_update(refresh)
+
+    async def async_revision(self, refresh=False):
+        return await self.async_crud.get_revision(refresh)
+
+    async def async_history_is_updated(self, refresh=False):
+        return await self.async_crud.history_is_updated(refresh)
+
+    async def async_update(self, owner):
+        # The processes sharing the database take turns with a lock.
+        return await self.async_crud.update_database(owner)
+
+    async def async_is_monitored_by(self, pollutant, station):
+        return await self.async_crud.is_monitored_by(pollutant, station)
+
+    async def async_get_values(self, station, pollutant, n_days):
+        return await self.async_crud.get_values(station, pollutant, n_days)
+
+    async def async_get_batch_values(self, pairs, stations, n_days):
+        return await self.async_crud.get_batch_values(pairs, stations, n_days)
+
+    async def async_get_area_values(self, level, area, pollutant, n_days):
+        return await self.async_crud.get_area_values(level, area, pollutant, n_days)
+
+    async def async_get_quantiles(self, station, pollutant, n_days, q):
+        return await self.async_crud.get_quantiles(station, pollutant, n_days, q)
+
+    async def async_get_profiles(self, station, pollutant, first_month):
+        return await self.async_crud.get_profiles(station, pollutant, first_month)
+
+def get_backend(name=STORAGE, engine=QUERY_ENGINE):
+    '''
+    Return the storage named "name" ("mongodb" or "sqlite"), only
+    importing the modules it needs, whose averages are calculated by
+    "engine" ("storage" or "numpy", see module "cube").
+    '''
+    if name == "mongodb":
+        storage = mongoBackend()
+    elif name == "sqlite":
+        from .sqlite_storage import sqliteBackend
+        storage = sqliteBackend(SQLITE_PATH)
+    else:
+        raise ValueError("Unknown storage: "+name)
+    if engine == "numpy":
+        from .cube import cubeStorage
+        return cubeStorage(storage)
+    return storage
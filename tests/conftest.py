@@ -0,0 +1,138 @@
+'''
+Fixtures running the same scenarios against every storage (see module
+"storage"): the synthetic LCSQA sources of module "benchmarks.source",
+and each storage built from them.
+
+The MongoDB storage uses the server of GARY_MONGO_URI or, when none
+answers, a temporary server started with the optional "pymongo_inmemory"
+package (which downloads it). Its tests are skipped when neither is
+available, unless GARY_REQUIRE_MONGODB=1 (as in the continuous
+integration, where they must pass).
+'''
+import os
+import sys
+import tempfile
+import types
+from datetime import date
+
+import pytest
+
+# The modules import each other as parts of package "gary", whatever the
+# name of the directory of the checkout.
+if "gary" not in sys.modules:
+    package = types.ModuleType("gary")
+    package.__path__ = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    sys.modules["gary"] = package
+
+from gary.benchmarks.source import sourceServer
+
+# The settings are read when the modules of the application are first
+# imported, so the sources must be known (and the data of the tests kept
+# apart from the real ones) before.
+server = sourceServer(n_stations=4, n_pollutants=3, port=0)
+os.environ.update(server.environment())
+os.environ.update({
+    "GARY_DATABASE_NAME": "air_quality_test",
+    "GARY_MIRROR_DIR": tempfile.mkdtemp(prefix="gary-mirror-"),
+    "GARY_OFFLINE": "0",
+    "GARY_INITIAL_DAYS": "8",
+    # The files of the last five days may still be published later
+    # (those of older days being missing for good).
+    "GARY_FINAL_AFTER_DAYS": "5",
+    "GARY_DOWNLOAD_RETRIES": "0"})
+
+REQUIRE_MONGODB = os.environ.get("GARY_REQUIRE_MONGODB", "0") == "1"
+
+def server_answers(uri):
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+    client = MongoClient(uri, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+def start_mongod():
+    '''
+    Return a temporary MongoDB server started with package
+    "pymongo_inmemory", or None if it cannot be started.
+    '''
+    try:
+        from pymongo_inmemory import Mongod
+        from pymongo_inmemory.context import Context
+        mongod = Mongod(Context())
+        mongod.start()
+    except Exception:
+        return None
+    return mongod
+
+mongod = None
+if not(server_answers(os.environ.get("GARY_MONGO_URI", "mongodb://localhost:27017"))):
+    mongod = start_mongod()
+    if mongod is not None:
+        os.environ["GARY_MONGO_URI"] = mongod.connection_string
+
+def pytest_unconfigure(config):
+    if mongod is not None:
+        mongod.stop()
+
+@pytest.fixture(scope="session")
+def running_server():
+    server.start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def source(running_server, monkeypatch, tmp_path):
+    '''
+    Synthetic sources publishing every day up to today (see attributes
+    "last_day", "missing_days" and "incomplete_days" to simulate missing
+    or incomplete days), downloaded into an empty
+    mirror (whose final days would be read again otherwise).
+    '''
+    monkeypatch.setattr("gary.mirror.MIRROR_DIR", str(tmp_path/"mirror"))
+    running_server.last_day = date.today()
+    running_server.missing_days = set()
+    running_server.incomplete_days = set()
+    yield running_server
+    running_server.last_day = date.today()
+    running_server.missing_days = set()
+    running_server.incomplete_days = set()
+
+def mongo_storage():
+    from pymongo import MongoClient
+
+    from gary.config import DATABASE_NAME, MONGO_URI
+    if not(server_answers(MONGO_URI)):
+        if REQUIRE_MONGODB:
+            pytest.fail("no MongoDB server at "+MONGO_URI)
+        pytest.skip("no MongoDB server at "+MONGO_URI)
+    client = MongoClient(MONGO_URI)
+    client.drop_database(DATABASE_NAME)
+    from gary.storage import mongoBackend
+    return mongoBackend(), lambda: client.drop_database(DATABASE_NAME)
+
+@pytest.fixture
+def mongodb(source):
+    '''
+    Empty MongoDB storage, for the checks specific to MongoDB.
+    '''
+    storage, drop = mongo_storage()
+    yield storage
+    drop()
+
+@pytest.fixture(params=["sqlite", "mongodb"])
+def storage(request, source, tmp_path):
+    '''
+    Empty storage of each kind (built by calling its method "create").
+    '''
+    if request.param == "sqlite":
+        from gary.sqlite_storage import sqliteBackend
+        yield sqliteBackend(str(tmp_path/"air_quality.db"))
+    else:
+        storage, drop = mongo_storage()
+        yield storage
+        drop()
@@ -0,0 +1,46 @@
+from datetime import date, timedelta
+
+import pytest
+
+from gary.backfill import ingest_month, merge_staging, months, staging_name
+from gary.benchmarks.run_suite import expected_values
+from gary.benchmarks.synthetic import station_codes
+from gary.config import INITIAL_DAYS
+
+def backfill(start, end):
+    '''
+    Ingest and merge the days from "start" to "end" as "backfill.backfill"
+    does (in the current process), and return the dates of the files
+    missing at the source.
+    '''
+    partitions = months(start, end)
+    missing = []
+    for partition in partitions:
+        missing += ingest_month(*partition)[2]
+    merge_staging([
+        staging_name(year, month, "") for year, month, _, _ in partitions])
+    return missing
+
+def test_backfill(mongodb, source):
+    # The days preceding the initial ones are added, but the one whose
+    # file is missing, and the revision changes so that the results
+    # cached before are no longer served.
+    n_days = INITIAL_DAYS+12
+    mongodb.create()
+    assert mongodb.revision() == 0
+    source.missing_days = {date.today()-timedelta(days=15)}
+    missing = backfill(
+        date.today()-timedelta(days=n_days),
+        date.today()-timedelta(days=INITIAL_DAYS+1))
+    assert missing == [date.today()-timedelta(days=15)]
+    assert mongodb.revision() == 1
+    assert not(mongodb.update())
+    assert mongodb.revision() == 1
+    pairs = [
+        (station, pollutant)
+        for station in station_codes(source.n_stations)
+        for pollutant in source.pollutants]
+    for pair, expected in expected_values(source, pairs, n_days).items():
+        for row, expected_row in zip(
+            mongodb.get_values(*pair, n_days), expected):
+            assert row == pytest.approx(expected_row, abs=1e-6)
@@ -0,0 +1,34 @@
+import json
+import os
+from datetime import date, timedelta
+
+from gary import mirror
+from gary.download import daily_url, fetch
+
+def test_final_copy_needs_validation_once_final(source):
+    # A copy validated before its day was final may be incomplete: it is
+    # downloaded again, and used as it is afterwards.
+    DATE = date.today()-timedelta(days=10)
+    url = daily_url(DATE)
+    source.incomplete_days = {DATE}
+    incomplete = fetch(url, retries=0)
+    entry_path = mirror._entry_path(url)
+    with open(entry_path) as f:
+        entry = json.load(f)
+    entry["validated"] = (DATE+timedelta(days=1)).isoformat()
+    with open(entry_path, "w") as f:
+        json.dump(entry, f)
+    source.incomplete_days = set()
+    final_since = DATE+timedelta(days=2)
+    complete = fetch(url, retries=0, final_since=final_since)
+    assert os.path.getsize(complete) > os.path.getsize(incomplete)
+    source.last_day = DATE-timedelta(days=1)
+    assert fetch(url, retries=0, final_since=final_since) == complete
+
+def test_prune(source):
+    urls = [daily_url(date.today()-timedelta(days=n)) for n in [1, 2]]
+    paths = [fetch(url, retries=0) for url in urls]
+    mirror.prune(lambda url: url == urls[0], grace=0)
+    assert not(os.path.exists(paths[0]))
+    assert mirror.lookup(urls[0]) is None
+    assert mirror.lookup(urls[1]) == paths[1]
@@ -0,0 +1,96 @@
+'''
+Check that none of the queries performed while serving requests scans
+a whole collection, that is that the indexes of the "indexes" module
+exist, whatever built the MongoDB database: "create_database",
+"update_database" or a backfill (see module "backfill").
+'''
+from datetime import date, timedelta
+
+from gary.backfill import ingest_month, merge_staging, months, staging_name
+from gary.crud import \
+area_pipeline, batch_pipeline, database, profiles_filter, quantiles_pipeline, \
+values_pipeline
+
+def plan_stages(explanation):
+    '''
+    Return the set of the names of the stages found anywhere in the
+    output of an "explain" command.
+    '''
+    stages = set()
+    if isinstance(explanation, dict):
+        for key, value in explanation.items():
+            if key == "stage" and isinstance(value, str):
+                stages.add(value)
+            else:
+                stages |= plan_stages(value)
+    elif isinstance(explanation, list):
+        for value in explanation:
+            stages |= plan_stages(value)
+    return stages
+
+def explain_hot_queries():
+    '''
+    Run "explain" on each query performed while serving requests (with
+    parameters taken from the stored data) and return a dictionary
+    giving the stages of the plan of each of them.
+    '''
+    explain_pipeline = lambda name, pipeline: database.command(
+        "aggregate", name, pipeline=pipeline, explain=True)
+    triple = database["working_days"].find_one()["_id"]
+    rollup = database["working_days_rollups"].find_one()["_id"]
+    explanations = {
+        "get_values": explain_pipeline(
+            "working_days",
+            values_pipeline(triple["station"], triple["pollutant"], 7)),
+        "get_batch_values": explain_pipeline(
+            "working_days",
+            batch_pipeline(
+                [(triple["station"], triple["pollutant"])],
+                [triple["station"]],
+                7)),
+        "get_area_values": explain_pipeline(
+            "working_days_rollups",
+            area_pipeline(
+                rollup["level"], rollup["area"], rollup["pollutant"], 7)),
+        "get_quantiles": explain_pipeline(
+            "working_days",
+            quantiles_pipeline(triple["station"], triple["pollutant"], 7)),
+        "get_profiles": database["profiles"].find(
+            profiles_filter(triple["station"], triple["pollutant"], triple["bucket"]),
+            {"sum": 1, "count": 1}).explain(),
+        "is_monitored_by": database["distribution_pollutants"].find(
+            {"_id": triple["station"]}).explain(),
+        "get_station_codes": database.command(
+            "explain",
+            {"distinct": "LCSQA_stations", "key": "Code station"})}
+    return {label: plan_stages(e) for label, e in explanations.items()}
+
+def assert_no_collscan():
+    scans = {
+        label: sorted(stages)
+        for label, stages in explain_hot_queries().items()
+        if "COLLSCAN" in stages}
+    assert not(scans)
+
+def test_create(mongodb):
+    mongodb.create()
+    assert_no_collscan()
+
+def test_update(mongodb, source):
+    source.last_day = date.today()-timedelta(days=4)
+    mongodb.create()
+    source.last_day = date.today()
+    assert mongodb.update()
+    assert_no_collscan()
+
+def test_backfill(mongodb):
+    # The backfill of the days preceding the initial ones replaces the
+    # histories, rollups and profiles.
+    mongodb.create()
+    partitions = months(
+        date.today()-timedelta(days=20), date.today()-timedelta(days=9))
+    for partition in partitions:
+        ingest_month(*partition)
+    merge_staging([
+        staging_name(year, month, "") for year, month, _, _ in partitions])
+    assert_no_collscan()
@@ -0,0 +1,231 @@
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from gary.benchmarks.run_suite import expected_values, synthetic_records
+from gary.benchmarks.synthetic import station_codes
+from gary.config import INITIAL_DAYS
+from gary.sketch import ACCURACY
+from gary.storage import format_profiles, format_values, storageBackend
+
+def day(n_days_ago):
+    DATE = date.today()-timedelta(days=n_days_ago)
+    return datetime(DATE.year, DATE.month, DATE.day)
+
+def pairs(source):
+    return [
+        (station, pollutant)
+        for station in station_codes(source.n_stations)
+        for pollutant in source.pollutants]
+
+def last_stored_day(storage):
+    return max(
+        data["day"].max() for data in storage.iter_records(day(INITIAL_DAYS).date()))
+
+def assert_values(storage, source):
+    '''
+    Check the averages of every pair against those calculated from the
+    synthetic files of the "INITIAL_DAYS" last days.
+    '''
+    for pair, expected in expected_values(
+        source, pairs(source), INITIAL_DAYS).items():
+        for row, expected_row in zip(
+            storage.get_values(*pair, INITIAL_DAYS), expected):
+            assert row == pytest.approx(expected_row, abs=1e-6)
+
+def assert_profiles(storage, source):
+    '''
+    Check that the profiles of the stored months hold the same days as
+    "get_values" over the "INITIAL_DAYS" last days.
+    '''
+    for pair in pairs(source):
+        profiles = format_profiles(
+            storage.get_profiles(*pair, day(INITIAL_DAYS).date()))
+        values = storage.get_values(*pair, INITIAL_DAYS)
+        assert profiles["working_days"] == pytest.approx(values[0], abs=1e-6)
+        assert profiles["weekends"] == pytest.approx(values[1], abs=1e-6)
+
+def assert_area_values(storage, source):
+    '''
+    Check the averages of the region of the synthetic stations (all
+    located in "Région 0") against those calculated from the synthetic
+    files of the "INITIAL_DAYS" last days.
+    '''
+    records = synthetic_records(source, INITIAL_DAYS)
+    for pollutant in source.pollutants:
+        averages = records[records["Polluant"] == pollutant].groupby(
+            ["working_days","hour"])["valeur brute"].mean()
+        expected = [
+            [averages.get((working_days, hour), 0) for hour in range(24)]
+            for working_days in [True, False]]
+        values = storage.get_area_values(
+            "region", "Région 0", pollutant, INITIAL_DAYS)
+        for row, expected_row in zip(values, expected):
+            assert row == pytest.approx(expected_row, abs=1e-6)
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        storageBackend()
+
+def test_create(storage, source):
+    storage.create()
+    assert storage.is_ready()
+    assert storage.last_update() == day(1)
+    assert storage.station_codes() == set(station_codes(source.n_stations))
+    assert storage.is_monitored_by(source.pollutants[0], station_codes(1)[0])
+    assert not(storage.update())
+    assert_values(storage, source)
+
+def test_concurrent_initialize(storage, source, monkeypatch):
+    # The workers of the API initialize the storage at the same time:
+    # one of them builds it, the others wait for it and reuse it.
+    from gary.storage import mongoBackend
+    builds = []
+    def counted(create):
+        def counted_create():
+            builds.append(threading.get_ident())
+            time.sleep(0.5)
+            create()
+        return counted_create
+    if isinstance(storage, mongoBackend):
+        monkeypatch.setattr(
+            storage.crud, "create_database",
+            counted(storage.crud.create_database))
+    else:
+        monkeypatch.setattr(storage, "create", counted(storage.create))
+    barrier = threading.Barrier(3)
+    def initialize():
+        barrier.wait()
+        storage.initialize(rebuild=True)
+    workers = [threading.Thread(target=initialize) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert len(builds) == 1
+    assert storage.is_ready()
+    assert_values(storage, source)
+
+def test_get_stations(storage, source):
+    storage.create()
+    stations = storage.get_stations()
+    assert [e["code"] for e in stations] == station_codes(source.n_stations)
+    assert {e["region"] for e in stations} == {"Région 0"}
+    for e in stations:
+        for pollutant in source.pollutants:
+            assert (pollutant in e["pollutants"]) == \
+            storage.is_monitored_by(pollutant, e["code"])
+
+def test_get_area_values(storage, source):
+    storage.create()
+    assert_area_values(storage, source)
+    pollutant = source.pollutants[0]
+    assert storage.get_area_values("region", "Région 0", pollutant, 0) == \
+    format_values([])
+    assert storage.get_area_values(
+        "region", "Région 9", pollutant, INITIAL_DAYS) is None
+
+def test_get_quantiles(storage, source):
+    storage.create()
+    for pair, expected in expected_values(
+        source, pairs(source), INITIAL_DAYS, q=0.5).items():
+        for row, expected_row in zip(
+            storage.get_quantiles(*pair, INITIAL_DAYS, 0.5), expected):
+            assert row == pytest.approx(expected_row, rel=ACCURACY*(1+1e-9))
+
+def test_get_profiles(storage, source):
+    storage.create()
+    assert_profiles(storage, source)
+    station, pollutant = pairs(source)[0]
+    profiles = format_profiles(
+        storage.get_profiles(station, pollutant, day(INITIAL_DAYS).date()))
+    months = profiles["months"]
+    assert sorted(months) == sorted({
+        day(n).strftime("%Y-%m") for n in range(1, INITIAL_DAYS+1)})
+
+def test_update_after_missing_days(storage, source):
+    # The days whose files are not published yet are left to the next
+    # update, as well as the ones following them.
+    source.last_day = date.today()-timedelta(days=4)
+    storage.create()
+    assert storage.last_update() == day(4)
+    assert last_stored_day(storage) == (day(4)-datetime(1970, 1, 1)).days
+    storage.update()
+    assert storage.last_update() == day(4)
+    source.last_day = date.today()
+    assert storage.update()
+    assert storage.last_update() == day(1)
+    assert_values(storage, source)
+    assert_profiles(storage, source)
+
+def test_update_skips_days_missing_for_good(storage, source):
+    # A file still not found once its day is final will never be
+    # published: the day is skipped instead of stopping the ingestion,
+    # unlike a recent day which may be published later.
+    source.missing_days = {day(6).date(), day(1).date()}
+    storage.create()
+    assert storage.last_update() == day(2)
+    source.missing_days = {day(6).date()}
+    assert storage.update()
+    assert storage.last_update() == day(1)
+    assert_values(storage, source)
+    assert_profiles(storage, source)
+
+def test_update_revalidates_recent_days(storage, source):
+    # The file of the last day, published incomplete when first stored
+    # (the following day being not published yet), is completed later:
+    # as the day was not final yet, it is stored again by the next update.
+    source.last_day = date.today()-timedelta(days=2)
+    source.incomplete_days = {day(2).date()}
+    storage.create()
+    assert storage.last_update() == day(2)
+    source.last_day = date.today()
+    source.incomplete_days = set()
+    assert storage.update()
+    assert storage.last_update() == day(1)
+    assert_values(storage, source)
+    assert_profiles(storage, source)
+    assert_area_values(storage, source)
+
+def test_update_stores_days_again(storage, source):
+    # Days stored again (by an update interrupted before recording its
+    # date, then run again) must not be counted twice.
+    source.last_day = date.today()-timedelta(days=4)
+    storage.create()
+    source.last_day = date.today()
+    storage.update()
+    storage.set_last_update(day(4))
+    assert storage.update()
+    assert storage.last_update() == day(1)
+    assert_values(storage, source)
+    assert_profiles(storage, source)
+    assert_area_values(storage, source)
+
+def test_update_interrupted_partway(storage, source, monkeypatch):
+    # An update failing after part of its data were written (on MongoDB,
+    # once the histories of the weekends are merged but not their rollups
+    # and profiles) leaves the storage as consistent once run again.
+    from gary.storage import mongoBackend
+    source.last_day = date.today()-timedelta(days=4)
+    storage.create()
+    source.last_day = date.today()
+    def fail(*args):
+        raise RuntimeError("interrupted update")
+    with monkeypatch.context() as patch:
+        if isinstance(storage, mongoBackend):
+            store_rollups = storage.crud.store_rollups
+            patch.setattr(storage.crud, "store_rollups",
+                lambda name, *args: fail() if name == "new_weekends" \
+                else store_rollups(name, *args))
+        else:
+            patch.setattr(type(storage), "set_last_update", fail)
+        with pytest.raises(RuntimeError):
+            storage.update()
+    assert storage.last_update() == day(4)
+    assert storage.update()
+    assert storage.last_update() == day(1)
+    assert_values(storage, source)
+    assert_profiles(storage, source)
+    assert_area_values(storage, source)